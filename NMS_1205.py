@@ -4,7 +4,6 @@
 import mido  # type: ignore
 import queue
 import threading
-import time
 
 class NMS_1205(threading.Thread):
     def __init__(self, cpu, debug):
@@ -40,10 +39,14 @@ class NMS_1205(threading.Thread):
 
             self.qinbuf.put(in_)
 
-            self.cpu.interrupt()
+            # raised in the emulation thread
+            self.cpu.scheduler.post(self.midi_in)
 
         self.mpi.close()
 
+    def midi_in(self, when: int) -> None:
+        self.cpu.interrupt()
+
     def read_io(self, a: int) -> int:
         if a == 0x00:  # status register mpo
             return 0b00001110
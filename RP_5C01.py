@@ -16,6 +16,16 @@ class RP_5C01:
     def get_name(self):
         return 'RP-5C01 (RTC)'
 
+    def get_state(self) -> bytes:
+        # the register index followed by the 16 blocks of the 4 registers
+        return bytes([ self.ri ]) + b''.join(bytes(registers) for registers in self.blocks)
+
+    def set_state(self, data: bytes) -> None:
+        self.ri = data[0]
+
+        for i, registers in enumerate(self.blocks):
+            registers[:] = data[1 + i * 4:5 + i * 4]
+
     def read_io(self, a: int) -> int:
         block = self.blocks[0x0d][0] & 3
 
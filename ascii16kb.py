@@ -27,6 +27,9 @@ class ascii16kb:
     def get_n_pages(self):
         return 2
 
+    def get_banks(self) -> Tuple[int, ...]:
+        return tuple(self.ascii16kb_pages)
+
     def split_addr(self, a: int) -> Tuple[int, int]:
         assert a >= 0x4000
 
@@ -47,6 +50,12 @@ class ascii16kb:
         else:
             self.debug('ASCII-16kB write to %04x not understood' % a)
 
+    def get_state(self) -> bytes:
+        return bytes(self.ascii16kb_pages)
+
+    def set_state(self, data: bytes) -> None:
+        self.ascii16kb_pages[:] = data
+
     def read_mem(self, a: int) -> int:
         bank, offset = self.split_addr(a)
 
@@ -0,0 +1,152 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import queue
+import struct
+import threading
+from typing import Callable
+
+# kind, pc (or address), AF (or value), BC, DE, HL, AF', BC', DE', HL', IX,
+# IY, SP, cycle count
+record = struct.Struct('<BxHHHHHHHHHHHHQ')
+
+INSTRUCTION: int = 0
+MEM_READ: int = 1
+MEM_WRITE: int = 2
+IO_READ: int = 3
+IO_WRITE: int = 4
+
+kind_names = ( 'instruction', 'read', 'write', 'in', 'out' )
+
+class bintrace:
+    ''' Writes the instructions executed by step() and run() (with the
+    registers before each) and the memory and I/O accesses they do to a
+    file, as fixed size records. The records are collected in a buffer
+    that is written by a background thread. '''
+
+    def __init__(self, filename: str, buffer_size: int = 1 << 20) -> None:
+        self.fh = open(filename, 'wb')
+        self.buffer_size: int = buffer_size
+        self.buffer = bytearray()
+
+        # in an instruction (not decoding one)
+        self.active: bool = False
+
+        self.cpu = None
+        self.queue: queue.Queue = queue.Queue(16)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def start(self, cpu) -> None:
+        self.cpu = cpu
+
+        cpu.add_access_hook(self, { 'read_mem': self.traced_read_mem, 'bus_write_mem': self.traced_write_mem, 'read_io': self.traced_read_io, 'write_io': self.traced_write_io })
+        cpu.add_hook(self)
+
+    def stop(self) -> None:
+        cpu = self.cpu
+
+        cpu.remove_hook(self)
+        cpu.remove_access_hook(self)
+
+        self.queue.put(self.buffer)
+        self.queue.put(None)
+        self.thread.join()
+
+        self.fh.close()
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        pack = record.pack
+        sched = cpu.scheduler
+
+        def traced() -> int:
+            self.buffer += pack(INSTRUCTION, pc, (cpu.a << 8) | cpu.f, cpu.bc, cpu.de, cpu.hl, (cpu.a_ << 8) | cpu.f_, cpu.bc_, cpu.de_, cpu.hl_, cpu.ix, cpu.iy, cpu.sp, sched.now)
+
+            self.active = True
+            took = handler()
+            self.active = False
+
+            if len(self.buffer) >= self.buffer_size:
+                self.queue.put(self.buffer)
+                self.buffer = bytearray()
+
+            return took
+
+        return traced
+
+    def access(self, kind: int, a: int, v: int) -> None:
+        self.buffer += record.pack(kind, a, v, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, self.cpu.scheduler.now)
+
+    def traced_read_mem(self, a: int) -> int:
+        v = self.read_mem(a)
+
+        if self.active:
+            self.access(MEM_READ, a, v)
+
+        return v
+
+    def traced_write_mem(self, a: int, v: int) -> None:
+        if self.active:
+            self.access(MEM_WRITE, a, v)
+
+        self.bus_write_mem(a, v)
+
+    def traced_read_io(self, a: int) -> int:
+        v = self.read_io(a)
+
+        if self.active:
+            self.access(IO_READ, a, v)
+
+        return v
+
+    def traced_write_io(self, a: int, v: int) -> None:
+        if self.active:
+            self.access(IO_WRITE, a, v)
+
+        self.write_io(a, v)
+
+    def writer(self) -> None:
+        while True:
+            data = self.queue.get()
+
+            if data is None:
+                break
+
+            self.fh.write(data)
+
+def describe(data: bytes) -> str:
+    kind, pc, af, bc, de, hl, af_, bc_, de_, hl_, ix, iy, sp, cycles = record.unpack(data)
+
+    if kind == INSTRUCTION:
+        return '%d: %04x AF %04x BC %04x DE %04x HL %04x AF\' %04x BC\' %04x DE\' %04x HL\' %04x IX %04x IY %04x SP %04x' % (cycles, pc, af, bc, de, hl, af_, bc_, de_, hl_, ix, iy, sp)
+
+    return '%d:    %s %04x: %02x' % (cycles, kind_names[kind], pc, af)
+
+def first_difference(a, b, chunk: int = 1 << 24) -> int:
+    ''' Offset of the first byte that differs in 'a' and 'b' (e.g. mmaps of
+    two traces), or -1 when they are the same. '''
+    n = min(len(a), len(b))
+    pos = 0
+
+    while pos < n:
+        end = min(pos + chunk, n)
+
+        if a[pos:end] != b[pos:end]:
+            # halve the range until it is small
+            while end - pos > 4096:
+                middle = (pos + end) // 2
+
+                if a[pos:middle] != b[pos:middle]:
+                    end = middle
+
+                else:
+                    pos = middle
+
+            while a[pos] == b[pos]:
+                pos += 1
+
+            return pos
+
+        pos = end
+
+    return n if len(a) != len(b) else -1
@@ -0,0 +1,109 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from typing import Callable, Dict, Optional
+
+# the loops of the MSX 1 BIOS routines that move VRAM one byte at a time
+# through the data port: address of the loop, its code and the cycles per
+# iteration. Each iteration ends with DEC BC / LD A,C / OR B / JR NZ.
+loops: Dict[int, tuple] = {
+        0x0714: ('LDIRMV', bytes([ 0xdb, 0x98, 0x12, 0x13, 0x0b, 0x79, 0xb0, 0x20, 0xf7 ]), 50),  # IN A,(98) / LD (DE),A / INC DE
+        0x0748: ('LDIRVM', bytes([ 0x1a, 0xd3, 0x98, 0x13, 0x0b, 0x79, 0xb0, 0x20, 0xf7 ]), 50),  # LD A,(DE) / OUT (98),A / INC DE
+        0x0819: ('FILVRM', bytes([ 0xf1, 0xd3, 0x98, 0xf5, 0x0b, 0x79, 0xb0, 0x20, 0xf7 ]), 58),  # POP AF / OUT (98),A / PUSH AF
+    }
+
+class bios_vram:
+    ''' High level emulation of LDIRVM, LDIRMV and FILVRM of the BIOS: when
+    their loop is entered, the iterations up to the next scheduled event
+    (e.g. the VDP interrupt) are done at once, with one bulk transfer to
+    or from the VDP (see screen_kb.write_data()/read_data()). The
+    registers, flags and cycles end up as when the loop had run; the
+    last iteration is always executed by the BIOS itself. The rest of the
+    routines (setting the VRAM address) is not touched. WRTVRM and RDVRM
+    move a single byte and gain nothing from this. Uses pc_hooks: see
+    install(). '''
+
+    def __init__(self, cpu, vdp) -> None:
+        self.cpu = cpu
+        self.vdp = vdp
+
+        self.handlers: Dict[int, Callable] = { 0x0714: self.ldirmv, 0x0748: self.ldirvm, 0x0819: self.filvrm }
+
+    def matches(self, read_mem: Optional[Callable[[int], int]] = None) -> bool:
+        ''' Is the BIOS (read through 'read_mem', by default what the CPU
+        sees) the one with these loops? '''
+        read_mem = read_mem or self.cpu.read_mem
+
+        for a, (name, code, cycles) in loops.items():
+            if bytes([ read_mem(a + i) for i in range(len(code)) ]) != code:
+                return False
+
+        return True
+
+    def install(self, hooks, condition: Optional[str] = None) -> None:
+        ''' Adds the loops to a pchooks.pc_hooks; 'condition' should hold
+        when the BIOS is mapped at 0x0000. '''
+        for a, handler in self.handlers.items():
+            hooks.add(a, handler, condition)
+
+    def iterations(self, cycles: int) -> int:
+        # how many iterations can be done before the next scheduled event,
+        # leaving the last one
+        cpu = self.cpu
+        sched = cpu.scheduler
+
+        remaining = ((cpu.bc - 1) & 0xffff) + 1
+
+        return min(remaining - 1, (sched.deadline - sched.now - 1) // cycles)
+
+    def done(self, n: int, cycles: int) -> int:
+        # the registers at the start of the loop after 'n' iterations
+        cpu = self.cpu
+
+        bc = cpu.bc = (cpu.bc - n) & 0xffff
+
+        cpu.a = (bc >> 8) | (bc & 0xff)
+        cpu.f = cpu.sz53p_lookup[cpu.a]
+        cpu.memptr = cpu.pc
+
+        return n * cycles
+
+    def ldirmv(self, cpu) -> Optional[int]:
+        n = self.iterations(50)
+
+        if n <= 0:
+            return None
+
+        de = cpu.de
+
+        for i, v in enumerate(self.vdp.read_data(n)):
+            cpu.write_mem((de + i) & 0xffff, v)
+
+        cpu.de = (de + n) & 0xffff
+
+        return self.done(n, 50)
+
+    def ldirvm(self, cpu) -> Optional[int]:
+        n = self.iterations(50)
+
+        if n <= 0:
+            return None
+
+        de = cpu.de
+
+        self.vdp.write_data(bytes([ cpu.read_mem((de + i) & 0xffff) for i in range(n) ]))
+
+        cpu.de = (de + n) & 0xffff
+
+        return self.done(n, 50)
+
+    def filvrm(self, cpu) -> Optional[int]:
+        n = self.iterations(58)
+
+        if n <= 0:
+            return None
+
+        # the value is in the pushed AF
+        self.vdp.write_data(bytes([ cpu.read_mem((cpu.sp + 1) & 0xffff) ]) * n)
+
+        return self.done(n, 58)
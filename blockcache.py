@@ -0,0 +1,222 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+# instructions after which a block ends: jumps, calls, returns, port
+# access, halt and changes to the interrupt state
+end_main = (0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0x76, 0xc0, 0xc2, 0xc3, 0xc4, 0xc7, 0xc8, 0xc9, 0xca, 0xcc, 0xcd, 0xcf, 0xd0, 0xd2, 0xd3, 0xd4, 0xd7, 0xd8, 0xda, 0xdb, 0xdc, 0xdf, 0xe0, 0xe2, 0xe4, 0xe7, 0xe8, 0xe9, 0xea, 0xec, 0xef, 0xf0, 0xf2, 0xf3, 0xf4, 0xf7, 0xf8, 0xfa, 0xfb, 0xfc, 0xff)
+
+# ED: in/out, retn/reti and the block instructions (the repeating ones
+# rewind the program counter)
+end_ed = tuple([ i for i in range(0x40, 0x80) if (i & 7) in (0, 1, 5) ] + [ i for i in range(0xa0, 0xc0) ])
+
+class blockcache:
+    ''' Translates straight-line Z80 code into Python functions. Blocks are
+    cached per program counter and memory layout and are thrown away when
+    the CPU writes to a byte of them: these are registered per key of the
+    memory layout (e.g. a RAM segment) and 256 bytes in it, so that a write
+    through any address where that is mapped is seen. Instructions are
+    decoded by the CPU. '''
+
+    def __init__(self, cpu, max_instructions: int = 64):
+        self.cpu = cpu
+        self.max_instructions: int = max_instructions
+
+        self.layouts: Dict[object, Dict[int, Callable]] = {}
+        self.layout: object = cpu.memory_layout
+        self.blocks: Dict[int, Callable] = self.layouts.setdefault(self.layout, {})
+
+        # per (key, 256 bytes in its 16KB): the (layout, start, lowest and
+        # highest offset in the 16KB, stale-marker) of the blocks that have
+        # bytes there
+        self.part_blocks: Dict[tuple, list] = {}
+
+        self.n_compiled: int = 0
+        self.n_invalidated: int = 0
+
+    def set_layout(self, layout) -> None:
+        self.layout = layout
+        self.blocks = self.layouts.setdefault(layout, {})
+
+    def invalidate(self, a: int) -> None:
+        offset = a & 0x3fff
+        part = (self.cpu.memory_layout[a >> 14], offset >> 8)
+
+        entries = self.part_blocks.get(part)
+
+        if not entries:
+            return
+
+        keep = []
+
+        for entry in entries:
+            layout, start, low, high, stale = entry
+
+            if stale[0]:
+                continue
+
+            if offset < low or offset > high:
+                keep.append(entry)
+                continue
+
+            stale[0] = True
+
+            blocks = self.layouts[layout]
+            if start in blocks and blocks[start].stale is stale:
+                del blocks[start]
+                self.n_invalidated += 1
+
+        self.part_blocks[part] = keep
+
+    def flush(self) -> None:
+        for entries in self.part_blocks.values():
+            for layout, start, low, high, stale in entries:
+                stale[0] = True
+
+        self.part_blocks = {}
+
+        self.layouts = {}
+        self.set_layout(self.layout)
+
+    def get(self, pc: int) -> Optional[Callable]:
+        block = self.blocks.get(pc)
+
+        if block is None:
+            block = self.compile(pc)
+
+        return block
+
+    def decode(self, a: int) -> Tuple[Callable[[], int], int, bool]:
+        ''' returns handler (with its operands), instruction length and if
+        the block ends after this instruction '''
+        read = self.cpu.fetch_mem
+
+        handler, length = self.cpu.decode(a)
+
+        instr = read(a)
+
+        if instr == 0xcb:
+            return (handler, length, False)
+
+        if instr == 0xed:
+            return (handler, length, read((a + 1) & 0xffff) in end_ed)
+
+        if instr == 0xdd or instr == 0xfd:
+            instr = read((a + 1) & 0xffff)
+
+            if instr == 0xcb:
+                return (handler, length, False)
+
+            if instr in (0xdd, 0xed, 0xfd):  # chained prefixes
+                return (handler, length, True)
+
+        return (handler, length, instr in end_main)
+
+    def inline(self, a: int, length: int) -> Optional[Tuple[List[str], int]]:
+        ''' Python statements for simple instructions that do not touch the
+        flags or memory, None if the handler needs to be called '''
+        read = self.cpu.fetch_mem
+        instr = read(a)
+
+        # reading and setting B, C, D, E, H, L and A
+        get = ( '(cpu.bc >> 8)', '(cpu.bc & 0xff)', '(cpu.de >> 8)', '(cpu.de & 0xff)', '(cpu.hl >> 8)', '(cpu.hl & 0xff)', None, 'cpu.a' )
+        put = ( 'cpu.bc = (cpu.bc & 0xff) | (%s << 8)', 'cpu.bc = (cpu.bc & 0xff00) | %s', 'cpu.de = (cpu.de & 0xff) | (%s << 8)', 'cpu.de = (cpu.de & 0xff00) | %s',
+                'cpu.hl = (cpu.hl & 0xff) | (%s << 8)', 'cpu.hl = (cpu.hl & 0xff00) | %s', None, 'cpu.a = %s' )
+
+        if instr == 0x00:  # NOP
+            return ([], 4)
+
+        if instr >= 0x40 and instr < 0x80 and instr != 0x76 and (instr & 7) != 6 and ((instr >> 3) & 7) != 6:  # LD r,r'
+            return ([ put[(instr >> 3) & 7] % get[instr & 7] ], 4)
+
+        if instr < 0x40 and (instr & 7) == 6 and instr != 0x36:  # LD r,n
+            return ([ put[instr >> 3] % ('0x%02x' % read((a + 1) & 0xffff)) ], 7)
+
+        if instr in (0x01, 0x11, 0x21, 0x31):  # LD rr,nn
+            pair = ('bc', 'de', 'hl', 'sp')[instr >> 4]
+            return ([ 'cpu.%s = 0x%04x' % (pair, (read((a + 2) & 0xffff) << 8) | read((a + 1) & 0xffff)) ], 10)
+
+        if instr == 0xeb:  # EX DE,HL
+            return ([ 'cpu.de, cpu.hl = cpu.hl, cpu.de' ], 4)
+
+        return None
+
+    def compile(self, start: int) -> Optional[Callable]:
+        code: List[str] = []
+        handlers: dict = {}
+        stale: List[bool] = [ False ]
+
+        a = start
+        pc_ok = True
+        n = 0
+        cycles = 0
+
+        while n < self.max_instructions:
+            handler, length, end = self.decode(a)
+
+            next_a = (a + length) & 0xffff
+
+            simple = None if end else self.inline(a, length)
+
+            if simple:
+                code += simple[0]
+                cycles += simple[1]
+                pc_ok = False
+
+            else:
+                name = 'h%d' % n
+                handlers[name] = handler
+
+                code.append('cpu.pc = 0x%04x' % next_a)
+                code.append('t += %s()' % name)
+                pc_ok = True
+
+                if not end:
+                    code.append('if stale[0]:')
+                    code.append('    return t + %d' % cycles)
+
+            a = next_a
+            n += 1
+
+            if end:
+                break
+
+        if n == 0:
+            return None
+
+        if not pc_ok:
+            code.append('cpu.pc = 0x%04x' % a)
+
+        code.append('return t + %d' % cycles)
+
+        src = 'def block_%04x(cpu):\n    t = 0\n' % start + ''.join([ '    %s\n' % line for line in code ])
+
+        handlers['stale'] = stale
+        exec(compile(src, '<block %04x>' % start, 'exec'), handlers)
+
+        block = handlers['block_%04x' % start]
+        block.stale = stale
+
+        self.blocks[start] = block
+
+        last = (a - 1) & 0xffff
+        page = start >> 8
+        while True:
+            low = start if page == start >> 8 else page << 8
+            high = last if page == last >> 8 else (page << 8) | 0xff
+
+            part = (self.layout[page >> 6], page & 0x3f)
+            self.part_blocks.setdefault(part, []).append((self.layout, start, low & 0x3fff, high & 0x3fff, stale))
+
+            # let the CPU check these bytes on writes
+            self.cpu.mark_code(page << 8)
+
+            if page == last >> 8:
+                break
+
+            page = (page + 1) & 0xff
+
+        self.n_compiled += 1
+
+        return block
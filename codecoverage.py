@@ -0,0 +1,175 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import ast
+import json
+from typing import Callable, Dict, List
+
+# per byte a combination of these
+EXECUTED: int = 1
+READ: int = 2
+WRITTEN: int = 4
+START: int = 8  # first byte of an instruction
+
+class codecoverage:
+    ''' Which bytes were executed (as part of an instruction), read and
+    written by step() and run(), per bank: what is mapped in a 16KB page,
+    the key of the CPU's memory layout (slot/subslot/page, with the banks
+    of a mapper or megarom). Instructions are marked when they are
+    decoded, so executing them again costs nothing; reads and writes cost
+    a bytearray OR each. Reading the code of an instruction is not a read:
+    the CPU does that with fetch_mem, which is not hooked. Not recorded
+    with compiled blocks. '''
+
+    def __init__(self) -> None:
+        # bank: flags per byte
+        self.maps: Dict[object, bytearray] = {}
+        # bank: the instruction bytes (for listing())
+        self.code: Dict[object, bytearray] = {}
+
+        # the maps of the pages of the current memory layout
+        self.layout = None
+        self.pages: list = [ None ] * 4
+
+        self.cpu = None
+
+    def get_map(self, bank) -> bytearray:
+        m = self.maps.get(bank)
+
+        if m is None:
+            m = self.maps[bank] = bytearray(16384)
+            self.code[bank] = bytearray(16384)
+
+        return m
+
+    def set_layout(self, layout: tuple) -> None:
+        self.layout = layout
+        self.pages = [ self.get_map(bank) for bank in layout ]
+
+    def start(self, cpu) -> None:
+        self.cpu = cpu
+
+        cpu.add_access_hook(self, { 'read_mem': self.counted_read_mem, 'bus_write_mem': self.counted_write_mem })
+        cpu.add_hook(self)
+
+    def stop(self) -> None:
+        cpu = self.cpu
+
+        cpu.remove_hook(self)
+        cpu.remove_access_hook(self)
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        if cpu.memory_layout is not self.layout:
+            self.set_layout(cpu.memory_layout)
+
+        for i in range(length):
+            a = (pc + i) & 0xffff
+            page = a >> 14
+            offset = a & 0x3fff
+
+            self.pages[page][offset] |= (START | EXECUTED) if i == 0 else EXECUTED
+            self.code[self.layout[page]][offset] = cpu.fetch_mem(a)
+
+        return handler
+
+    def counted_read_mem(self, a: int) -> int:
+        cpu = self.cpu
+
+        if cpu.memory_layout is not self.layout:
+            self.set_layout(cpu.memory_layout)
+
+        self.pages[a >> 14][a & 0x3fff] |= READ
+
+        return self.read_mem(a)
+
+    def counted_write_mem(self, a: int, v: int) -> None:
+        cpu = self.cpu
+
+        if cpu.memory_layout is not self.layout:
+            self.set_layout(cpu.memory_layout)
+
+        self.pages[a >> 14][a & 0x3fff] |= WRITTEN
+
+        self.bus_write_mem(a, v)
+
+    def export(self, filename: str) -> None:
+        ''' As JSON: per bank (its repr()) the flags and instruction bytes,
+        in hex. '''
+        data = { repr(bank): { 'flags': m.hex(), 'code': self.code[bank].hex() } for bank, m in self.maps.items() if any(m) }
+
+        with open(filename, 'w') as fh:
+            json.dump(data, fh, indent=1)
+
+    def load(self, filename: str) -> None:
+        ''' Adds the coverage in a file written by export(), e.g. of an
+        earlier run. '''
+        with open(filename, 'r') as fh:
+            data = json.load(fh)
+
+        for key, item in data.items():
+            bank = ast.literal_eval(key)
+
+            m = self.get_map(bank)
+            for i, v in enumerate(bytes.fromhex(item['flags'])):
+                m[i] |= v
+
+            code = self.code[bank]
+            for i, v in enumerate(bytes.fromhex(item['code'])):
+                if m[i] & EXECUTED:
+                    code[i] = v
+
+    def listing(self, bank) -> List[str]:
+        ''' The bytes of a bank that were used, one line per instruction or
+        data byte (offset in the bank, bytes, X for executed, R for read and
+        W for written). A gap is shown as an empty line. '''
+        m = self.maps[bank]
+        code = self.code[bank]
+
+        out = []
+        i = 0
+
+        while i < 16384:
+            flags = m[i]
+
+            if flags == 0:
+                if out and out[-1]:
+                    out.append('')
+
+                i += 1
+                continue
+
+            n = 1
+
+            if flags & START:
+                # the instruction ends at the next instruction (at most 4
+                # bytes) or at the last executed byte
+                while n < 4 and i + n < 16384 and (m[i + n] & (START | EXECUTED)) == EXECUTED:
+                    n += 1
+
+            for k in range(i, i + n):
+                flags |= m[k]
+
+            state = ''.join(c if flags & flag else '-' for c, flag in (('X', EXECUTED), ('R', READ), ('W', WRITTEN)))
+
+            if flags & EXECUTED:
+                out.append('%04x  %-11s  %s' % (i, code[i:i + n].hex(' '), state))
+
+            else:
+                out.append('%04x  %-11s  %s' % (i, '', state))
+
+            i += n
+
+        return out
+
+    def write_listing(self, filename: str) -> None:
+        with open(filename, 'w') as fh:
+            for bank in self.maps:
+                lines = self.listing(bank)
+
+                if lines:
+                    fh.write('%s:\n' % (bank,))
+
+                    for line in lines:
+                        fh.write('%s\n' % line)
+
+                    fh.write('\n')
@@ -0,0 +1,485 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# runs a CP/M program (e.g. zexall.com) without an MSX around it:
+# cpm.py [options] program.com [arguments]
+
+import os
+import sys
+from optparse import OptionParser
+from typing import List, Optional, TextIO
+from z80 import z80
+from screen_kb_dummy import screen_kb_dummy
+
+# where the BDOS is (0x0005 jumps there; it is also the top of the memory
+# that programs can use) and the warm boot entry of the BIOS (0x0000 jumps
+# there)
+bdos_address: int = 0xfe06
+wboot_address: int = 0xff03
+
+# the file control blocks and the command line (and default DMA address)
+fcb1: int = 0x005c
+fcb2: int = 0x006c
+command_tail: int = 0x0080
+
+record_size: int = 128
+
+class cpm:
+    ''' A Z80 with 64KB of RAM that runs CP/M 2.2 programs: BDOS calls are
+    done in Python, files are the files in 'directory' (the drive letter is
+    ignored), the console is 'fin'/'fout'. The program ends with a warm boot:
+    a jump to 0x0000, a RET from the program or BDOS function 0. Of the
+    BIOS only the warm boot is there. 'compiled' uses compiled blocks (see
+    blockcache.py), the BDOS is reached through a jump which always starts a
+    block so that run_block() can stop there. '''
+
+    def __init__(self, directory: str = '.', fin: TextIO = sys.stdin, fout: TextIO = sys.stdout, compiled: bool = True) -> None:
+        self.directory = directory
+        self.fin = fin
+        self.fout = fout
+        self.compiled = compiled
+
+        self.ram: List[int] = [ 0 ] * 65536
+        self.io: List[int] = [ 0 ] * 256
+
+        ram = self.ram
+
+        def write_mem(a: int, v: int) -> None:
+            ram[a] = v
+
+        def write_io(a: int, v: int) -> None:
+            self.io[a & 0xff] = v
+
+        self.cpu = z80(ram.__getitem__, write_mem, lambda a: self.io[a & 0xff], write_io, lambda x: None, screen_kb_dummy(self.io))
+        self.cpu.set_memory_layout((0, 1, 2, 3), [ (ram, page << 14, True) for page in range(4) ])
+
+        if compiled:
+            self.cpu.enable_blocks()
+
+        self.dma: int = command_tail
+        self.user: int = 0
+        # what BDOS function 17 found, for 18
+        self.found: List[str] = []
+        self.done: bool = False
+
+        self.functions = { 0: self.reset, 1: self.console_input, 2: self.console_output, 6: self.direct_console_io,
+                9: self.print_string, 10: self.read_buffer, 11: self.console_status, 12: self.version,
+                13: self.reset_disks, 14: self.select_disk, 15: self.open_file, 16: self.close_file,
+                17: self.search_first, 18: self.search_next, 19: self.delete_file, 20: self.read_sequential,
+                21: self.write_sequential, 22: self.make_file, 23: self.rename_file, 25: self.current_disk,
+                26: self.set_dma, 32: self.user_code, 33: self.read_random, 34: self.write_random,
+                35: self.file_size, 36: self.set_random_record }
+
+    def load(self, filename: str, arguments: List[str] = []) -> None:
+        ''' Puts the program at 0x0100, the arguments in the command line
+        and the first two in the file control blocks. '''
+        ram = self.ram
+        cpu = self.cpu
+
+        with open(filename, 'rb') as fh:
+            program = fh.read()
+
+        ram[0x0100:0x0100 + len(program)] = list(program)
+
+        # JP WBOOT, JP BDOS
+        ram[0x0000:0x0003] = [ 0xc3, wboot_address & 0xff, wboot_address >> 8 ]
+        ram[0x0005:0x0008] = [ 0xc3, bdos_address & 0xff, bdos_address >> 8 ]
+        # RET after the call is done
+        ram[bdos_address] = 0xc9
+        # warm boot is BDOS function 0: LD C,0 / JP BDOS
+        ram[wboot_address:wboot_address + 5] = [ 0x0e, 0x00, 0xc3, bdos_address & 0xff, bdos_address >> 8 ]
+
+        tail = (' ' + ' '.join(arguments)).upper()[0:127] if arguments else ''
+        ram[command_tail] = len(tail)
+        ram[command_tail + 1:command_tail + 1 + len(tail)] = [ ord(c) & 0x7f for c in tail ]
+
+        self.set_fcb(fcb1, arguments[0] if len(arguments) > 0 else '')
+        self.set_fcb(fcb2, arguments[1] if len(arguments) > 1 else '')
+
+        cpu.flush_decoded()
+
+        # a RET from the program does a warm boot
+        cpu.sp = bdos_address
+        cpu.push(0x0000)
+        cpu.pc = 0x0100
+
+    def set_fcb(self, a: int, text: str) -> None:
+        drive = 0
+
+        if len(text) > 1 and text[1] == ':':
+            drive = ord(text[0].upper()) - ord('A') + 1
+            text = text[2:]
+
+        name, dot, type_ = text.upper().partition('.')
+
+        def field(part: str, n: int) -> List[int]:
+            if '*' in part:
+                part = part[0:part.index('*')].ljust(n, '?')
+
+            return [ ord(c) & 0x7f for c in part[0:n].ljust(n) ]
+
+        self.store(a, [ drive ] + field(name, 8) + field(type_, 3) + [ 0 ] * 4)
+        self.store(a + 32, [ 0 ])
+
+    def store(self, a: int, values: List[int]) -> None:
+        # the CPU does not see what is put in self.ram directly: it has to
+        # drop what it decoded or compiled there
+        ram = self.ram
+        n = min(len(values), 0x10000 - a)
+
+        ram[a:a + n] = values[0:n]
+        ram[0:len(values) - n] = values[n:]
+
+        self.cpu.invalidate_range(a, n)
+        self.cpu.invalidate_range(0, len(values) - n)
+
+    def run(self, limit: Optional[int] = None) -> bool:
+        ''' Runs the program until it ends (returns True) or, when given,
+        'limit' cycles have passed (False). '''
+        cpu = self.cpu
+        run = cpu.run_block if self.compiled else cpu.run
+        end = None if limit is None else cpu.scheduler.now + limit
+
+        try:
+            while not self.done:
+                if end is not None and cpu.scheduler.now >= end:
+                    return False
+
+                run(1000000 if end is None else min(1000000, end - cpu.scheduler.now), bdos_address)
+
+                if cpu.pc == bdos_address:
+                    self.bdos()
+
+                    if not self.done:
+                        cpu.step()  # the RET
+
+        finally:
+            self.fout.flush()
+
+        return True
+
+    def bdos(self) -> None:
+        cpu = self.cpu
+        function = self.functions.get(cpu.c)
+
+        if function is None:
+            print('BDOS function %d is not supported' % cpu.c, file=sys.stderr)
+            self.result(0xff)
+            return
+
+        result = function(cpu.de)
+
+        self.result(0 if result is None else result)
+
+    def result(self, v: int) -> None:
+        # 8 bit results are in A and L, 16 bit results in HL (and BA)
+        cpu = self.cpu
+
+        cpu.hl = v & 0xffff
+        cpu.a = v & 0xff
+        cpu.b = (v >> 8) & 0xff
+
+    # console
+
+    def output(self, text: str) -> None:
+        self.fout.write(text)
+
+    def reset(self, de: int) -> None:
+        self.done = True
+
+    def read_char(self) -> int:
+        self.fout.flush()
+
+        c = self.fin.read(1)
+
+        return ord(c) & 0xff if c else 0x1a  # ^Z at the end
+
+    def console_input(self, de: int) -> int:
+        c = self.read_char()
+
+        self.output(chr(c))
+
+        return c
+
+    def console_output(self, de: int) -> None:
+        self.output(chr(de & 0xff))
+
+    def direct_console_io(self, de: int) -> Optional[int]:
+        e = de & 0xff
+
+        if e == 0xff:
+            return self.read_char()
+
+        if e == 0xfe:
+            return 0
+
+        self.output(chr(e))
+
+        return None
+
+    def print_string(self, de: int) -> None:
+        ram = self.ram
+        out = []
+
+        # (at most all of memory when there is no '$')
+        for i in range(0x10000):
+            if ram[de] == ord('$'):
+                break
+
+            out.append(chr(ram[de]))
+            de = (de + 1) & 0xffff
+
+        self.output(''.join(out))
+
+    def read_buffer(self, de: int) -> None:
+        self.fout.flush()
+
+        line = self.fin.readline().rstrip('\r\n')[0:self.ram[de]]
+
+        self.output(line + '\r\n')
+
+        self.store((de + 1) & 0xffff, [ len(line) ] + [ ord(c) & 0xff for c in line ])
+
+    def console_status(self, de: int) -> int:
+        return 0
+
+    def version(self, de: int) -> int:
+        return 0x0022
+
+    # disks and files
+
+    def reset_disks(self, de: int) -> None:
+        self.dma = command_tail
+
+    def select_disk(self, de: int) -> None:
+        pass
+
+    def current_disk(self, de: int) -> int:
+        return 0
+
+    def set_dma(self, de: int) -> None:
+        self.dma = de
+
+    def user_code(self, de: int) -> int:
+        if de & 0xff != 0xff:
+            self.user = de & 0x0f
+
+        return self.user
+
+    def fcb_name(self, fcb: int) -> str:
+        # "NAME.TYP" with the attribute bits removed
+        ram = self.ram
+
+        name = ''.join(chr(ram[fcb + i] & 0x7f) for i in range(1, 9)).rstrip()
+        type_ = ''.join(chr(ram[fcb + i] & 0x7f) for i in range(9, 12)).rstrip()
+
+        return name + '.' + type_ if type_ else name
+
+    def fcb_pattern(self, fcb: int) -> str:
+        # the 8 + 3 characters of the name as they are in the FCB (padded
+        # with spaces), with the attribute bits removed
+        return ''.join(chr(self.ram[fcb + i] & 0x7f) for i in range(1, 12))
+
+    def matching(self, pattern: str) -> List[str]:
+        # the files in the directory that fit 'pattern' (see fcb_pattern(),
+        # '?' is any character, also the padding), case insensitive
+        found = []
+
+        for filename in sorted(os.listdir(self.directory)):
+            name, dot, type_ = filename.upper().partition('.')
+
+            if len(name) > 8 or len(type_) > 3 or '.' in type_ or not os.path.isfile(os.path.join(self.directory, filename)):
+                continue
+
+            if all(p == '?' or p == c for p, c in zip(pattern, name.ljust(8) + type_.ljust(3))):
+                found.append(filename)
+
+        return found
+
+    def host_file(self, fcb: int) -> str:
+        ''' The path of the file in an FCB: an existing file with that name
+        in any case, else in lower case. '''
+        found = self.matching(self.fcb_pattern(fcb))
+
+        return os.path.join(self.directory, found[0] if found else self.fcb_name(fcb).lower())
+
+    def get_record(self, fcb: int) -> int:
+        ram = self.ram
+
+        return (((ram[fcb + 14] << 5) | (ram[fcb + 12] & 0x1f)) << 7) | (ram[fcb + 32] & 0x7f)
+
+    def set_record(self, fcb: int, record: int) -> None:
+        # the extent (EX, S2) and record in it (CR)
+        self.store(fcb + 32, [ record & 0x7f ])
+        self.store(fcb + 12, [ (record >> 7) & 0x1f ])
+        self.store(fcb + 14, [ (record >> 12) & 0xff ])
+
+    def get_random_record(self, fcb: int) -> int:
+        ram = self.ram
+
+        return ram[fcb + 33] | (ram[fcb + 34] << 8) | (ram[fcb + 35] << 16)
+
+    def set_random_record_to(self, fcb: int, record: int) -> None:
+        self.store(fcb + 33, [ record & 0xff, (record >> 8) & 0xff, (record >> 16) & 0xff ])
+
+    def records(self, path: str) -> int:
+        return (os.path.getsize(path) + record_size - 1) // record_size
+
+    def open_file(self, de: int) -> int:
+        path = self.host_file(de)
+
+        if not os.path.isfile(path):
+            return 0xff
+
+        # the number of records in the extent
+        self.store(de + 15, [ max(0, min(128, self.records(path) - ((self.ram[de + 12] & 0x1f) << 7))) ])
+
+        return 0
+
+    def close_file(self, de: int) -> int:
+        return 0 if os.path.isfile(self.host_file(de)) else 0xff
+
+    def make_file(self, de: int) -> int:
+        try:
+            open(self.host_file(de), 'wb').close()
+
+        except OSError:
+            return 0xff
+
+        self.store(de + 15, [ 0 ])
+
+        return 0
+
+    def delete_file(self, de: int) -> int:
+        found = self.matching(self.fcb_pattern(de))
+
+        for filename in found:
+            os.unlink(os.path.join(self.directory, filename))
+
+        return 0 if found else 0xff
+
+    def rename_file(self, de: int) -> int:
+        path = self.host_file(de)
+
+        if not os.path.isfile(path):
+            return 0xff
+
+        os.rename(path, self.host_file(de + 16))
+
+        return 0
+
+    def search_first(self, de: int) -> int:
+        self.found = self.matching(self.fcb_pattern(de))
+
+        return self.search_next(de)
+
+    def search_next(self, de: int) -> int:
+        if not self.found:
+            return 0xff
+
+        filename = self.found.pop(0)
+        name, dot, type_ = filename.upper().partition('.')
+        records = self.records(os.path.join(self.directory, filename))
+
+        # a directory entry at the start of the DMA buffer
+        self.store(self.dma, [ self.user ] + [ ord(c) & 0x7f for c in name.ljust(8) + type_.ljust(3) ] + [ 0, 0, 0, min(128, records) ] + [ 0 ] * 16)
+
+        return 0
+
+    def read(self, de: int, record: int) -> int:
+        path = self.host_file(de)
+
+        try:
+            with open(path, 'rb') as fh:
+                fh.seek(record * record_size)
+                data = fh.read(record_size)
+
+        except OSError:
+            return 0xff
+
+        if not data:
+            return 1  # end of file
+
+        self.store(self.dma, list(data.ljust(record_size, b'\x1a')))
+
+        return 0
+
+    def write(self, de: int, record: int) -> int:
+        path = self.host_file(de)
+
+        try:
+            with open(path, 'r+b' if os.path.isfile(path) else 'wb') as fh:
+                fh.seek(record * record_size)
+                fh.write(bytes(self.ram[self.dma:self.dma + record_size]))
+
+        except OSError:
+            return 0xff
+
+        return 0
+
+    def read_sequential(self, de: int) -> int:
+        record = self.get_record(de)
+        rc = self.read(de, record)
+
+        if rc == 0:
+            self.set_record(de, record + 1)
+
+        return rc
+
+    def write_sequential(self, de: int) -> int:
+        record = self.get_record(de)
+        rc = self.write(de, record)
+
+        if rc == 0:
+            self.set_record(de, record + 1)
+
+        return rc
+
+    def read_random(self, de: int) -> int:
+        record = self.get_random_record(de)
+        rc = self.read(de, record)
+
+        if rc == 0:
+            self.set_record(de, record)
+
+        return rc
+
+    def write_random(self, de: int) -> int:
+        record = self.get_random_record(de)
+        rc = self.write(de, record)
+
+        if rc == 0:
+            self.set_record(de, record)
+
+        return rc
+
+    def file_size(self, de: int) -> int:
+        path = self.host_file(de)
+
+        if not os.path.isfile(path):
+            return 0xff
+
+        self.set_random_record_to(de, self.records(path))
+
+        return 0
+
+    def set_random_record(self, de: int) -> None:
+        self.set_random_record_to(de, self.get_record(de))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] program.com [arguments]')
+    parser.add_option('-d', '--directory', dest='directory', default='.', help='where the files of the program are')
+    parser.add_option('-i', '--interpret', action='store_true', dest='interpret', help='do not compile the Z80 code into Python functions (slower)')
+    parser.add_option('-l', '--limit', type='int', dest='limit', default=None, help='stop after this many cycles (exit code 2)')
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    machine = cpm(options.directory, compiled=not options.interpret)
+    machine.load(args[0], args[1:])
+
+    sys.exit(0 if machine.run(options.limit) else 2)
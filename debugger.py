@@ -0,0 +1,370 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import sys
+from typing import Callable, Dict, List, Optional, Tuple
+from pchooks import compile_condition
+
+# what a watchpoint is on
+READ: int = 1
+WRITE: int = 2
+
+mode_names: dict = { READ: 'r', WRITE: 'w', READ | WRITE: 'rw' }
+
+class break_hit(Exception):
+    ''' Raised out of step() and run() when a breakpoint or watchpoint is
+    hit. cpu.pc is the instruction that is executed next: the one with the
+    breakpoint or the one after the access that was watched. '''
+
+class debugger:
+    ''' Breakpoints on the program counter, watchpoints on memory (an
+    address range, optionally only when a given slot/subslot/bank is
+    mapped there) and on I/O ports. Nothing is checked while there are
+    none of a kind: breakpoints wrap the handlers of the instructions at
+    their addresses (see z80.add_hook()), memory watchpoints put a function
+    that looks up the 256 byte page in a table in front of read_mem and/or
+    bus_write_mem (only for the kinds of access that are watched, see
+    z80.add_access_hook()) and I/O watchpoints do the same for the ports.
+    The CPU has one read_mem for all memory, so with a memory watchpoint
+    every access pays that lookup; LDIR and friends only lose their bulk
+    copy on the 16KB pages with a watchpoint.
+    Breakpoints can have a condition (see pchooks.compile_condition(),
+    'names' are the extra names that these can use). Not with compiled
+    blocks. '''
+
+    def __init__(self, cpu, names: Optional[Dict[str, Callable[[], int]]] = None) -> None:
+        self.cpu = cpu
+        self.names = names
+
+        # ('pc', address, condition, compiled condition), ('mem', start,
+        # end, mode, bank) and ('io', port, mode), in the order these were
+        # added
+        self.points: List[tuple] = []
+
+        # READ/WRITE per 256 bytes and per port, of all watchpoints
+        self.memory_pages = bytearray(256)
+        self.io_ports = bytearray(256)
+        # address: the compiled conditions of its breakpoints, None for
+        # none
+        self.breakpoints: dict = {}
+
+        self.hooked: bool = False
+        # the CPU functions that are watched, and the 16KB pages
+        self.watched: dict = {}
+        self.watched_pages: tuple = ()
+
+        # why it stopped
+        self.reason: Optional[str] = None
+        # a watchpoint was hit, it stops after the instruction
+        self.stopping: bool = False
+        # the program counter and cycle count of the last breakpoint that
+        # was hit: continuing executes that instruction
+        self.skip: Optional[Tuple[int, int]] = None
+
+    def add_breakpoint(self, pc: int, condition: Optional[str] = None) -> None:
+        ''' Raises ValueError when the condition is invalid. '''
+        compiled = None if condition is None else compile_condition(condition, self.cpu, self.names)
+
+        self.add(('pc', pc & 0xffff, condition, compiled))
+
+    def add_watchpoint(self, start: int, end: Optional[int] = None, mode: int = READ | WRITE, bank: Optional[tuple] = None) -> None:
+        ''' 'end' is inclusive. 'bank' is (the start of) the key of what is
+        mapped in the 16KB page (see z80.set_memory_layout()), e.g. (1, 0)
+        for slot 1, subslot 0 or ('ram', 4) for segment 4 of the memory
+        mapper. '''
+        self.add(('mem', start, start if end is None else end, mode, bank))
+
+    def add_io_watchpoint(self, port: int, mode: int = READ | WRITE) -> None:
+        self.add(('io', port & 0xff, mode))
+
+    def add(self, point: tuple) -> None:
+        self.points.append(point)
+
+        self.update()
+
+    def delete(self, n: int) -> None:
+        ''' Deletes the n-th (from 0) of list(). '''
+        del self.points[n]
+
+        self.update()
+
+    def clear(self) -> None:
+        self.points = []
+
+        self.update()
+
+    def list(self) -> List[str]:
+        out = []
+
+        for point in self.points:
+            if point[0] == 'pc':
+                out.append('breakpoint %04x%s' % (point[1], '' if point[2] is None else ' if %s' % point[2]))
+
+            elif point[0] == 'mem':
+                out.append('watchpoint %04x-%04x %s%s' % (point[1], point[2], mode_names[point[3]], '' if point[4] is None else ' %s' % (point[4],)))
+
+            else:
+                out.append('I/O watchpoint %02x %s' % (point[1], mode_names[point[2]]))
+
+        return out
+
+    def update(self) -> None:
+        cpu = self.cpu
+
+        breakpoints: dict = {}
+        memory_pages = bytearray(256)
+        io_ports = bytearray(256)
+
+        for point in self.points:
+            if point[0] == 'pc':
+                breakpoints.setdefault(point[1], []).append(point[3])
+
+            elif point[0] == 'mem':
+                for page in range(point[1] >> 8, (point[2] >> 8) + 1):
+                    memory_pages[page] |= point[3]
+
+            else:
+                io_ports[point[1]] |= point[2]
+
+        self.memory_pages[:] = memory_pages
+        self.io_ports[:] = io_ports
+
+        if breakpoints != self.breakpoints:
+            self.breakpoints = breakpoints
+
+            # the handlers with a breakpoint are wrapped when decoded
+            if self.hooked:
+                cpu.remove_hook(self)
+                self.hooked = False
+
+            if breakpoints:
+                cpu.add_hook(self)
+                self.hooked = True
+
+        modes = 0
+        for mode in memory_pages:
+            modes |= mode
+
+        io_modes = 0
+        for mode in io_ports:
+            io_modes |= mode
+
+        watched = {}
+
+        if modes & READ:
+            watched['read_mem'] = self.watched_read_mem
+
+        if modes & WRITE:
+            watched['bus_write_mem'] = self.watched_write_mem
+
+        if io_modes & READ:
+            watched['read_io'] = self.watched_read_io
+
+        if io_modes & WRITE:
+            watched['write_io'] = self.watched_write_io
+
+        # the 16KB pages with memory watchpoints
+        pages = tuple(page for page in range(0, 4) if any(memory_pages[page << 6:(page + 1) << 6]))
+
+        if watched.keys() != self.watched.keys() or pages != self.watched_pages:
+            if self.watched:
+                cpu.remove_access_hook(self)
+
+            if watched:
+                cpu.add_access_hook(self, watched, pages)
+
+            self.watched = watched
+            self.watched_pages = pages
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        conditions = self.breakpoints.get(pc)
+
+        if conditions is None:
+            return handler
+
+        after = (pc + length) & 0xffff
+
+        def breakpoint() -> int:
+            where = (pc, cpu.scheduler.now)
+
+            if self.skip == where:
+                self.skip = None
+
+                return handler()
+
+            # conditions see the registers before the instruction
+            cpu.pc = pc
+
+            if not any(condition is None or condition() for condition in conditions):
+                cpu.pc = after
+
+                return handler()
+
+            self.skip = where
+            self.reason = 'breakpoint at %04x' % pc
+
+            raise break_hit(self.reason)
+
+        return breakpoint
+
+    def hit(self, reason: str) -> None:
+        # in the middle of an instruction: stop when it is done
+        if not self.stopping:
+            self.stopping = True
+            self.reason = reason
+
+            self.cpu.scheduler.add(self.cpu.scheduler.now, self.stop)
+
+    def request_stop(self) -> None:
+        ''' Can be called from any thread. '''
+        self.cpu.scheduler.post(lambda when: self.hit('stopped'))
+
+    def stop(self, when: int) -> None:
+        self.stopping = False
+
+        raise break_hit(self.reason)
+
+    def peek(self, a: int) -> int:
+        ''' Reads memory without triggering watchpoints. '''
+        return self.cpu.fetch_mem(a)
+
+    def check_memory(self, a: int, mode: int, v: int) -> None:
+        bank = self.cpu.memory_layout[a >> 14]
+        key = bank if isinstance(bank, tuple) else (bank,)
+
+        for point in self.points:
+            if point[0] == 'mem' and point[3] & mode and point[1] <= a <= point[2] and (point[4] is None or key[0:len(point[4])] == point[4]):
+                self.hit('%s %02x at %04x (%s)' % ('read' if mode == READ else 'write', v, a, bank))
+                break
+
+    def watched_read_mem(self, a: int) -> int:
+        v = self.read_mem(a)
+
+        # (instructions are fetched with cpu.fetch_mem, which is not watched)
+        if self.memory_pages[a >> 8] & READ:
+            self.check_memory(a, READ, v)
+
+        return v
+
+    def watched_write_mem(self, a: int, v: int) -> None:
+        if self.memory_pages[a >> 8] & WRITE:
+            self.check_memory(a, WRITE, v)
+
+        self.bus_write_mem(a, v)
+
+    def watched_read_io(self, a: int) -> int:
+        v = self.read_io(a)
+
+        if self.io_ports[a & 0xff] & READ:
+            self.hit('I/O read %02x from port %02x' % (v, a & 0xff))
+
+        return v
+
+    def watched_write_io(self, a: int, v: int) -> None:
+        if self.io_ports[a & 0xff] & WRITE:
+            self.hit('I/O write %02x to port %02x' % (v, a & 0xff))
+
+        self.write_io(a, v)
+
+console_help: str = '''b addr [condition]          breakpoint, e.g. "b 4010 a == 3 and mem(hl) == 0"
+w addr[-end] [r|w|rw] [bank] watchpoint on memory, bank is e.g. 1.0 (slot 1, subslot 0) or ram.4
+io port [r|w|rw]            watchpoint on an I/O port
+l                           list the breakpoints and watchpoints
+d n                         delete the n-th of these
+s [n]                       execute n (1) instructions
+c                           continue
+r                           show the registers
+m addr [n]                  show n (64) bytes of memory
+q                           quit the emulator
+(addresses, ports and slots are hexadecimal)'''
+
+def parse_mode(text: str) -> int:
+    return { 'r': READ, 'w': WRITE, 'rw': READ | WRITE }[text]
+
+def parse_bank(text: str) -> tuple:
+    parts = text.split('.')
+
+    if parts[0] == 'ram':
+        return ('ram',) + tuple(int(p, 16) for p in parts[1:])
+
+    return tuple(int(p, 16) for p in parts)
+
+def console(dbg: debugger, fin=sys.stdin, fout=sys.stdout) -> bool:
+    ''' Reads commands until the emulator is to continue (returns True) or
+    to stop (False). '''
+    cpu = dbg.cpu
+
+    print(cpu.reg_str(), file=fout)
+
+    while True:
+        print('> ', end='', file=fout, flush=True)
+
+        line = fin.readline()
+
+        if line == '':
+            return False
+
+        parts = line.split()
+
+        if not parts:
+            continue
+
+        try:
+            cmd = parts[0]
+
+            if cmd == 'b':
+                condition = line.split(None, 2)[2:]
+
+                dbg.add_breakpoint(int(parts[1], 16), condition[0] if condition else None)
+
+            elif cmd == 'w':
+                addresses = parts[1].split('-')
+                start = int(addresses[0], 16)
+                end = int(addresses[1], 16) if len(addresses) > 1 else start
+
+                dbg.add_watchpoint(start, end, parse_mode(parts[2]) if len(parts) > 2 else READ | WRITE, parse_bank(parts[3]) if len(parts) > 3 else None)
+
+            elif cmd == 'io':
+                dbg.add_io_watchpoint(int(parts[1], 16), parse_mode(parts[2]) if len(parts) > 2 else READ | WRITE)
+
+            elif cmd == 'l':
+                for i, text in enumerate(dbg.list()):
+                    print('%d %s' % (i, text), file=fout)
+
+            elif cmd == 'd':
+                dbg.delete(int(parts[1]))
+
+            elif cmd == 's':
+                for i in range(int(parts[1]) if len(parts) > 1 else 1):
+                    try:
+                        cpu.step()
+
+                    except break_hit as e:
+                        print(e, file=fout)
+                        break
+
+                print(cpu.reg_str(), file=fout)
+
+            elif cmd == 'c':
+                return True
+
+            elif cmd == 'r':
+                print(cpu.reg_str(), file=fout)
+
+            elif cmd == 'm':
+                a = int(parts[1], 16)
+                n = int(parts[2]) if len(parts) > 2 else 64
+
+                for o in range(0, n, 16):
+                    values = [ dbg.peek((a + o + i) & 0xffff) for i in range(min(16, n - o)) ]
+
+                    print('%04x %s' % ((a + o) & 0xffff, ' '.join('%02x' % v for v in values)), file=fout)
+
+            elif cmd == 'q':
+                return False
+
+            else:
+                print(console_help, file=fout)
+
+        except (IndexError, KeyError, ValueError):
+            print(console_help, file=fout)
@@ -6,6 +6,10 @@ import sys
 from enum import Enum, IntFlag, IntEnum
 from typing import List
 
+# buffer position, buffer mode, need flush, tc, flags, step direction and
+# track; followed by the registers and the buffer
+disk_state = struct.Struct('<HBBBBhh')
+
 class disk:
     class T1(IntFlag):
         BUSY = 0x01
@@ -82,6 +86,19 @@ class disk:
     def get_name(self):
         return 'FDC'
 
+    def get_state(self) -> bytes:
+        return disk_state.pack(self.bufp, self.bmode.value, self.need_flush, self.tc, self.flags, self.step_dir, self.track) + bytes(self.regs) + bytes(self.buffer)
+
+    def set_state(self, data: bytes) -> None:
+        self.bufp, bmode, need_flush, self.tc, self.flags, self.step_dir, self.track = disk_state.unpack_from(data, 0)
+
+        self.bmode = disk.BufMode(bmode)
+        self.need_flush = need_flush == 1
+
+        o = disk_state.size
+        self.regs[:] = data[o:o + 16]
+        self.buffer[:] = data[o + 16:o + 16 + 512]
+
     def file_offset(self, side: int, track: int, sector: int) -> int:
         assert sector >= 1 and sector <= 9
         assert track >=0 and track < 80
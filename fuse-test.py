@@ -286,10 +286,7 @@ while True:
     ok = False
 
     try:
-        ccnt = 0
-
-        while ccnt < regs2[6]:
-            ccnt += cpu.step()
+        ccnt = cpu.run(regs2[6])
 
         ok = True
     except:
@@ -0,0 +1,444 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# random single instruction tests in the format of the jsmoo test set (see
+# json-test.py):
+#   fuzzer.py -n 1000000 -o tests.json       generate tests (with the
+#                                            results of z80.py)
+#   fuzzer.py tests.json jsmoo/v1/*.json     compare z80.py with recorded
+#                                            tests
+
+import json
+import os
+import random
+import sys
+from collections import deque
+from multiprocessing import Pool
+from optparse import OptionParser
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from z80 import z80
+from screen_kb_dummy import screen_kb_dummy
+
+# the values of a test that are the same in z80.py
+plain: Tuple[str, ...] = ('a', 'f', 'i', 'r', 'pc', 'sp', 'ix', 'iy', 'im', 'iff1', 'iff2')
+
+# the 8 bit registers of the pairs in z80.py
+pairs: Tuple[Tuple[str, str, str], ...] = (('bc', 'b', 'c'), ('de', 'd', 'e'), ('hl', 'h', 'l'))
+
+# what is compared; not R (not counted by z80.py) and WZ
+compared: Tuple[str, ...] = ('a', 'b', 'c', 'd', 'e', 'f', 'h', 'l', 'i', 'pc', 'sp', 'ix', 'iy', 'iff1', 'iff2', 'af_', 'bc_', 'de_', 'hl_')
+
+tables: Tuple[str, ...] = ('main', 'cb', 'ed', 'dd', 'fd', 'ddcb', 'fdcb')
+
+class memory(dict):
+    ''' Sparse 64KB (or I/O ports): what was not written reads as 0. '''
+
+    def __missing__(self, a: int) -> int:
+        return 0
+
+class tester:
+    ''' One z80 object that runs all tests (of a process) one by one, with
+    memory and I/O ports that only hold what a test put there. '''
+
+    def __init__(self, generated: bool = True) -> None:
+        self.memory = memory()
+        self.ports = memory()
+
+        self.cpu = z80(self.memory.__getitem__, self.memory.__setitem__, self.ports.__getitem__, self.ports.__setitem__, lambda x: None, screen_kb_dummy(None), generated)
+
+    def execute(self) -> int:
+        ''' Executes the instruction at PC like z80.step() does, but
+        without interrupts or scheduled events. Returns the number of
+        cycles. '''
+        cpu = self.cpu
+
+        handler, length = cpu.decode(cpu.pc)
+        cpu.pc = (cpu.pc + length) & 0xffff
+
+        return handler()
+
+def opcodes(cpu, table: str) -> List[List[int]]:
+    ''' The bytes up to and including the opcode of the instructions in a
+    table that z80.py has; not HALT (it runs up to the next event) and not
+    the prefixes. '''
+    prefixes = (0x76, 0xcb, 0xdd, 0xed, 0xfd)
+
+    if table == 'main':
+        return [ [ i ] for i in range(256) if i not in prefixes ]
+
+    if table == 'cb':
+        return [ [ 0xcb, i ] for i in range(256) ]
+
+    if table == 'ed':
+        return [ [ 0xed, i ] for i in range(256) if cpu.ed_jumps[i] is not None ]
+
+    prefix = 0xdd if table[0:2] == 'dd' else 0xfd
+
+    if table in ('dd', 'fd'):
+        return [ [ prefix, i ] for i in range(256) if i not in prefixes and cpu.ix_jumps[i] is not None ]
+
+    # displacement (filled in later) and opcode
+    return [ [ prefix, 0xcb, 0, i ] for i in range(256) if cpu.ix_bit_jumps[i] is not None ]
+
+def random_test(rnd: random.Random, choices: List[List[int]], n: int) -> dict:
+    instruction = list(rnd.choice(choices))
+
+    if len(instruction) == 4:  # DDCB/FDCB
+        instruction[2] = rnd.randrange(256)
+
+    # operands
+    instruction += [ rnd.randrange(256) for i in range(4 - len(instruction)) ]
+
+    initial = { name: rnd.randrange(256) for name in ('a', 'b', 'c', 'd', 'e', 'f', 'h', 'l', 'i', 'r') }
+    initial.update({ name: rnd.randrange(65536) for name in ('pc', 'sp', 'ix', 'iy', 'af_', 'bc_', 'de_', 'hl_', 'wz') })
+    initial['im'] = rnd.randrange(3)
+    initial['iff1'] = initial['iff2'] = rnd.randrange(2)
+
+    # what the instruction may read: (BC), (DE), (HL), the stack,
+    # (IX/IY+d) and (nn)
+    ram = {}
+
+    for high, low in (('b', 'c'), ('d', 'e'), ('h', 'l')):
+        ram[(initial[high] << 8) | initial[low]] = rnd.randrange(256)
+
+    for i in range(2):
+        ram[(initial['sp'] + i) & 0xffff] = rnd.randrange(256)
+
+    offset = instruction[2] - 256 if instruction[2] >= 128 else instruction[2]
+
+    for name in ('ix', 'iy'):
+        ram[(initial[name] + offset) & 0xffff] = rnd.randrange(256)
+
+    # a DD/FD prefix in front of a main table instruction is ignored
+    body = instruction[1:] if instruction[0] in (0xdd, 0xfd) else instruction
+
+    nn = None
+
+    if body[0] in (0x2a, 0x3a):  # LD HL/IX/IY/A,(nn)
+        nn = body[1] | (body[2] << 8)
+
+    elif instruction[0] == 0xed and instruction[1] & 0xcf == 0x4b:  # LD rr,(nn)
+        nn = instruction[2] | (instruction[3] << 8)
+
+    if nn is not None:
+        for i in range(2):
+            ram[(nn + i) & 0xffff] = rnd.randrange(256)
+
+    # z80.py does all of OTIR at once: B (0 is 256) bytes from (HL)
+    if instruction[0:2] == [ 0xed, 0xb3 ]:
+        hl = (initial['h'] << 8) | initial['l']
+
+        for i in range(initial['b'] or 256):
+            ram[(hl + i) & 0xffff] = rnd.randrange(256)
+
+    for i, v in enumerate(instruction):
+        ram[(initial['pc'] + i) & 0xffff] = v
+
+    initial['ram'] = sorted([ a, v ] for a, v in ram.items())
+
+    # what IN reads: port A * 256 + n for IN A,(n), else BC
+    ports = []
+
+    if body[0] == 0xdb:
+        ports.append([ (initial['a'] << 8) | body[1], rnd.randrange(256), 'r' ])
+
+    elif instruction[0] == 0xed and (instruction[1] & 0xc7 == 0x40 or instruction[1] in (0xa2, 0xaa, 0xb2, 0xba)):
+        ports.append([ (initial['b'] << 8) | initial['c'], rnd.randrange(256), 'r' ])
+
+    return { 'name': '%s %d' % (' '.join('%02x' % v for v in instruction), n), 'initial': initial, 'ports': ports }
+
+def set_initial(t: tester, initial: dict) -> None:
+    cpu = t.cpu
+
+    cpu.reset()
+    t.memory.clear()
+    t.ports.clear()
+
+    registers = { name: initial[name] for name in plain if name in initial }
+
+    for name, high, low in pairs:
+        if high in initial and low in initial:
+            registers[name] = (initial[high] << 8) | initial[low]
+
+    # AF' is split in z80.py
+    if 'af_' in initial:
+        registers['a_'] = initial['af_'] >> 8
+        registers['f_'] = initial['af_'] & 0xff
+
+    for name in ('bc_', 'de_', 'hl_'):
+        if name in initial:
+            registers[name] = initial[name]
+
+    if 'wz' in initial:
+        registers['memptr'] = initial['wz']
+
+    for name, v in registers.items():
+        setattr(cpu, name, v)
+
+    t.memory.update({ a: v for a, v in initial.get('ram', []) })
+
+def set_ports(t: tester, ports: list) -> None:
+    # what IN reads (z80.py uses the lower 8 bits of the port)
+    t.ports.update({ port & 0xff: v for port, v, mode in ports if mode == 'r' })
+
+def get_final(t: tester, initial: dict) -> dict:
+    cpu = t.cpu
+
+    # not R: z80.py does not count it
+    final = { name: getattr(cpu, name) for name in plain if name != 'r' }
+
+    for name, high, low in pairs:
+        final[high] = getattr(cpu, name) >> 8
+        final[low] = getattr(cpu, name) & 0xff
+
+    final['af_'] = (cpu.a_ << 8) | cpu.f_
+
+    for name in ('bc_', 'de_', 'hl_'):
+        final[name] = getattr(cpu, name)
+
+    final['wz'] = cpu.memptr
+
+    # the addresses of the initial state and those that were written
+    mem = t.memory
+    addresses = set(a for a, v in initial.get('ram', [])) | set(mem.keys())
+
+    final['ram'] = [ [ a, mem[a] ] for a in sorted(addresses) ]
+
+    return final
+
+def known(t: tester) -> bool:
+    ''' Does z80.py have the instruction at PC? Not HALT: it runs up to the
+    next event. '''
+    cpu = t.cpu
+    mem = t.memory
+    pc = cpu.pc
+
+    if mem[pc] == 0x76 or (mem[pc] in (0xdd, 0xfd) and mem[(pc + 1) & 0xffff] == 0x76):
+        return False
+
+    try:
+        handler = cpu.decode(pc)[0]
+
+    except TypeError:  # no handler for a CB or DDCB/FDCB opcode
+        return False
+
+    # a prefix that is ignored wraps the instruction after it
+    while getattr(handler, 'func', None) == cpu._main_mirror:
+        handler = handler.args[0]
+
+    return getattr(handler, 'func', None) != cpu.invalid
+
+def run_tests(t: tester, tests: List[dict]) -> List[Optional[Tuple[dict, int]]]:
+    ''' Executes the instruction of each test, returns the final state and
+    the number of cycles per test; None for tests of instructions that
+    z80.py does not have (e.g. recorded ones). '''
+    results: List[Optional[Tuple[dict, int]]] = []
+
+    for test in tests:
+        set_initial(t, test['initial'])
+        set_ports(t, test.get('ports', []))
+
+        if not known(t):
+            results.append(None)
+            continue
+
+        cycles = t.execute()
+
+        results.append((get_final(t, test['initial']), cycles))
+
+    return results
+
+def compare(test: dict, final: dict, cycles: int) -> List[Tuple[str, object, object]]:
+    ''' The differences with the final state of a recorded test as (item,
+    is, should be). '''
+    differences = []
+    should_be = test['final']
+
+    for name in compared:
+        if name in should_be and final[name] != should_be[name]:
+            differences.append((name, final[name], should_be[name]))
+
+    is_ram = dict((a, v) for a, v in final['ram'])
+
+    for a, v in should_be.get('ram', []):
+        if is_ram.get(a, 0) != v:
+            differences.append(('ram %04x' % a, is_ram.get(a, 0), v))
+
+    # one entry per cycle
+    if 'cycles' in test and len(test['cycles']) != cycles:
+        differences.append(('cycles', cycles, len(test['cycles'])))
+
+    return differences
+
+# one per process of the pool
+worker: Optional[tester] = None
+
+def get_tester() -> tester:
+    global worker
+
+    if worker is None:
+        worker = tester()
+
+    return worker
+
+def generate(job: Tuple[int, int, int, Tuple[str, ...]]) -> List[str]:
+    ''' Tests first..first + n - 1 (as JSON) of the given tables; these
+    only depend on the seed and the batch size, not on the process that
+    makes them. '''
+    seed, first, n, use_tables = job
+
+    t = get_tester()
+    choices = [ instruction for table in use_tables for instruction in opcodes(t.cpu, table) ]
+
+    rnd = random.Random('%d %d' % (seed, first))
+    tests = [ random_test(rnd, choices, first + i) for i in range(n) ]
+
+    out = []
+
+    for test, (final, cycles) in zip(tests, run_tests(t, tests)):
+        test['final'] = final
+        # z80.py only knows the number of cycles, not what is on the bus
+        test['cycles'] = [ [ None, None, '----' ] for i in range(cycles) ]
+
+        out.append(json.dumps(test))
+
+    return out
+
+def check(job: Tuple[str, List[dict]]) -> Tuple[int, int, List[str]]:
+    ''' Compares recorded tests (of a file), returns how many were run and
+    skipped and the failures. '''
+    filename, tests = job
+
+    t = get_tester()
+    skipped = 0
+    failures = []
+
+    for test, result in zip(tests, run_tests(t, tests)):
+        if result is None:
+            skipped += 1
+            continue
+
+        for item, is_, should_be in compare(test, *result):
+            failures.append(f'{test["name"]}, Item {item} failed, is {is_}, should be {should_be} ({filename})')
+
+    return (len(tests) - skipped, skipped, failures)
+
+def read_tests(filename: str) -> Iterator[dict]:
+    ''' The tests in a file; those written by write_tests() are read one at
+    a time. '''
+    with open(filename, 'r') as fh:
+        first = fh.readline()
+
+        if first.strip() != '[':  # e.g. jsmoo: all on one line
+            fh.seek(0)
+
+            yield from (test for test in json.load(fh) if 'name' in test)
+
+            return
+
+        for line in fh:
+            line = line.strip().rstrip(',')
+
+            if line and line != ']':
+                yield json.loads(line)
+
+def batches(tests: Iterable[dict], n: int) -> Iterator[List[dict]]:
+    batch = []
+
+    for test in tests:
+        batch.append(test)
+
+        if len(batch) == n:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def bounded_imap(pool: Pool, function: Callable, jobs: Iterable, ahead: int) -> Iterator:
+    ''' pool.imap() that takes at most 'ahead' jobs at a time, so that
+    these (and the results) do not all end up in memory. '''
+    pending: deque = deque()
+
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def write_tests(out, results: Iterator[List[str]]) -> int:
+    ''' Writes the tests as a JSON array while these come in. '''
+    n = 0
+
+    out.write('[')
+
+    for tests in results:
+        for test in tests:
+            out.write(',\n' if n else '\n')
+            out.write(test)
+
+            n += 1
+
+    out.write('\n]\n')
+
+    return n
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [recorded.json ...]')
+    parser.add_option('-o', '--output', dest='output', default=None, help='file to write generated tests to ("-" for stdout)')
+    parser.add_option('-n', '--count', type='int', dest='count', default=10000, help='number of tests to generate')
+    parser.add_option('-s', '--seed', type='int', dest='seed', default=1, help='seed of the random generator')
+    parser.add_option('-t', '--tables', dest='tables', default='main,cb', help='instruction tables to generate tests for (%s)' % ','.join(tables))
+    parser.add_option('-j', '--processes', type='int', dest='processes', default=None, help='number of processes (default: one per CPU)')
+    parser.add_option('-b', '--batch', type='int', dest='batch', default=2000, help='tests per batch of a process')
+    (options, args) = parser.parse_args()
+
+    if options.output is None and not args:
+        parser.print_help()
+        sys.exit(1)
+
+    with Pool(options.processes) as pool:
+        # batches in progress or done but not yet written
+        ahead = 2 * (options.processes or os.cpu_count() or 1)
+
+        if options.output is not None:
+            use_tables = tuple(options.tables.split(','))
+
+            if any(table not in tables for table in use_tables):
+                print('Tables are %s' % ', '.join(tables), file=sys.stderr)
+                sys.exit(1)
+
+            jobs = ((options.seed, first, min(options.batch, options.count - first), use_tables) for first in range(0, options.count, options.batch))
+
+            out = sys.stdout if options.output == '-' else open(options.output, 'w')
+
+            n = write_tests(out, bounded_imap(pool, generate, jobs, ahead))
+
+            if out is not sys.stdout:
+                out.close()
+
+            print('%d tests written' % n, file=sys.stderr)
+
+        else:
+            jobs = ((filename, batch) for filename in args for batch in batches(read_tests(filename), options.batch))
+
+            n = 0
+            not_run = 0
+            failed = 0
+
+            for done, skipped, failures in bounded_imap(pool, check, jobs, ahead):
+                n += done
+                not_run += skipped
+                failed += len(failures)
+
+                for failure in failures:
+                    print(failure)
+
+            print('%d tests, %d failures, %d skipped (HALT or not in z80.py)' % (n, failed, not_run), file=sys.stderr)
+
+            sys.exit(1 if failed else 0)
@@ -0,0 +1,60 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import sys
+from typing import Callable, List
+
+class history:
+    ''' The last 'size' instructions executed by step() and run(): program
+    counter, instruction bytes and what was mapped at the program counter
+    (the memory layout key), with the registers before the instruction.
+    See z80.set_history(). '''
+
+    def __init__(self, size: int = 1024) -> None:
+        self.size: int = size
+        self.pos: int = 0
+
+        # preallocated; per instruction a tuple of the (pc, bytes, bank)
+        # tuple of the decoded instruction and A, F, BC, DE, HL, IX, IY
+        # and SP. This costs (in CPython) a third of what storing these in
+        # arrays does.
+        self.ring: list = [ None ] * size
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        info = (pc, bytes([ cpu.fetch_mem((pc + i) & 0xffff) for i in range(min(length, 4)) ]), cpu.memory_layout[pc >> 14])
+
+        ring = self.ring
+        size = self.size
+
+        def recorded() -> int:
+            i = self.pos
+            ring[i] = (info, cpu.a, cpu.f, cpu.bc, cpu.de, cpu.hl, cpu.ix, cpu.iy, cpu.sp)
+
+            i += 1
+            self.pos = 0 if i == size else i
+
+            return handler()
+
+        return recorded
+
+    def entries(self) -> List[str]:
+        ''' Oldest first, one line per instruction. '''
+        out = []
+
+        for k in range(self.size):
+            entry = self.ring[(self.pos + k) % self.size]
+
+            if entry is None:
+                continue
+
+            (pc, code, bank), a, f, bc, de, hl, ix, iy, sp = entry
+
+            out.append('%04x %-11s AF %02x%02x BC %04x DE %04x HL %04x IX %04x IY %04x SP %04x  %s' % (pc, code.hex(' '), a, f, bc, de, hl, ix, iy, sp, bank))
+
+        return out
+
+    def dump(self, fh=sys.stderr) -> None:
+        print('Last executed instructions:', file=fh)
+
+        for line in self.entries():
+            print(line, file=fh)
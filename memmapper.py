@@ -2,7 +2,7 @@
 # released under AGPL v3.0
 
 import sys
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 class memmap:
     def __init__(self, n_pages:int, debug):
@@ -13,7 +13,10 @@ class memmap:
 
         self.mapper: List[int] = [ 3, 2, 1, 0 ]
 
-        self.ram = [ [ 0 for k in range(16384)] for j in range(self.n_pages)]
+        # bytearrays: these can be saved and restored in one go
+        self.ram = [ bytearray(16384) for j in range(self.n_pages) ]
+        # per page: written since the last get_state_pages()
+        self.dirty = bytearray(b'\1' * self.n_pages)
 
     def get_ios(self):
         return [ [ 0xfc, 0xfd, 0xfe, 0xff ], [ 0xfc, 0xfd, 0xfe, 0xff ] ]
@@ -34,6 +37,7 @@ class memmap:
         page, offset = self.split_addr(a)
 
         self.ram[page][offset] = v
+        self.dirty[page] = 1
 
     def read_mem(self, a: int) -> int:
         page, offset = self.split_addr(a)
@@ -49,3 +53,29 @@ class memmap:
         self.debug('memmap read %02x' % a)
 
         return self.mapper[a - 0xfc]
+
+    def get_state(self) -> bytes:
+        # the mapper registers followed by the pages
+        return bytes(self.mapper) + b''.join(self.ram)
+
+    def set_state(self, data: bytes) -> None:
+        if len(data) != 4 + self.n_pages * 16384:
+            raise ValueError('saved state has a different amount of RAM')
+
+        self.mapper[:] = data[0:4]
+
+        # in place, these lists are also accessed directly by the CPU
+        for i, page in enumerate(self.ram):
+            o = 4 + i * 16384
+            page[:] = data[o:o + 16384]
+
+        self.dirty[:] = b'\1' * self.n_pages
+
+    def get_state_pages(self) -> Tuple[bytes, List[Optional[bytes]]]:
+        # get_state() split in the mapper registers and the pages; pages
+        # that were not written since the previous call are None
+        pages = [ bytes(page) if self.dirty[i] else None for i, page in enumerate(self.ram) ]
+
+        self.dirty[:] = bytes(self.n_pages)
+
+        return bytes(self.mapper), pages
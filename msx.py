@@ -3,6 +3,8 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import os
+import signal
 import sys
 import threading
 import time
@@ -22,10 +24,22 @@ from sunriseide import sunriseide
 from cas import load_cas_file
 from ascii16kb import ascii16kb
 from msxdos2 import msxdos2
+from tracer import tracer, DEBUG
+from profiler import profiler
+from history import history
+from bintrace import bintrace
+from codecoverage import codecoverage
+import savestate
+from quickboot import quickboot, config_key
+from rewind import rewind
+from throttle import throttle
+from pchooks import pc_hooks
+from biosvram import bios_vram
+from debugger import debugger, break_hit, console, parse_bank, parse_mode, READ, WRITE
 
 abort_time = None # 60
 
-debug_log = None
+tr = tracer()
 
 io_values: List[int] = [ 0 ] * 256
 io_read: List[Callable[[int], int]] = [ None ] * 256
@@ -35,13 +49,9 @@ subslot: List[int] = [ 0x00, 0x00, 0x00, 0x00 ]
 has_subslots: List[bool] = [ False, False, False, False ]
 
 def debug(x):
-    #dk.debug('%s' % x)
-
-    if debug_log:
-        fh = open(debug_log, 'a+')
-        fh.write('%s\t%02x %02x\n' % (x, read_page_layout(0), read_mem(0xffff) ^ 0xff))
-        # fh.write('%s\n' % x)
-        fh.close()
+    # messages of the CPU, with the slot layout
+    if tr.enabled('cpu'):
+        tr.log('cpu', DEBUG, '%s\t%02x %02x', x, read_page_layout(0), read_mem(0xffff) ^ 0xff)
 
 slots = [[[None for k in range(4)] for j in range(4)] for i in range(4)]
 
@@ -53,7 +63,7 @@ def put_page(slot: int, subslot: int, page: int, obj):
 def get_page(slot: int, subslot: int, page: int):
     return slots[slot][subslot][page]
 
-mm = memmap(256, debug)
+mm = memmap(256, tr.logger('mem'))
 for p in range(0, 4):
     put_page(3, 2, p, mm)
 
@@ -62,6 +72,7 @@ bb_file = None
 parser = OptionParser()
 parser.add_option('-b', '--biosbasic', dest='bb_file', help='select BIOS/BASIC ROM')
 parser.add_option('-l', '--debug-log', dest='debug_log', help='logfile to write to (optional)')
+parser.add_option('-L', '--trace', dest='trace_levels', default='debug', help='what to log: a level (off, error, info or debug) and/or category:level pairs, comma separated (categories: cpu, slot, mem, rom, sound, scc, disk, ide, rtc, midi)')
 parser.add_option('-R', '--rom', action='append', dest='rom', help='select a simple ROM to use, format: slot:subslot:rom-filename')
 parser.add_option('-S', '--scc-rom', action='append', dest='scc_rom', help='select an SCC ROM to use, format: slot:subslot:rom-filename')
 parser.add_option('-D', '--disk-rom', action='append', dest='disk_rom', help='select a disk ROM to use, format: slot:subslot:rom-filename:disk-image.dsk')
@@ -70,36 +81,90 @@ parser.add_option('-C', '--cas-file', dest='cas_file', help='select a .cas file
 parser.add_option('-A', '--ascii-16kb', action='append', dest='a16_rom', help='select an ASCII-16kB ROM to use, format: slot:subslot:rom-filename')
 parser.add_option('-M', '--msx-dos2', action='append', dest='msxdos2_rom', help='select an MSX-DOS2 ROM to use, format: slot:subslot:rom-filename')
 parser.add_option('-T', '--time', action='store_true', dest='time', help='enable RTC')
+parser.add_option('-c', '--compile-blocks', action='store_true', dest='compile_blocks', help='translate Z80 code into Python functions (faster)')
+parser.add_option('-P', '--profile', dest='profile', help='count the executed instructions per opcode, address and bank and write these to a .json or .csv file when done (not with -c)')
+parser.add_option('-B', '--binary-trace', dest='binary_trace', help='write the executed instructions with the registers and memory/I/O accesses to a binary file (see tracediff.py, not with -c)')
+parser.add_option('-V', '--coverage', dest='coverage', help='record which bytes were executed, read and written per slot/subslot/bank and write that to a file when done; an existing file is added to (not with -c)')
+parser.add_option('--coverage-listing', dest='coverage_listing', help='write a listing of the executed code and the used data (see -V) to a file when done')
+parser.add_option('--save-state', dest='save_state', help='save the state of the machine to a file when done and when getting a SIGUSR2')
+parser.add_option('--load-state', dest='load_state', help='start from a state saved with --save-state (with the same ROMs and options)')
+parser.add_option('-Q', '--quick-boot', action='store_true', dest='quick_boot', help='after booting once, start from where the BASIC prompt or the disk boot was reached (cached per ROMs, disk images and slots in ~/.cache/pymsx)')
+parser.add_option('--rewind', dest='rewind', type='int', help='keep the state of the machine in memory every N frames, a SIGHUP goes back to the newest of these (repeat to go back further)')
+parser.add_option('--rewind-size', dest='rewind_size', type='int', default=300, help='how many states --rewind keeps (300 by default)')
+parser.add_option('-H', '--history', dest='history', type='int', default=0, help='remember the last N instructions, these are printed when the emulator crashes or gets a SIGUSR1 (costs about a third of the speed, not recorded with -c)')
+parser.add_option('-t', '--speed', dest='speed', default='real', help='real (as fast as a real MSX, the default), turbo (as fast as possible) or how many times faster than a real MSX to run (e.g. 2 or 0.5)')
+parser.add_option('--hz', dest='hz', type='int', default=50, help='refresh rate of the VDP: 50 (the default) or 60')
+parser.add_option('--break', action='append', dest='breakpoints', help='stop in the debugger console when the program counter gets here, format: address [condition] (hexadecimal address, the condition is a Python expression with the registers, mem(address) and slots (the primary slot register), e.g. "4010 a == 3 and slots == 0xf0"; not with -c)')
+parser.add_option('--watch', action='append', dest='watchpoints', help='stop in the debugger console when memory is accessed, format: address[-end][:r|w|rw[:bank]] (hexadecimal, the bank is e.g. 1.0 for slot 1, subslot 0 or ram.4); every memory access is checked while there are watchpoints, which slows down the emulation')
+parser.add_option('--watch-io', action='append', dest='io_watchpoints', help='stop in the debugger console when an I/O port is accessed, format: port[:r|w|rw] (hexadecimal)')
+parser.add_option('--console', action='store_true', dest='console', help='start in the debugger console; a SIGQUIT (ctrl+\\) stops in it as well')
+parser.add_option('--bios-vram', action='store_true', dest='bios_vram', help='move VRAM in LDIRVM, LDIRMV and FILVRM of the (MSX 1) BIOS in slot 0 in bulk instead of per byte (not with -c)')
+parser.add_option('-N', '--no-idle-skip', action='store_true', dest='no_idle_skip', help='do not skip loops that wait for an interrupt or the VDP status')
 (options, args) = parser.parse_args()
 
-debug_log = options.debug_log
+if options.debug_log:
+    try:
+        tr.open(options.debug_log, options.trace_levels)
+
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
 if not options.bb_file:
     print('No BIOS/BASIC ROM selected (e.g. msxbiosbasic.rom)')
     sys.exit(1)
 
+if options.hz not in (50, 60):
+    print('The refresh rate must be 50 or 60 Hz')
+    sys.exit(1)
+
+if options.speed == 'turbo':
+    speed = None
+
+elif options.speed == 'real':
+    speed = 1.0
+
+else:
+    try:
+        speed = float(options.speed)
+
+    except ValueError:
+        speed = 0.0
+
+    if speed <= 0.0:
+        print('The speed must be real, turbo or a positive number')
+        sys.exit(1)
+
+if options.compile_blocks and (options.profile or options.binary_trace or options.coverage or options.coverage_listing):
+    print('-P, -B and -V cannot be combined with -c')
+    sys.exit(1)
+
 # bb == bios/basic
-bb = rom(options.bb_file, debug, 0x0000)
+bb = rom(options.bb_file, tr.logger('rom'), 0x0000)
 put_page(0, 0, 0, bb)
 put_page(0, 0, 1, bb)
 
-snd = sound(debug)
+snd = sound(tr.logger('sound'))
+
+# devices that switch ROM banks when written to
+bank_switchers = []
 
 if options.scc_rom:
     for o in options.scc_rom:
         parts = o.split(':')
-        scc_obj = scc(parts[2], snd, debug)
+        scc_obj = scc(parts[2], snd, tr.logger('scc'))
         scc_slot = int(parts[0])
         scc_subslot = int(parts[1])
         put_page(scc_slot, scc_subslot, 1, scc_obj)
         put_page(scc_slot, scc_subslot, 2, scc_obj)
+        bank_switchers.append(scc_obj)
 
 if options.disk_rom:
     for o in options.disk_rom:
         parts = o.split(':')
         disk_slot = int(parts[0])
         disk_subslot = int(parts[1])
-        disk_obj = disk(parts[2], debug, parts[3])
+        disk_obj = disk(parts[2], tr.logger('disk'), parts[3])
         put_page(disk_slot, disk_subslot, 1, disk_obj)
 
 if options.rom:
@@ -110,7 +175,7 @@ if options.rom:
         offset = 0x4000
         if len(parts) == 4:
             offset = int(parts[3], 16)
-        rom_obj = gen_rom(parts[2], debug, offset=offset)
+        rom_obj = gen_rom(parts[2], tr.logger('rom'), offset=offset)
         page_offset = offset // 0x4000
         for p in range(page_offset, page_offset + rom_obj.get_n_pages()):
             put_page(rom_slot, rom_subslot, p, rom_obj)
@@ -120,31 +185,34 @@ if options.ide_rom:
         parts = o.split(':')
         ide_slot = int(parts[0])
         ide_subslot = int(parts[1])
-        ide_obj = sunriseide(parts[2], debug, parts[3])
+        ide_obj = sunriseide(parts[2], tr.logger('ide'), parts[3])
         put_page(ide_slot, ide_subslot, 1, ide_obj)
+        bank_switchers.append(ide_obj)
 
 if options.a16_rom:
     for o in options.a16_rom:
         parts = o.split(':')
-        a16_obj = ascii16kb(parts[2], debug)
+        a16_obj = ascii16kb(parts[2], tr.logger('rom'))
         a16_slot = int(parts[0])
         a16_subslot = int(parts[1])
         put_page(a16_slot, a16_subslot, 1, a16_obj)
         put_page(a16_slot, a16_subslot, 2, a16_obj)
+        bank_switchers.append(a16_obj)
 
 if options.msxdos2_rom:
     for o in options.msxdos2_rom:
         parts = o.split(':')
-        md2_obj = msxdos2(parts[2], debug)
+        md2_obj = msxdos2(parts[2], tr.logger('rom'))
         md2_slot = int(parts[0])
         md2_subslot = int(parts[1])
         put_page(md2_slot, md2_subslot, 1, md2_obj)
+        bank_switchers.append(md2_obj)
 
 slot_for_page: List[int] = [ 0, 0, 0, 0 ]
 
 clockchip = None
 if options.time:
-    clockchip = RP_5C01(debug)
+    clockchip = RP_5C01(tr.logger('rtc'))
 
 def get_subslot_for_page(slot: int, page: int):
     if has_subslots[slot]:
@@ -178,18 +246,61 @@ def write_mem(a: int, v: int) -> None:
 
     if a == 0xffff:
         if has_subslots[slot_for_page[3]]:
-            debug('Setting sub-page layout to %02x' % v)
+            tr.log('slot', DEBUG, 'Setting sub-page layout to %02x', v)
             subslot[slot_for_page[3]] = v
+            update_memory_layout()
             return
 
     page = a >> 14
 
     slot = get_page(slot_for_page[page], get_subslot_for_page(slot_for_page[page], page), page)
     if slot == None:
-        debug('Writing %02x to %04x which is not backed by anything (slot: %02x, subslot: %02x)' % (v, a, read_page_layout(0), subslot[slot_for_page[3]]))
+        tr.log('slot', DEBUG, 'Writing %02x to %04x which is not backed by anything (slot: %02x, subslot: %02x)', v, a, read_page_layout(0), subslot[slot_for_page[3]])
         return
     
-    slot.write_mem(a, v)
+    if slot in bank_switchers:
+        banks = slot.get_banks()
+        slot.write_mem(a, v)
+
+        if slot.get_banks() != banks:
+            update_memory_layout()
+
+    else:
+        slot.write_mem(a, v)
+
+def update_memory_layout() -> None:
+    # tell the cpu what is visible in each page; a RAM segment is the same
+    # wherever it is mapped
+    layout = []
+    # plain memory the cpu may access directly for LDIR and friends
+    direct = []
+
+    for page in range(0, 4):
+        slot = slot_for_page[page]
+        sub = get_subslot_for_page(slot, page)
+        obj = get_page(slot, sub, page)
+
+        if obj is mm:
+            layout.append(('ram', mm.mapper[page]))
+            direct.append((mm.ram[mm.mapper[page]], 0, True, (mm.dirty, mm.mapper[page])))
+
+        elif obj in bank_switchers:
+            layout.append((slot, sub, page, obj.get_banks()))
+            direct.append(None)
+
+        else:
+            layout.append((slot, sub, page))
+
+            if isinstance(obj, rom):
+                direct.append((obj.rom, page * 0x4000 - obj.base_address, False))
+
+            elif isinstance(obj, gen_rom):
+                direct.append((obj.rom, page * 0x4000 - obj.offset, False))
+
+            else:
+                direct.append(None)
+
+    cpu.set_memory_layout(tuple(layout), direct)
 
 def read_page_layout(a: int) -> int:
     return (slot_for_page[3] << 6) | (slot_for_page[2] << 4) | (slot_for_page[1] << 2) | slot_for_page[0]
@@ -198,6 +309,13 @@ def write_page_layout(a: int, v: int) -> None:
     for i in range(0, 4):
         slot_for_page[i] = (v >> (i * 2)) & 3
 
+    update_memory_layout()
+
+def write_mapper(a: int, v: int) -> None:
+    mm.write_io(a, v)
+
+    update_memory_layout()
+
 def printer_out(a: int, v: int) -> None:
     # FIXME handle strobe
     print('PRINTER: %c' % v)
@@ -218,7 +336,7 @@ def invoke_load_cas(a: int) -> int:
     if options.cas_file:
         global cpu
 
-        cpu.pc = load_cas_file(write_mem, options.cas_file)
+        cpu.pc = load_cas_file(cpu.write_mem, options.cas_file)
 
     return 123
 
@@ -266,6 +384,9 @@ def init_io():
 
     add_dev(mm)
 
+    for r in mm.get_ios()[1]:
+        io_write[r] = write_mapper
+
     print('set "mmu"')
     io_read[0xa8] = read_page_layout
     io_write[0xa8] = write_page_layout
@@ -293,23 +414,298 @@ def write_io(a: int, v: int) -> None:
     else:
         print('Unmapped I/O write %02x: %02x' % (a, v))
 
+def get_machine_state() -> bytes:
+    # the slots and subslots selected and the last values written to the
+    # I/O ports
+    return bytes(slot_for_page) + bytes(subslot) + bytes(io_values)
+
+def set_machine_state(data: bytes) -> None:
+    slot_for_page[:] = data[0:4]
+    subslot[:] = data[4:8]
+    io_values[:] = data[8:8 + 256]
+
+def state_devices() -> list:
+    # the (name, get_state, set_state) of everything with a state, see
+    # savestate.py; devices in slots are named after where they are
+    devices = [ ('cpu', cpu.get_state, cpu.set_state), ('machine', get_machine_state, set_machine_state), ('vdp', dk.get_state, dk.set_state), ('psg', snd.get_state, snd.set_state) ]
+
+    if clockchip:
+        devices.append(('rtc', clockchip.get_state, clockchip.set_state))
+
+    seen = set()
+
+    for slot in range(0, 4):
+        for sub in range(0, 4):
+            for page in range(0, 4):
+                obj = get_page(slot, sub, page)
+
+                if obj is None or id(obj) in seen or not hasattr(obj, 'get_state'):
+                    continue
+
+                seen.add(id(obj))
+                devices.append(('slot %d.%d.%d' % (slot, sub, page), obj.get_state, obj.set_state))
+
+    return devices
+
+def save_state(filename: str) -> None:
+    savestate.save(filename, state_devices())
+
+def restore_state(data: bytes) -> None:
+    savestate.restore(data, state_devices())
+
+    update_memory_layout()
+
+def load_state(filename: str) -> None:
+    with open(filename, 'rb') as fh:
+        restore_state(fh.read())
+
+def paged_devices() -> dict:
+    # the get_state_pages() of the devices of state_devices() that have
+    # their memory in pages, for the rewind buffer
+    paged = {}
+
+    for name, get_state, set_state in state_devices():
+        obj = getattr(get_state, '__self__', None)
+
+        if hasattr(obj, 'get_state_pages'):
+            paged[name] = obj.get_state_pages
+
+    return paged
+
+def rewind_state() -> None:
+    if rewinder.back(state_devices()):
+        update_memory_layout()
+
+        print('Went back to a state that was taken %d frames ago, %d older states remain' % (options.rewind, len(rewinder)))
+
+    else:
+        print('No states to go back to')
+
+def machine_config() -> str:
+    # the key of the quick boot cache: the options that change what is in
+    # the slots and the contents of the files these use
+    settings = [ 'state version %d' % savestate.VERSION, 'RTC %s' % options.time ]
+    files = [ options.bb_file ]
+
+    for flag, values in (('-R', options.rom), ('-S', options.scc_rom), ('-D', options.disk_rom), ('-I', options.ide_rom), ('-A', options.a16_rom), ('-M', options.msxdos2_rom)):
+        for value in values or []:
+            parts = value.split(':')
+
+            if flag in ('-D', '-I'):  # with a disk image
+                settings.append('%s %s:%s' % (flag, parts[0], parts[1]))
+                files += parts[2:4]
+
+            else:  # -R can have an offset
+                settings.append('%s %s' % (flag, ':'.join(parts[0:2] + parts[3:])))
+                files.append(parts[2])
+
+    return config_key(settings, files)
+
+def finish_quick_boot() -> None:
+    global boot_cache
+
+    cpu.remove_hook(boot_cache)
+    boot_cache.store(savestate.dump(state_devices()))
+    boot_cache = None
+
 stop_flag = False
+save_flag = False
+rewind_flag = False
 
 def cpu_thread():
+    global save_flag, rewind_flag, stop_flag
+
     #t = time.time()
     #while time.time() - t < 5:
-    while not stop_flag:
-        cpu.step()
+    # breakpoints and hooks only work when interpreting
+    run = cpu.run_block if options.compile_blocks and not dbg and not hooks else cpu.run
+    frames = 0
+
+    try:
+        if options.console and not console(dbg):
+            stop_flag = True
+
+        while not stop_flag:
+            try:
+                if boot_cache:
+                    # the hook only works when interpreting
+                    cpu.run(cpu.frame_cycles)
+
+                    if boot_cache.reached:
+                        finish_quick_boot()
 
-dk = screen_kb(io_values)
+                else:
+                    run(cpu.frame_cycles)
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk)
+            except break_hit as e:
+                print(e)
 
-musicmodule = NMS_1205(cpu, debug)
+                if not console(dbg):
+                    stop_flag = True
+
+                continue
+
+            pacer.pace(cpu.scheduler.now)
+
+            status = pacer.report(cpu.scheduler.now)
+            if status:
+                print('\r%s ' % status, end='', file=sys.stderr)
+
+            if save_flag:
+                save_flag = False
+                save_state(options.save_state)
+
+            if rewinder:
+                frames += 1
+
+                if rewind_flag:
+                    rewind_flag = False
+                    rewind_state()
+                    frames = 0
+
+                elif frames >= options.rewind:
+                    rewinder.take(state_devices(), paged)
+                    frames = 0
+
+    except BaseException:
+        if cpu.history:
+            cpu.history.dump()
+
+        raise
+
+dk = screen_kb(io_values, options.hz)
+
+cpu = z80(read_mem, write_mem, read_io, write_io, debug, dk, idle_ports=None if options.no_idle_skip else { 0x99: dk.status_by_events }, hz=options.hz)
+dk.clock = lambda: cpu.scheduler.now
+cpu.set_trace(tr.enabled('cpu'))
+
+if options.profile:
+    cpu.set_profiler(profiler())
+
+if options.history:
+    cpu.set_history(history(options.history))
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: cpu.history.dump())
+
+trace_writer = None
+if options.binary_trace:
+    trace_writer = bintrace(options.binary_trace)
+    trace_writer.start(cpu)
+
+code_coverage = None
+if options.coverage or options.coverage_listing:
+    code_coverage = codecoverage()
+
+    if options.coverage and os.path.exists(options.coverage):
+        code_coverage.load(options.coverage)
+
+    code_coverage.start(cpu)
+
+if options.compile_blocks:
+    cpu.enable_blocks()
+
+update_memory_layout()
+
+musicmodule = NMS_1205(cpu, tr.logger('midi'))
 musicmodule.start()
 
 init_io()
 
+if options.load_state:
+    try:
+        load_state(options.load_state)
+
+    except ValueError as e:
+        print('Cannot load %s: %s' % (options.load_state, e))
+        sys.exit(1)
+
+boot_cache = None
+if options.quick_boot and not options.load_state:
+    boot_cache = quickboot(os.path.expanduser('~/.cache/pymsx'), machine_config())
+    data = boot_cache.load()
+
+    if data:
+        try:
+            restore_state(data)
+            boot_cache = None
+
+        except ValueError as e:
+            print('Cannot use quick boot state: %s' % e)
+
+    if boot_cache:
+        cpu.add_hook(boot_cache)
+
+if options.save_state:
+    def request_save(signum, frame) -> None:
+        global save_flag
+
+        save_flag = True
+
+    signal.signal(signal.SIGUSR2, request_save)
+
+# what conditions of breakpoints and hooks can use besides the registers
+hook_names = { 'slots': lambda: read_page_layout(0), 'bios': lambda: cpu.memory_layout[0] == (0, 0, 0) }
+
+hooks = None
+if options.bios_vram:
+    hooks = pc_hooks(cpu, hook_names)
+
+    vram = bios_vram(cpu, dk)
+
+    if vram.matches(bb.read_mem):
+        vram.install(hooks, 'bios')
+        cpu.add_hook(hooks)
+
+    else:
+        print('Not the (MSX 1) BIOS that --bios-vram knows')
+        hooks = None
+
+dbg = None
+if options.breakpoints or options.watchpoints or options.io_watchpoints or options.console:
+    dbg = debugger(cpu, hook_names)
+
+    try:
+        for breakpoint in options.breakpoints or []:
+            parts = breakpoint.split(None, 1)
+
+            dbg.add_breakpoint(int(parts[0], 16), parts[1] if len(parts) > 1 else None)
+
+        for watch in options.watchpoints or []:
+            parts = watch.split(':')
+            addresses = parts[0].split('-')
+
+            dbg.add_watchpoint(int(addresses[0], 16), int(addresses[-1], 16), parse_mode(parts[1]) if len(parts) > 1 else READ | WRITE, parse_bank(parts[2]) if len(parts) > 2 else None)
+
+        for watch in options.io_watchpoints or []:
+            parts = watch.split(':')
+
+            dbg.add_io_watchpoint(int(parts[0], 16), parse_mode(parts[1]) if len(parts) > 1 else READ | WRITE)
+
+    except (KeyError, ValueError) as e:
+        print('Invalid breakpoint or watchpoint: %s' % e)
+        sys.exit(1)
+
+    signal.signal(signal.SIGQUIT, lambda signum, frame: dbg.request_stop())
+
+rewinder = None
+if options.rewind:
+    rewinder = rewind(options.rewind_size)
+    paged = paged_devices()
+
+    def request_rewind(signum, frame) -> None:
+        global rewind_flag
+
+        rewind_flag = True
+
+    signal.signal(signal.SIGHUP, request_rewind)
+
+start_time = time.time()
+# not counting what was restored
+start_cycles = cpu.scheduler.now
+
+pacer = throttle(3579545, cpu.frame_cycles, speed)
+pacer.restart(start_cycles)
+
 t = threading.Thread(target=cpu_thread)
 t.start()
 
@@ -324,8 +720,41 @@ except KeyboardInterrupt:
     stop_flag = True
     t.join()
 
+if options.save_state:
+    save_state(options.save_state)
+
 dk.stop()
+tr.close()
+
+if trace_writer:
+    trace_writer.stop()
+
+if code_coverage:
+    code_coverage.stop()
 
-#for i in range(0, 256):
-#    if cpu.counts[i]:
-#        print('instr %02x: %d' % (i, cpu.counts[i]), file=sys.stderr)
+    if options.coverage:
+        code_coverage.export(options.coverage)
+
+    if options.coverage_listing:
+        code_coverage.write_listing(options.coverage_listing)
+
+print(file=sys.stderr)  # after the speed
+
+took = time.time() - start_time
+cycles = cpu.scheduler.now - start_cycles
+busy = cycles - cpu.halt_cycles - cpu.idle_cycles
+print('%d cycles in %.1f seconds (%.2f MHz)' % (cycles, took, cycles / took / 1000000), file=sys.stderr)
+if busy > 0:
+    # what executing the skipped cycles would have taken
+    print('%d cycles skipped in HALT, saved about %.1f seconds' % (cpu.halt_cycles, cpu.halt_cycles * took / busy), file=sys.stderr)
+    print('%d cycles skipped in idle loops, saved about %.1f seconds' % (cpu.idle_cycles, cpu.idle_cycles * took / busy), file=sys.stderr)
+
+if rewinder:
+    print('%d rewind states in %.1f MB' % (len(rewinder), rewinder.memory_used() / 1048576), file=sys.stderr)
+
+if cpu.profiler:
+    if options.profile.endswith('.csv'):
+        cpu.profiler.export_csv(options.profile)
+
+    else:
+        cpu.profiler.export_json(options.profile)
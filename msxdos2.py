@@ -27,6 +27,9 @@ class msxdos2:
     def get_n_pages(self):
         return 1
 
+    def get_banks(self) -> Tuple[int, ...]:
+        return (self.msxdos2_page, )
+
     def split_addr(self, a: int) -> Tuple[int, int]:
         assert a >= 0x4000
 
@@ -39,6 +42,12 @@ class msxdos2:
         self.debug('MSX-DOS2: set bank to %d (%d) via %04x' % (v, v & 3, a))
         self.msxdos2_page = v & 3
 
+    def get_state(self) -> bytes:
+        return bytes([ self.msxdos2_page ])
+
+    def set_state(self, data: bytes) -> None:
+        self.msxdos2_page = data[0]
+
     def read_mem(self, a: int) -> int:
         bank, offset = self.split_addr(a)
 
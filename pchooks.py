@@ -0,0 +1,127 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import ast
+from typing import Callable, Dict, List, Optional, Tuple
+from z80 import register_views
+
+# what a condition can use as is
+registers: frozenset = frozenset(('a', 'f', 'bc', 'de', 'hl', 'a_', 'f_', 'bc_', 'de_', 'hl_', 'ix', 'iy', 'pc', 'sp', 'i', 'r', 'im', 'iff1', 'iff2', 'memptr'))
+
+class condition_compiler(ast.NodeTransformer):
+    ''' Turns the names in a condition into accesses of the CPU: registers
+    (B, C etc. are taken from their pair), mem(a) reads memory and the
+    names given by the caller are functions without arguments (e.g. the
+    primary slot register). '''
+
+    def __init__(self, names: Dict[str, Callable[[], int]]) -> None:
+        self.names = names
+
+    def cpu(self, attribute: str) -> ast.AST:
+        return ast.Attribute(value=ast.Name(id='cpu', ctx=ast.Load()), attr=attribute, ctx=ast.Load())
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        name = node.id
+
+        if name in registers:
+            return self.cpu(name)
+
+        if name in register_views:
+            pair, shift = register_views[name]
+
+            if shift:
+                return ast.BinOp(left=self.cpu(pair), op=ast.RShift(), right=ast.Constant(value=shift))
+
+            return ast.BinOp(left=self.cpu(pair), op=ast.BitAnd(), right=ast.Constant(value=0xff))
+
+        if name == 'mem':
+            return self.cpu('read_mem')
+
+        if name in self.names:
+            function = ast.Subscript(value=ast.Name(id='names', ctx=ast.Load()), slice=ast.Constant(value=name), ctx=ast.Load())
+
+            return ast.Call(func=function, args=[], keywords=[])
+
+        raise ValueError('unknown name %s in condition' % name)
+
+def compile_condition(condition: str, cpu, names: Optional[Dict[str, Callable[[], int]]] = None) -> Callable[[], bool]:
+    ''' E.g. "pc == 0x4010 and a == 3 and slots == 0xf0" (with 'slots' in
+    'names'), as a function. Raises ValueError when it is invalid. '''
+    try:
+        tree = ast.parse(condition.strip(), mode='eval')
+
+    except SyntaxError as e:
+        raise ValueError('invalid condition %s: %s' % (condition, e))
+
+    body = condition_compiler(names or {}).visit(tree.body)
+
+    function = ast.Expression(body=ast.Lambda(args=ast.arguments(posonlyargs=[], args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]), body=body))
+    ast.fix_missing_locations(function)
+
+    return eval(compile(function, '<condition>', 'eval'), { '__builtins__': {}, 'cpu': cpu, 'names': names or {} })
+
+class pc_hooks:
+    ''' Python functions that are called before the instruction at an
+    address is executed, optionally only when a condition holds. A
+    function gets the CPU (with pc at the instruction); when it returns
+    the number of cycles that it took, it took the place of the
+    instruction (e.g. it emulated a BIOS call and did the RET), with None
+    the instruction is executed. Given to z80.add_hook(): only the
+    instructions at hooked addresses are wrapped, the others cost
+    nothing. Not with compiled blocks. '''
+
+    def __init__(self, cpu, names: Optional[Dict[str, Callable[[], int]]] = None) -> None:
+        self.cpu = cpu
+        self.names: Dict[str, Callable[[], int]] = names or {}
+
+        # address: [ (function, condition), ... ]
+        self.table: Dict[int, List[Tuple[Callable, Optional[Callable[[], bool]]]]] = {}
+
+    def add(self, pc: int, function: Callable, condition: Optional[str] = None) -> None:
+        entries = self.table.get(pc)
+
+        compiled = None if condition is None else compile_condition(condition, self.cpu, self.names)
+
+        if entries is None:
+            self.table[pc] = [ (function, compiled) ]
+
+            # the instruction there may be decoded already
+            self.cpu.flush_decoded()
+
+        else:  # the wrapped handler uses the same list
+            entries.append((function, compiled))
+
+    def remove(self, pc: int, function: Optional[Callable] = None) -> None:
+        ''' All functions at 'pc' when 'function' is None. '''
+        entries = self.table.get(pc, [])
+
+        entries[:] = [ entry for entry in entries if function is not None and entry[0] != function ]
+
+        if not entries and pc in self.table:
+            del self.table[pc]
+
+            self.cpu.flush_decoded()
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        entries = self.table.get(pc)
+
+        if entries is None:
+            return handler
+
+        after = (pc + length) & 0xffff
+
+        def hooked() -> int:
+            cpu.pc = pc
+
+            for function, condition in entries:
+                if condition is None or condition():
+                    took = function(cpu)
+
+                    if took is not None:
+                        return took
+
+            cpu.pc = after
+
+            return handler()
+
+        return hooked
@@ -0,0 +1,91 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import csv
+import json
+from typing import Callable, Dict, List
+
+# the instruction tables of the z80
+tables = ( 'main', 'cb', 'ed', 'dd', 'fd', 'ddcb', 'fdcb' )
+
+class profiler:
+    ''' Counts executions and cycles per opcode (per instruction table), per
+    program counter and per bank (what is mapped in the 16KB page, the key
+    of the CPU's memory layout). Given to z80.set_profiler() which then
+    wraps the handlers of the instructions it decodes. '''
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, List[int]] = { table: [ 0 ] * 256 for table in tables }
+        self.cycles: Dict[str, List[int]] = { table: [ 0 ] * 256 for table in tables }
+
+        # (bank, pc): [ count, cycles ]
+        self.pcs: Dict[tuple, List[int]] = {}
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        table, opcode = cpu.opcode_at(pc)
+        bank = cpu.memory_layout[pc >> 14]
+
+        counts = self.counts[table]
+        cycles = self.cycles[table]
+        entry = self.pcs.setdefault((bank, pc), [ 0, 0 ])
+
+        def counted() -> int:
+            took = handler()
+
+            counts[opcode] += 1
+            cycles[opcode] += took
+            entry[0] += 1
+            entry[1] += took
+
+            return took
+
+        return counted
+
+    def reset(self) -> None:
+        # in place: the wrapped handlers refer to these lists
+        for table in tables:
+            self.counts[table][:] = [ 0 ] * 256
+            self.cycles[table][:] = [ 0 ] * 256
+
+        for entry in self.pcs.values():
+            entry[0] = entry[1] = 0
+
+    def snapshot(self) -> dict:
+        ''' The non-zero counters, most cycles first. '''
+        opcodes = [ { 'table': table, 'opcode': opcode, 'count': count, 'cycles': self.cycles[table][opcode] }
+                    for table in tables for opcode, count in enumerate(self.counts[table]) if count ]
+
+        pcs = [ { 'bank': str(bank), 'pc': pc, 'count': entry[0], 'cycles': entry[1] }
+                for (bank, pc), entry in self.pcs.items() if entry[0] ]
+
+        banks: Dict[str, dict] = {}
+        for item in pcs:
+            bank = banks.setdefault(item['bank'], { 'bank': item['bank'], 'count': 0, 'cycles': 0 })
+            bank['count'] += item['count']
+            bank['cycles'] += item['cycles']
+
+        by_cycles = lambda item: -item['cycles']
+
+        return { 'opcodes': sorted(opcodes, key=by_cycles), 'pcs': sorted(pcs, key=by_cycles), 'banks': sorted(banks.values(), key=by_cycles) }
+
+    def export_json(self, filename: str) -> None:
+        with open(filename, 'w') as fh:
+            json.dump(self.snapshot(), fh, indent=1)
+
+    def export_csv(self, filename: str) -> None:
+        ''' One row per counter: kind (opcode, pc or bank), table or bank,
+        opcode or program counter, count, cycles. '''
+        snapshot = self.snapshot()
+
+        with open(filename, 'w', newline='') as fh:
+            out = csv.writer(fh)
+            out.writerow([ 'kind', 'table/bank', 'opcode/pc', 'count', 'cycles' ])
+
+            for item in snapshot['opcodes']:
+                out.writerow([ 'opcode', item['table'], '%02x' % item['opcode'], item['count'], item['cycles'] ])
+
+            for item in snapshot['pcs']:
+                out.writerow([ 'pc', item['bank'], '%04x' % item['pc'], item['count'], item['cycles'] ])
+
+            for item in snapshot['banks']:
+                out.writerow([ 'bank', item['bank'], '', item['count'], item['cycles'] ])
@@ -0,0 +1,65 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import hashlib
+import os
+from typing import Callable, List, Optional
+
+# CHGET (the BASIC prompt waits for a key) and where the disk ROM starts the
+# boot sector
+boot_points: tuple = ( 0x009f, 0xc01e )
+
+def config_key(settings: List[str], files: List[str]) -> str:
+    ''' A hash of the configuration of the machine: 'settings' (e.g. the
+    command line options) and the contents of 'files' (the ROMs and disk
+    images). '''
+    h = hashlib.sha256()
+
+    for setting in settings:
+        h.update(setting.encode('utf-8') + b'\0')
+
+    for filename in files:
+        with open(filename, 'rb') as fh:
+            h.update(hashlib.sha256(fh.read()).digest())
+
+    return h.hexdigest()
+
+class quickboot:
+    ''' A cache of states of machines that are done booting, per
+    configuration (see config_key()). Given to z80.add_hook() it sets
+    'reached' when one of the boot points is executed; the state can be
+    stored then. '''
+
+    def __init__(self, directory: str, key: str) -> None:
+        self.filename: str = os.path.join(directory, '%s.state' % key)
+        self.reached: bool = False
+
+    def load(self) -> Optional[bytes]:
+        try:
+            with open(self.filename, 'rb') as fh:
+                return fh.read()
+
+        except FileNotFoundError:
+            return None
+
+    def store(self, data: bytes) -> None:
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+        # never leave half a state when interrupted
+        temp = self.filename + '.tmp'
+
+        with open(temp, 'wb') as fh:
+            fh.write(data)
+
+        os.replace(temp, self.filename)
+
+    def wrap(self, handler: Callable[[], int], cpu, pc: int, length: int) -> Callable[[], int]:
+        if pc not in boot_points:
+            return handler
+
+        def boot_point() -> int:
+            self.reached = True
+
+            return handler()
+
+        return boot_point
@@ -0,0 +1,94 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+import savestate
+
+# returns the state of a device as a part without the memory and the memory
+# in pages, None for pages not written since the previous call; the state
+# is the part followed by all pages (see memmap.get_state_pages())
+get_state_pages = Callable[[], Tuple[bytes, List[Optional[bytes]]]]
+
+class rewind:
+    ''' The last 'size' states of the machine, kept in memory. Of devices
+    that can return their state in pages only the pages that changed are
+    stored; the others are shared with the previous state. '''
+
+    def __init__(self, size: int) -> None:
+        self.states: deque = deque(maxlen=size)
+
+        # per device the pages of the newest state (or of the state that
+        # was restored), which is what the device has in its memory apart
+        # from the pages that were written since then
+        self.pages: Dict[str, List[bytes]] = {}
+
+    def take(self, devices: List[savestate.device], paged: Dict[str, get_state_pages]) -> None:
+        ''' 'paged' has the get_state_pages() of devices in 'devices' that
+        have one. '''
+        state = {}
+
+        for name, get_state, set_state in devices:
+            if name not in paged:
+                state[name] = get_state()
+                continue
+
+            data, pages = paged[name]()
+            previous = self.pages.get(name)
+
+            for i, page in enumerate(pages):
+                if page is None:
+                    pages[i] = previous[i]
+
+                # written but the same (e.g. after set_state())
+                elif previous and page == previous[i]:
+                    pages[i] = previous[i]
+
+            self.pages[name] = pages
+            state[name] = (data, pages)
+
+        self.states.append(state)
+
+    def back(self, devices: List[savestate.device]) -> bool:
+        ''' Restores the newest state and forgets it, so that the next call
+        goes back further. Returns False when there is none. '''
+        if not self.states:
+            return False
+
+        state = self.states.pop()
+
+        for name, get_state, set_state in devices:
+            data = state[name]
+
+            if isinstance(data, tuple):
+                self.pages[name] = data[1]
+
+                data = data[0] + b''.join(data[1])
+
+            set_state(data)
+
+        return True
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def memory_used(self) -> int:
+        ''' Bytes used by the states, counting shared pages once. '''
+        seen = set()
+        total = 0
+
+        for state in self.states:
+            for data in state.values():
+                if isinstance(data, tuple):
+                    total += len(data[0])
+
+                    for page in data[1]:
+                        if id(page) not in seen:
+                            seen.add(id(page))
+                            total += len(page)
+
+                else:
+                    total += len(data)
+
+        return total
@@ -0,0 +1,72 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import struct
+from typing import Callable, List, Tuple
+
+# a state is the header followed by a section per device: a header with the
+# name and the length of the data, then the data that the device returned
+# from get_state()
+magic: bytes = b'PyMSXsav'
+VERSION: int = 1
+
+header = struct.Struct('<8sI')
+section = struct.Struct('<16sI')
+
+# name, get_state(), set_state(data)
+device = Tuple[str, Callable[[], bytes], Callable[[bytes], None]]
+
+def dump(devices: List[device]) -> bytes:
+    out = [ header.pack(magic, VERSION) ]
+
+    for name, get_state, set_state in devices:
+        data = get_state()
+
+        out.append(section.pack(name.encode('ascii'), len(data)))
+        out.append(data)
+
+    return b''.join(out)
+
+def restore(data: bytes, devices: List[device]) -> None:
+    ''' Raises ValueError when 'data' is not a state (of this version) or
+    when it is of a differently configured machine. '''
+    if len(data) < header.size:
+        raise ValueError('not a saved state')
+
+    file_magic, version = header.unpack_from(data, 0)
+
+    if file_magic != magic:
+        raise ValueError('not a saved state')
+
+    if version != VERSION:
+        raise ValueError('saved state is version %d, expected %d' % (version, VERSION))
+
+    sections = {}
+    pos = header.size
+
+    while pos < len(data):
+        name, length = section.unpack_from(data, pos)
+        pos += section.size
+
+        sections[name.rstrip(b'\0').decode('ascii')] = data[pos:pos + length]
+        pos += length
+
+    names = [ name for name, get_state, set_state in devices ]
+
+    if sorted(sections) != sorted(names):
+        raise ValueError('saved state has %s, this machine has %s' % (', '.join(sections), ', '.join(names)))
+
+    for name, get_state, set_state in devices:
+        set_state(sections[name])
+
+def save(filename: str, devices: List[device]) -> None:
+    data = dump(devices)
+
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+
+def load(filename: str, devices: List[device]) -> None:
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+
+    restore(data, devices)
@@ -29,6 +29,9 @@ class scc:
     def get_n_pages(self):
         return 2
 
+    def get_banks(self) -> Tuple[int, ...]:
+        return tuple(self.scc_pages)
+
     def split_addr(self, a: int) -> Tuple[int, int]:
         bank = (a >> 13) - 2
         offset = a & 0x1fff
@@ -52,6 +55,12 @@ class scc:
         else:
             self.debug('SCC write to %04x not understood' % a)
 
+    def get_state(self) -> bytes:
+        return bytes(self.scc_pages)
+
+    def set_state(self, data: bytes) -> None:
+        self.scc_pages[:] = data
+
     def read_mem(self, a: int) -> int:
         bank, offset = self.split_addr(a)
 
@@ -0,0 +1,78 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import heapq
+import threading
+from typing import Callable, List
+
+class scheduler:
+    ''' Calls functions when the emulated machine reaches a cycle count.
+    'now' is advanced by the CPU which calls run_due() once it is at or
+    past 'deadline'. Callbacks get the cycle count they were scheduled
+    for. '''
+
+    never: int = 1 << 62
+
+    def __init__(self) -> None:
+        self.now: int = 0
+        self.deadline: int = scheduler.never
+        # how often run_due() was called
+        self.runs: int = 0
+
+        # heap of [ cycle count, sequence number, callback ]
+        self.events: List[list] = []
+        self.n: int = 0
+
+        # callbacks posted by other threads, run at the next instruction
+        self.posted: List[Callable[[int], None]] = []
+        self.lock = threading.Lock()
+
+    def add(self, when: int, callback: Callable[[int], None]) -> list:
+        ''' Only to be called from the emulation thread. '''
+        event = [ when, self.n, callback ]
+        self.n += 1
+
+        heapq.heappush(self.events, event)
+
+        if when < self.deadline:
+            self.deadline = when
+
+        return event
+
+    def add_in(self, cycles: int, callback: Callable[[int], None]) -> list:
+        return self.add(self.now + cycles, callback)
+
+    def cancel(self, event: list) -> None:
+        event[2] = None
+
+    def post(self, callback: Callable[[int], None]) -> None:
+        ''' Can be called from any thread. '''
+        with self.lock:
+            self.posted.append(callback)
+            self.deadline = 0
+
+    def run_due(self) -> None:
+        self.runs += 1
+
+        if self.posted:
+            with self.lock:
+                posted = self.posted
+                self.posted = []
+
+            for callback in posted:
+                callback(self.now)
+
+        events = self.events
+
+        while events and events[0][0] <= self.now:
+            when, n, callback = heapq.heappop(events)
+
+            if callback:
+                callback(when)
+
+        with self.lock:
+            if self.posted:
+                self.deadline = 0
+
+            else:
+                self.deadline = events[0][0] if events else scheduler.never
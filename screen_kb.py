@@ -7,6 +7,7 @@ import struct
 import sys
 import threading
 from enum import IntEnum
+from typing import Callable, List, Optional, Tuple
 from vdp import vdp
 
 class screen_kb:
@@ -15,10 +16,19 @@ class screen_kb:
         GET_IO = 1
         INTERRUPT = 2
         GET_REG = 3
+        GET_STATE = 4
+        SET_STATE = 5
+        GET_STATE_PAGES = 6
+        WRITE_DATA = 7
+        READ_DATA = 8
 
-    def __init__(self, io):
+    def __init__(self, io, hz: int = 50):
         self.stop_flag = False
         self.io = io
+        self.hz = hz
+
+        # returns the emulated time, which the VDP uses for its status
+        self.clock: Callable[[], int] = lambda: 0
 
         self.keyboard_queue = []
         self.k_lock = threading.Lock()
@@ -46,7 +56,7 @@ class screen_kb:
         self.pid = os.fork()
 
         if self.pid == 0:
-            self.vdp = vdp()
+            self.vdp = vdp(self.hz)
             self.vdp.start()
             
             while True:
@@ -60,7 +70,7 @@ class screen_kb:
                     self.vdp.write_io(a, v)
 
                 elif type_ == screen_kb.Msg.GET_IO:
-                    a = os.read(self.pipe_tv_in, 1)[0]
+                    a, self.vdp.cycles = struct.unpack('<BQ', self.read_all(self.pipe_tv_in, 9))
                     v = self.vdp.read_io(a)
 
                     packet = ( screen_kb.Msg.GET_IO, a, v )
@@ -69,8 +79,8 @@ class screen_kb:
                 elif type_ == screen_kb.Msg.INTERRUPT:
                     self.vdp.interrupt()
 
-                    # interrupt ack
-                    packet = ( screen_kb.Msg.INTERRUPT, 123 )
+                    # interrupt ack, with IE0
+                    packet = ( screen_kb.Msg.INTERRUPT, 1 if self.vdp.registers[1] & 32 else 0 )
                     os.write(self.pipe_fv_out, bytearray(packet))
 
                 elif type_ == screen_kb.Msg.GET_REG:
@@ -79,6 +89,35 @@ class screen_kb:
                     packet = ( screen_kb.Msg.GET_REG, self.vdp.registers[a] )
                     os.write(self.pipe_fv_out, bytearray(packet))
 
+                elif type_ == screen_kb.Msg.GET_STATE:
+                    data = self.vdp.get_state()
+
+                    os.write(self.pipe_fv_out, struct.pack('<I', len(data)))
+                    self.write_all(self.pipe_fv_out, data)
+
+                elif type_ == screen_kb.Msg.GET_STATE_PAGES:
+                    data, pages = self.vdp.get_state_pages()
+                    written = [ page for page in pages if page is not None ]
+                    mask = sum(1 << i for i, page in enumerate(pages) if page is not None)
+
+                    os.write(self.pipe_fv_out, struct.pack('<IB', len(data), mask))
+                    self.write_all(self.pipe_fv_out, data + b''.join(written))
+
+                elif type_ == screen_kb.Msg.WRITE_DATA:
+                    length = struct.unpack('<I', self.read_all(self.pipe_tv_in, 4))[0]
+
+                    self.vdp.write_data(self.read_all(self.pipe_tv_in, length))
+
+                elif type_ == screen_kb.Msg.READ_DATA:
+                    length = struct.unpack('<I', self.read_all(self.pipe_tv_in, 4))[0]
+
+                    self.write_all(self.pipe_fv_out, self.vdp.read_data(length))
+
+                elif type_ == screen_kb.Msg.SET_STATE:
+                    length = struct.unpack('<I', self.read_all(self.pipe_tv_in, 4))[0]
+
+                    self.vdp.set_state(self.read_all(self.pipe_tv_in, length))
+
                 else:
                     print('Unexpected message %d' % type_)
 
@@ -87,11 +126,13 @@ class screen_kb:
         os.close(self.pipe_tv_in)
         os.close(self.pipe_fv_out)
 
-    def interrupt(self):
+    def interrupt(self) -> bool:
+        # returns if the VDP interrupt is enabled (IE0)
         os.write(self.pipe_tv_out, screen_kb.Msg.INTERRUPT.to_bytes(1, 'big'))
         data = os.read(self.pipe_fv_in, 2)
         assert data[0] == screen_kb.Msg.INTERRUPT
-        assert data[1] == 123
+
+        return data[1] == 1
 
     def IE0(self) -> bool:
         packet = [ screen_kb.Msg.GET_REG, 1 ]  # request VDP status register 1
@@ -104,14 +145,77 @@ class screen_kb:
 
         return (v & 32) == 32
 
+    def get_register(self, a: int) -> int:
+        os.write(self.pipe_tv_out, bytearray([ screen_kb.Msg.GET_REG, a ]))
+
+        data = os.read(self.pipe_fv_in, 2)
+        assert data[0] == screen_kb.Msg.GET_REG
+
+        return data[1]
+
+    def status_by_events(self) -> bool:
+        ''' If what port 0x99 returns only changes at events (the VDP
+        interrupt): not while register 15 selects S#2, of which the HR and
+        VR bits change with the emulated time. '''
+        return self.get_register(15) != 2
+
+    def read_all(self, fd: int, n: int) -> bytes:
+        # a pipe returns at most what fits in it
+        data = bytearray()
+
+        while len(data) < n:
+            data += os.read(fd, n - len(data))
+
+        return bytes(data)
+
+    def write_all(self, fd: int, data: bytes) -> None:
+        view = memoryview(data)
+
+        while view:
+            view = view[os.write(fd, view):]
+
+    def get_state(self) -> bytes:
+        ''' The state of the VDP (in the display process). '''
+        os.write(self.pipe_tv_out, screen_kb.Msg.GET_STATE.to_bytes(1, 'big'))
+
+        length = struct.unpack('<I', self.read_all(self.pipe_fv_in, 4))[0]
+
+        return self.read_all(self.pipe_fv_in, length)
+
+    def get_state_pages(self) -> Tuple[bytes, List[Optional[bytes]]]:
+        ''' get_state() as everything but the VRAM and the VRAM per 16KB,
+        None for the parts that were not written since the previous call. '''
+        os.write(self.pipe_tv_out, screen_kb.Msg.GET_STATE_PAGES.to_bytes(1, 'big'))
+
+        length, mask = struct.unpack('<IB', self.read_all(self.pipe_fv_in, 5))
+        data = self.read_all(self.pipe_fv_in, length)
+        pages = [ self.read_all(self.pipe_fv_in, 16384) if mask & (1 << i) else None for i in range(8) ]
+
+        return data, pages
+
+    def set_state(self, data: bytes) -> None:
+        os.write(self.pipe_tv_out, screen_kb.Msg.SET_STATE.to_bytes(1, 'big') + struct.pack('<I', len(data)))
+        self.write_all(self.pipe_tv_out, data)
+
+    def write_data(self, data: bytes) -> None:
+        ''' Writes all of 'data' to the VRAM data port (0x98) with one
+        message instead of one per byte. '''
+        os.write(self.pipe_tv_out, screen_kb.Msg.WRITE_DATA.to_bytes(1, 'big') + struct.pack('<I', len(data)))
+        self.write_all(self.pipe_tv_out, data)
+
+    def read_data(self, n: int) -> bytes:
+        ''' Reads the VRAM data port (0x98) 'n' times. '''
+        os.write(self.pipe_tv_out, screen_kb.Msg.READ_DATA.to_bytes(1, 'big') + struct.pack('<I', n))
+
+        return self.read_all(self.pipe_fv_in, n)
+
     def write_io(self, a: int, v: int) -> None:
         packet = ( screen_kb.Msg.SET_IO, a, v )
         os.write(self.pipe_tv_out, bytearray(packet))
 
     def read_io(self, a: int) -> None:
         if a in (0x98, 0x99, 0xa9):
-            packet = ( screen_kb.Msg.GET_IO, a )
-            os.write(self.pipe_tv_out, bytearray(packet))
+            os.write(self.pipe_tv_out, struct.pack('<BBQ', screen_kb.Msg.GET_IO, a, self.clock()))
 
             data = os.read(self.pipe_fv_in, 3)
             type_ = data[0]
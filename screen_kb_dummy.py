@@ -1,9 +1,11 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+from typing import List, Optional, Tuple
+
 class screen_kb_dummy:
-    def __init__(self, io):
-        pass
+    def __init__(self, io, hz: int = 50):
+        self.clock = lambda: 0
 
     def get_ios(self):
         return [ [ ] , [ ] ]
@@ -11,15 +13,33 @@ class screen_kb_dummy:
     def get_name(self):
         return 'screen/keyboard'
 
-    def interrupt(self):
-        pass
+    def interrupt(self) -> bool:
+        return False
 
     def IE0(self) -> bool:
         return False
 
+    def status_by_events(self) -> bool:
+        return True
+
     def start(self):
         pass
 
+    def get_state(self) -> bytes:
+        return b''
+
+    def get_state_pages(self) -> Tuple[bytes, List[Optional[bytes]]]:
+        return b'', []
+
+    def set_state(self, data: bytes) -> None:
+        pass
+
+    def write_data(self, data: bytes) -> None:
+        pass
+
+    def read_data(self, n: int) -> bytes:
+        return bytes(n)
+
     def write_io(self, a: int, v: int) -> None:
         pass
 
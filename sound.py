@@ -242,6 +242,28 @@ class sound():
 
             self.recalc_channels(True)
 
+    def get_state(self) -> bytes:
+        # the PSG register index and registers, then the SCC registers
+        return bytes([ self.ri ]) + bytes(self.psg_regs) + bytes(self.scc_regs)
+
+    def set_state(self, data: bytes) -> None:
+        self.ri = data[0]
+        self.psg_regs[:] = data[1:17]
+        self.scc_regs[:] = data[17:17 + 256]
+
+        # also to the audio process, in one go
+        packets = bytearray()
+
+        for a, v in enumerate(self.psg_regs):
+            packets += bytes(( sound.T_AY_3_8910, a, v ))
+
+        for a, v in enumerate(self.scc_regs):
+            packets += bytes(( sound.SCC, a, v ))
+
+        os.write(self.pipeout, packets)
+
+        self.recalc_channels(True)
+
     def recalc_channels(self, midi: bool) -> None:
         # base_freq = 3579545 / 16.0
         base_freq = 1789772.5 / 16.0
@@ -4,7 +4,11 @@
 import struct
 import sys
 from enum import Enum, IntFlag, IntEnum
-from typing import List
+from typing import List, Tuple
+
+# the byte of the data register that is next, the data register and the
+# control register
+ide_state = struct.Struct('<BHB')
 
 class sunriseide:
     class bytesel(Enum):
@@ -34,6 +38,9 @@ class sunriseide:
     def get_name(self):
         return 'SunRise IDE'
 
+    def get_banks(self) -> Tuple[int, ...]:
+        return (self.control, )
+
     def write_mem(self, a: int, v: int) -> None:
         if a == 0x7e00 or (a >= 0x7c00 and a <= 0x7dff):  # data
             if self.which_byte == sunriseide.bytesel.lowbyte:
@@ -60,6 +67,14 @@ class sunriseide:
         else:
             self.debug('Unexpected write: %04x %02x' % (a, v))
 
+    def get_state(self) -> bytes:
+        return ide_state.pack(self.which_byte.value, self.word, self.control)
+
+    def set_state(self, data: bytes) -> None:
+        which_byte, self.word, self.control = ide_state.unpack(data)
+
+        self.which_byte = sunriseide.bytesel(which_byte)
+
     def read_mem(self, a: int) -> int:
         if (self.control & 1) == 1 and (a == 0x7e00 or (a >= 0x7c00 and a <= 0x7dff)):
             v = None
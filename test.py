@@ -3,9 +3,28 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
+import json
 import sys
+import tempfile
 from inspect import getframeinfo, stack
 from z80 import z80
+from screen_kb_dummy import screen_kb_dummy
+from profiler import profiler
+from history import history
+import bintrace
+import codecoverage
+import savestate
+from memmapper import memmap
+import quickboot
+from rewind import rewind
+from throttle import throttle
+import tracer
+import debugger
+import pchooks
+import biosvram
+from cpm import cpm
+import fuzzer
+import io as textio
 
 io = [ 0 ] * 256
 
@@ -66,13 +85,16 @@ def flag_str(f):
 
     return flags
 
+class test_failed(Exception):
+    pass
+
 def my_assert(r):
     if not r:
         print(cpu.reg_str())
         caller = getframeinfo(stack()[1][0])
         print(flag_str(cpu.f))
         print('%s:%d' % (caller.filename, caller.lineno))
-        sys.exit(1)
+        raise test_failed()
 
 def test_ld():
     # LD C,L
@@ -401,6 +423,45 @@ def test_jp():
     my_assert(cpu.pc == 0x2000)
     my_assert(cpu.sp == 0xffff)
 
+def test_bulk():
+    # LDIR / LDDR / CPIR with direct memory access must end up the same as
+    # when it is done one byte at a time
+    program = [ 0xed, 0xb0, 0xed, 0xb8, 0xed, 0xb1 ] # LDIR, LDDR, CPIR
+
+    results = []
+    written = bytearray(2)
+    for direct in (None, [ (ram0, 0, True, (written, 1)), None, None, None ]):
+        reset_mem()
+        for i in range(0, 0x1000):
+            ram0[i] = 0
+        ram0[0:6] = program
+        for i in range(0x100, 0x140):
+            ram0[i] = i & 0x3f
+
+        cpu.reset()
+        cpu.set_memory_layout((0, 1, 2, 3), direct)
+        cpu.hl = 0x0100 # overlapping: repeats 0100-013f up to 033f
+        cpu.de = 0x0140
+        cpu.bc = 0x0200
+        cycles = cpu.run(100000, 0x0002)
+        my_assert(cpu.pc == 0x0002)
+        cpu.hl = 0x0213
+        cpu.de = 0x0810
+        cpu.bc = 0x0100
+        cycles += cpu.run(100000, 0x0004)
+        my_assert(cpu.pc == 0x0004)
+        cpu.hl = 0x0800
+        cpu.bc = 0x0400
+        cpu.a = 0x00
+        cycles += cpu.run(100000, 0x0006)
+        results.append((cycles, cpu.bc, cpu.de, cpu.hl, cpu.f, cpu.memptr, ram0[0:0x1000]))
+
+    cpu.set_memory_layout((0, 1, 2, 3))
+    my_assert(written == b'\x00\x01')
+    my_assert(results[0] == results[1])
+    my_assert(results[0][0] == (0x1ff + 0xff + 0x11) * 21 + 3 * 16)
+    my_assert(results[0][3] == 0x0812)
+
 def test_call_ret():
     # CALL **
     reset_mem()
@@ -538,6 +599,116 @@ def test_call_ret():
     my_assert(cpu.pc == 0x2211)
     my_assert(cpu.sp == 0x3ffd)
 
+def test_coverage():
+    reset_mem()
+    cpu.reset()
+    program = [ 0x3a, 0x00, 0x01, # LD A,(0100)
+                0x32, 0x01, 0x01, # LD (0101),A
+                0x21, 0x00, 0x02, # LD HL,0200
+                0x11, 0x00, 0x03, # LD DE,0300
+                0x01, 0x02, 0x00, # LD BC,0002
+                0xed, 0xb0,       # LDIR
+                0x3a, 0x14, 0x00 ] # LD A,(0014): data right after the instruction
+    ram0[0:len(program)] = program
+    c = codecoverage.codecoverage()
+    c.start(cpu)
+    for i in range(8):
+        cpu.step()
+    c.stop()
+    my_assert(cpu.pc == 0x0014)
+    my_assert(cpu.read_mem == read_mem)
+    m = c.maps[0]
+    my_assert(m[0] == codecoverage.START | codecoverage.EXECUTED)
+    my_assert(m[1] == codecoverage.EXECUTED)
+    my_assert(m[0x0f] == codecoverage.START | codecoverage.EXECUTED)
+    my_assert(m[0x14] == codecoverage.READ)
+    my_assert(m[0x15] == 0)
+    my_assert(m[0x0100] == codecoverage.READ)
+    my_assert(m[0x0101] == codecoverage.WRITTEN)
+    my_assert(m[0x0200] == codecoverage.READ and m[0x0201] == codecoverage.READ and m[0x0202] == 0)
+    my_assert(m[0x0300] == codecoverage.WRITTEN and m[0x0301] == codecoverage.WRITTEN)
+    listing = c.listing(0)
+    my_assert(listing[0] == '0000  3a 00 01     X--')
+    my_assert(listing[5] == '000f  ed b0        X--')
+    my_assert(listing[6] == '0011  3a 14 00     X--')
+    my_assert(listing[7] == '0014               -R-')
+    my_assert(listing[8] == '')
+    my_assert(listing[9] == '0100               -R-')
+    fh = tempfile.NamedTemporaryFile()
+    c.export(fh.name)
+    other = codecoverage.codecoverage()
+    other.load(fh.name)
+    my_assert(other.maps[0] == m)
+    my_assert(other.listing(0) == listing)
+
+def test_cpm():
+    directory = tempfile.TemporaryDirectory()
+    program = directory.name + '/test.com'
+    open(program, 'wb').write(bytes([ 0x11, 0x4c, 0x01, 0x0e, 0x09, 0xcd, 0x05, 0x00, # LD DE,014c / LD C,9 / CALL 5 (print)
+        0x11, 0x5c, 0x00, 0x0e, 0x16, 0xcd, 0x05, 0x00, # LD DE,005c / LD C,22 / CALL 5 (make)
+        0x11, 0x00, 0x02, 0x0e, 0x1a, 0xcd, 0x05, 0x00, # LD DE,0200 / LD C,26 / CALL 5 (DMA)
+        0x11, 0x5c, 0x00, 0x0e, 0x15, 0xcd, 0x05, 0x00, # LD DE,005c / LD C,21 / CALL 5 (write)
+        0x11, 0x5c, 0x00, 0x0e, 0x10, 0xcd, 0x05, 0x00, # LD DE,005c / LD C,16 / CALL 5 (close)
+        0x3e, 0x00, 0x32, 0x7c, 0x00, # LD A,0 / LD (007c),A (first record)
+        0x11, 0x00, 0x03, 0x0e, 0x1a, 0xcd, 0x05, 0x00, # LD DE,0300 / LD C,26 / CALL 5 (DMA)
+        0x11, 0x5c, 0x00, 0x0e, 0x14, 0xcd, 0x05, 0x00, 0x32, 0x00, 0x04, # LD DE,005c / LD C,20 / CALL 5 (read) / LD (0400),A
+        0x11, 0x5c, 0x00, 0x0e, 0x14, 0xcd, 0x05, 0x00, 0x32, 0x01, 0x04, # the same, at the end of the file / LD (0401),A
+        0xc9 ]) + b'hi$') # RET (warm boot)
+    data = [ (i * 7) & 0xff for i in range(128) ]
+
+    for compiled in (False, True):
+        out = textio.StringIO()
+        machine = cpm(directory.name, textio.StringIO(), out, compiled)
+        machine.load(program, [ 'out.txt' ])
+        my_assert(machine.ram[0x005c:0x0068] == [ 0 ] + [ ord(c) for c in 'OUT     TXT' ])
+        my_assert(machine.ram[0x0080:0x0089] == [ 8 ] + [ ord(c) for c in ' OUT.TXT' ])
+        machine.ram[0x0200:0x0280] = data
+        my_assert(machine.run(1000000))
+        my_assert(out.getvalue() == 'hi')
+        my_assert(list(open(directory.name + '/out.txt', 'rb').read()) == data)
+        my_assert(machine.ram[0x0300:0x0380] == data)
+        my_assert(machine.ram[0x0400] == 0)
+        my_assert(machine.ram[0x0401] == 1)
+
+    # code that is read over code that was executed before
+    open(directory.name + '/code.bin', 'wb').write(bytes([ 0x3e, 0x02, 0xc9 ])) # LD A,2 / RET
+    open(program, 'wb').write(bytes([ 0xcd, 0x00, 0x03, 0x32, 0x00, 0x04, # CALL 0300 / LD (0400),A
+        0x11, 0x00, 0x03, 0x0e, 0x1a, 0xcd, 0x05, 0x00, # LD DE,0300 / LD C,26 / CALL 5 (DMA)
+        0x11, 0x5c, 0x00, 0x0e, 0x0f, 0xcd, 0x05, 0x00, # LD DE,005c / LD C,15 / CALL 5 (open)
+        0x11, 0x5c, 0x00, 0x0e, 0x14, 0xcd, 0x05, 0x00, # LD DE,005c / LD C,20 / CALL 5 (read)
+        0xcd, 0x00, 0x03, 0x32, 0x01, 0x04, # CALL 0300 / LD (0401),A
+        0xc9 ])) # RET (warm boot)
+
+    for compiled in (False, True):
+        machine = cpm(directory.name, textio.StringIO(), textio.StringIO(), compiled)
+        machine.load(program, [ 'code.bin' ])
+        machine.ram[0x0300:0x0303] = [ 0x3e, 0x01, 0xc9 ] # LD A,1 / RET
+        my_assert(machine.run(1000000))
+        my_assert(machine.ram[0x0400] == 1)
+        my_assert(machine.ram[0x0401] == 2)
+
+    # wildcards, in the FCB as CP/M pads them
+    machine = cpm(directory.name, textio.StringIO(), textio.StringIO())
+    machine.ram[0x0100:0x010c] = [ 0 ] + [ ord(c) for c in '????????COM' ]
+    my_assert(machine.matching(machine.fcb_pattern(0x0100)) == [ 'test.com' ])
+    machine.ram[0x0100:0x010c] = [ 0 ] + [ ord(c) for c in 'OUT     ???' ]
+    my_assert(machine.matching(machine.fcb_pattern(0x0100)) == [ 'out.txt' ])
+    machine.ram[0x0100:0x010c] = [ 0 ] + [ ord(c) for c in 'OU      ???' ]
+    my_assert(machine.matching(machine.fcb_pattern(0x0100)) == [ ])
+
+    # a string without a '$' ends after all of memory
+    out = textio.StringIO()
+    machine = cpm(directory.name, textio.StringIO(), out)
+    machine.ram[0x0000:0x10000] = [ ord('x') ] * 0x10000
+    machine.print_string(0x0100)
+    my_assert(out.getvalue() == 'x' * 0x10000)
+
+    # a program that does not end
+    open(program, 'wb').write(bytes([ 0x18, 0xfe ])) # JR $
+    machine = cpm(directory.name, textio.StringIO(), textio.StringIO())
+    machine.load(program)
+    my_assert(not machine.run(10000))
+
 def test_cpl():
     # CPL
     reset_mem()
@@ -1164,6 +1335,8 @@ def test_out_in():
     cpu.a = 123
     ram0[0] = 0xdb
     ram0[1] = 0x00
+    # written behind the back of the CPU
+    cpu.flush_decoded()
     cpu.step()
     my_assert(cpu.a == 0xf0)
     my_assert(cpu.f == 0x00)
@@ -2055,39 +2228,804 @@ def test_srl():
     my_assert(cpu.f == 0x01)
     my_assert(cpu.pc == 2)
 
-cpu = z80(read_mem, write_mem, read_io, write_io, debug)
-
-test__flags()
-test__support()
-test_add()
-test_and()
-test_bit()
-test_call_ret()
-test_ccf()
-test_cp_cpir()
-test_cpl()
-test_dec()
-test_di_ei()
-test_djnz()
-test_ex()
-test_inc()
-test_jp()
-test_jr()
-test_ld()
-test_ldi_r()
-test_nop()
-test_or()
-test_out_in()
-test_push_pop()
-test_res()
-test_rlca_rlc_rl_rla()
-test_rr()
-test_rrca()
-test_rst()
-test_set()
-test_sla()
-test_srl()
-test_sub()
-test_xor()
+def segment_cpu():
+    # a CPU with 4 RAM segments, mapped as set in the returned layout
+    segments = [ [ 0 ] * 16384 for i in range(4) ]
+    layout = [ ('ram', 0), ('ram', 1), ('ram', 2), ('ram', 3) ]
+    def read(a):
+        return segments[layout[a >> 14][1]][a & 0x3fff]
+    def write(a, v):
+        segments[layout[a >> 14][1]][a & 0x3fff] = v
+    mapped = z80(read, write, read_io, write_io, debug, cpu.screen)
+    mapped.set_memory_layout(tuple(layout))
+    return (mapped, segments, layout)
+
+def test_blocks():
+    reset_mem()
+    cpu.reset()
+    cpu.enable_blocks()
+    cpu.f = 0
+    ram0[0] = 0x21 # LD HL,0006
+    ram0[1] = 0x06
+    ram0[2] = 0x00
+    ram0[3] = 0x36 # LD (HL),07 (patches the operand of the next instruction)
+    ram0[4] = 0x07
+    ram0[5] = 0x06 # LD B,00
+    ram0[6] = 0x00
+    ram0[7] = 0xc3 # JP 0100
+    ram0[8] = 0x00
+    ram0[9] = 0x01
+    my_assert(cpu.step_block() == 20)
+    my_assert(cpu.pc == 5)
+    my_assert(cpu.step_block() == 17)
+    my_assert(cpu.b == 7)
+    my_assert(cpu.h == 0x00)
+    my_assert(cpu.l == 0x06)
+    my_assert(cpu.pc == 0x0100)
+    my_assert(cpu.f == 0)
+    cpu.disable_blocks()
+    # a segment that is mapped at two addresses
+    mapped, segments, layout = segment_cpu()
+    layout[1] = ('ram', 2)
+    mapped.set_memory_layout(tuple(layout))
+    mapped.enable_blocks()
+    segments[2][0:5] = [ 0x3e, 0x01, 0xc3, 0x00, 0x80 ] # LD A,01 / JP 8000
+    mapped.pc = 0x8000
+    mapped.step_block()
+    my_assert(mapped.a == 0x01)
+    mapped.write_mem(0x4001, 0x05)
+    mapped.step_block()
+    my_assert(mapped.a == 0x05)
+    # code that cannot be compiled is executed as is
+    mapped.blocks.compile = lambda pc: None
+    mapped.write_mem(0x8001, 0x06)
+    my_assert(mapped.step_block() == 7)
+    my_assert(mapped.a == 0x06)
+    my_assert(mapped.pc == 0x8002)
+    my_assert(mapped.run_block(10) == 10)
+    my_assert(mapped.pc == 0x8000)
+
+def test_decode():
+    reset_mem()
+    cpu.reset()
+    ram0[0] = 0x3e # LD A,01
+    ram0[1] = 0x01
+    ram0[2] = 0x18 # JR 0000
+    ram0[3] = 0xfc
+    my_assert(cpu.step() == 7)
+    my_assert(cpu.a == 0x01)
+    my_assert(cpu.step() == 12)
+    my_assert(cpu.pc == 0x0000)
+    cpu.write_mem(0x0001, 0x02) # patch the decoded instruction
+    my_assert(cpu.step() == 7)
+    my_assert(cpu.a == 0x02)
+    my_assert(cpu.pc == 0x0002)
+    # a segment that is mapped at two addresses
+    mapped, segments, layout = segment_cpu()
+    segments[2][0:2] = [ 0x3e, 0x01 ] # LD A,01
+    mapped.pc = 0x8000
+    mapped.step()
+    my_assert(mapped.a == 0x01)
+    layout[1] = ('ram', 2)
+    mapped.set_memory_layout(tuple(layout))
+    mapped.write_mem(0x4001, 0x05)
+    mapped.pc = 0x8000
+    mapped.step()
+    my_assert(mapped.a == 0x05)
+    # after a reset the memory is decoded again
+    segments[2][1] = 0x06
+    mapped.reset()
+    mapped.set_memory_layout(tuple(layout))
+    mapped.pc = 0x4000
+    mapped.step()
+    my_assert(mapped.a == 0x06)
+
+def test_batch_run():
+    reset_mem()
+    cpu.reset()
+    ram0[0] = 0x3e # LD A,01
+    ram0[1] = 0x01
+    ram0[2] = 0x3c # INC A
+    ram0[3] = 0x18 # JR 0002
+    ram0[4] = 0xfd
+    my_assert(cpu.run(20) == 7 + 4 + 12)
+    my_assert(cpu.pc == 0x0002)
+    my_assert(cpu.run(100, 0x0003) == 4)
+    my_assert(cpu.a == 0x03)
+    my_assert(cpu.run(100, 0x0003) == 0)
+
+def test_bc_de_hl():
+    cpu.reset()
+    cpu.bc = 0x1234
+    my_assert(cpu.b == 0x12)
+    my_assert(cpu.c == 0x34)
+    cpu.h = 0x56
+    cpu.l = 0x78
+    my_assert(cpu.hl == 0x5678)
+    cpu.e_ = 0x9a
+    my_assert(cpu.de_ == 0xff9a)
+    my_assert(cpu.get_pair(2) == (0x5678, 'HL'))
+
+def test_events():
+    reset_mem()
+    cpu.reset()
+    for i in range(0, 5):
+        ram0[i] = 0x00 # NOP
+    fired = []
+    start = cpu.scheduler.now
+    cpu.scheduler.add(start + 10, lambda when: fired.append(when))
+    event = cpu.scheduler.add(start + 5, lambda when: fired.append(-1))
+    cpu.scheduler.cancel(event)
+    my_assert(cpu.run(8) == 8) # 2x NOP
+    my_assert(fired == [])
+    cpu.run(8)
+    my_assert(fired == [ start + 10 ])
+    cpu.scheduler.post(lambda when: fired.append(when))
+    cpu.step()
+    my_assert(fired == [ start + 10, start + 16 ])
+
+def test_flag_tables():
+    other = z80(read_mem, write_mem, read_io, write_io, debug, cpu.screen)
+    my_assert(other.add_lookup is cpu.add_lookup)
+    reset_mem()
+    cpu.reset()
+    ram0[0] = 0x3e # LD A,99
+    ram0[1] = 0x99
+    ram0[2] = 0xc6 # ADD A,01
+    ram0[3] = 0x01
+    ram0[4] = 0x27 # DAA
+    cpu.step()
+    cpu.step()
+    my_assert(cpu.a == 0x9a)
+    my_assert(cpu.f == 0x88)
+    cpu.step()
+    my_assert(cpu.a == 0x00)
+    my_assert(cpu.f == 0x55)
+
+def test_generated():
+    reset_mem()
+    cpu.reset()
+    interpreted = z80(read_mem, write_mem, read_io, write_io, debug, cpu.screen, generated=False)
+    my_assert(cpu.main_jumps[0x3c].__name__ == 'main_3c')
+    my_assert(interpreted.main_jumps[0x3c].__name__ != 'main_3c')
+    ram0[0] = 0x3e # LD A,7f
+    ram0[1] = 0x7f
+    ram0[2] = 0x3c # INC A
+    ram0[3] = 0xdd # LD IXH,A
+    ram0[4] = 0x67
+    ram0[5] = 0xed # NEG
+    ram0[6] = 0x44
+    for i in range(4):
+        my_assert(cpu.step() == interpreted.step())
+        my_assert(cpu.a == interpreted.a)
+        my_assert(cpu.f == interpreted.f)
+        my_assert(cpu.ix == interpreted.ix)
+
+def test_get_set_state():
+    reset_mem()
+    # NOP, NOP, JR 0 so that run() does not depend on what the tests before left in memory
+    ram0[0:4] = [ 0x00, 0x00, 0x18, 0xfc ]
+    cpu.reset()
+    cpu.a = 0x12
+    cpu.bc = 0x3456
+    cpu.pc = 0x1234
+    cpu.halted = True
+    ram = memmap(4, debug)
+    ram.ram[1][5] = 0x77
+    ram.write_io(0xfd, 1)
+    devices = [ ('cpu', cpu.get_state, cpu.set_state), ('ram', ram.get_state, ram.set_state) ]
+    data = savestate.dump(devices)
+    now = cpu.scheduler.now
+    next_frame = cpu.frame_event[0]
+    cpu.a = 0x00
+    cpu.pc = 0x0000
+    cpu.halted = False
+    cpu.run(1000)
+    ram.ram[1][5] = 0x00
+    ram.write_io(0xfd, 2)
+    savestate.restore(data, devices)
+    my_assert(cpu.a == 0x12)
+    my_assert(cpu.bc == 0x3456)
+    my_assert(cpu.pc == 0x1234)
+    my_assert(cpu.halted)
+    my_assert(cpu.scheduler.now == now)
+    my_assert(cpu.frame_event[0] == next_frame)
+    my_assert(ram.ram[1][5] == 0x77)
+    my_assert(ram.mapper == [ 3, 1, 1, 0 ])
+    for bad in (b'', b'x' * 100, data[0:8] + b'\x02\x00\x00\x00' + data[12:]):
+        try:
+            savestate.restore(bad, devices)
+            my_assert(False)
+        except ValueError:
+            pass
+    try:
+        savestate.restore(data, devices[0:1])
+        my_assert(False)
+    except ValueError:
+        pass
+    cpu.halted = False
+
+def test_boot_cache():
+    reset_mem()
+    cpu.reset()
+    directory = tempfile.TemporaryDirectory()
+    rom_file = directory.name + '/rom'
+    open(rom_file, 'wb').write(b'\x01\x02')
+    key = quickboot.config_key([ '-R 1:0' ], [ rom_file ])
+    my_assert(key == quickboot.config_key([ '-R 1:0' ], [ rom_file ]))
+    my_assert(key != quickboot.config_key([ '-R 2:0' ], [ rom_file ]))
+    open(rom_file, 'wb').write(b'\x01\x03')
+    my_assert(key != quickboot.config_key([ '-R 1:0' ], [ rom_file ]))
+    cache = quickboot.quickboot(directory.name + '/cache', key)
+    my_assert(cache.load() is None)
+    ram0[0] = 0xc3 # JP 009f
+    ram0[1] = 0x9f
+    ram0[2] = 0x00
+    ram0[0x9f] = 0x00 # NOP
+    cpu.add_hook(cache)
+    cpu.step()
+    my_assert(not cache.reached)
+    cpu.step()
+    my_assert(cache.reached)
+    cpu.remove_hook(cache)
+    cache.store(b'state')
+    my_assert(cache.load() == b'state')
+
+def test_rewind():
+    ram = memmap(4, debug)
+    machine = [ 1 ]
+    devices = [ ('machine', lambda: bytes(machine), lambda data: machine.__setitem__(0, data[0])), ('ram', ram.get_state, ram.set_state) ]
+    paged = { 'ram': ram.get_state_pages }
+    states = rewind(3)
+    states.take(devices, paged)
+    my_assert(states.memory_used() == 1 + 4 + 4 * 16384)
+    ram.write_io(0xfc, 2)
+    ram.write_mem(0x0010, 0x55) # page 2
+    machine[0] = 2
+    states.take(devices, paged)
+    my_assert(states.memory_used() == 2 * (1 + 4) + 5 * 16384) # only page 2 is new
+    ram.ram[1][0] = 0x66 # not through write_mem: not seen
+    ram.write_mem(0x0011, 0x77)
+    machine[0] = 3
+    my_assert(states.back(devices))
+    my_assert(machine[0] == 2)
+    my_assert(ram.mapper == [ 2, 2, 1, 0 ])
+    my_assert(ram.ram[2][0x10] == 0x55 and ram.ram[2][0x11] == 0x00)
+    my_assert(ram.ram[1][0] == 0x00) # restored anyway
+    states.take(devices, paged) # the same as the one before
+    my_assert(states.memory_used() == 2 * (1 + 4) + 5 * 16384)
+    my_assert(len(states) == 2)
+    my_assert(states.back(devices))
+    my_assert(states.back(devices))
+    my_assert(machine[0] == 1)
+    my_assert(ram.mapper == [ 3, 2, 1, 0 ] and ram.ram[2][0x10] == 0x00)
+    my_assert(not states.back(devices))
+
+def test_throttle():
+    now = [ 10.0 ]
+    slept = []
+    def sleep(t):
+        slept.append(t)
+        now[0] += t
+    pacer = throttle(1000000, 20000, 1.0, lambda: now[0], sleep)
+    pacer.restart(5000)
+    pacer.pace(505000) # half a second ahead
+    my_assert(slept == [ 0.5 ])
+    my_assert(pacer.report(505000) is None) # not a second yet
+    now[0] += 0.75 # behind, catches up
+    pacer.pace(1005000)
+    my_assert(len(slept) == 1)
+    now[0] += 1.0 # too far behind: does not catch up
+    pacer.pace(1010000)
+    my_assert(len(slept) == 1)
+    pacer.pace(1110000)
+    my_assert(abs(slept[1] - 0.1) < 0.0001)
+    my_assert(pacer.report(2005000) == '0.85 MHz, 42.6 fps (85%)')
+    pacer.pace(1000) # went back
+    my_assert(len(slept) == 2)
+    turbo = throttle(1000000, 20000, None, lambda: now[0], sleep)
+    turbo.pace(10000000)
+    my_assert(len(slept) == 2)
+    now[0] += 2.0
+    my_assert(turbo.report(10000000) == '5.00 MHz, 250.0 fps (500%)')
+    fast = z80(read_mem, write_mem, read_io, write_io, debug, cpu.screen, hz=60)
+    my_assert(fast.frame_cycles == 3579545 // 60 + 1)
+
+def test_tracer():
+    fh = tempfile.NamedTemporaryFile()
+    for bad in ('verbose', 'cpu:loud', 'cpu:debug:x'):
+        log = tracer.tracer()
+        try:
+            log.open(fh.name, bad)
+            my_assert(False)
+        except ValueError as e:
+            my_assert(str(e) == 'Invalid trace level "%s", the levels are off, error, info, debug' % bad)
+        my_assert(log.fh is None and log.levels == {})
+    log = tracer.tracer()
+    log.open(fh.name, 'info,cpu:debug')
+    my_assert(log.enabled('cpu') and log.enabled('disk', tracer.INFO) and not log.enabled('disk'))
+    log.close()
+
+def test_debugger():
+    reset_mem()
+    cpu.reset()
+    ram0[0:10] = [ 0x00, 0x3e, 0x12, 0x32, 0x00, 0x30, 0xd3, 0x98, 0x00, 0x00 ] # NOP, LD A,12, LD (3000),A, OUT (98),A, NOP, NOP
+    dbg = debugger.debugger(cpu)
+    read_mem_before = cpu.read_mem
+    dbg.add_breakpoint(0x0001)
+    my_assert(cpu.read_mem == read_mem_before and cpu.memory_hooks == 0) # nothing on the memory accesses
+    try:
+        cpu.run(1000)
+        my_assert(False)
+    except debugger.break_hit as e:
+        my_assert(str(e) == 'breakpoint at 0001')
+    my_assert(cpu.pc == 0x0001)
+    dbg.add_watchpoint(0x3000, 0x30ff, debugger.WRITE)
+    my_assert(cpu.memory_hooks == 1)
+    my_assert(cpu.read_mem == read_mem_before) # only writes are watched
+    my_assert(cpu.hooked_pages == [ 1, 0, 0, 0 ])
+    try:
+        cpu.run(1000) # continues
+        my_assert(False)
+    except debugger.break_hit as e:
+        my_assert(str(e) == 'write 12 at 3000 (0)')
+    my_assert(cpu.pc == 0x0006) # after the instruction
+    my_assert(ram0[0x3000] == 0x12)
+    dbg.add_io_watchpoint(0x98, debugger.WRITE)
+    my_assert(cpu.step() == 11)
+    try:
+        cpu.step()
+        my_assert(False)
+    except debugger.break_hit as e:
+        my_assert(str(e) == 'I/O write 12 to port 98')
+    my_assert(dbg.list() == [ 'breakpoint 0001', 'watchpoint 3000-30ff w', 'I/O watchpoint 98 w' ])
+    dbg.delete(1)
+    dbg.add_watchpoint(0x3000, 0x30ff, debugger.WRITE, (1, 0)) # not this bank
+    dbg.delete(0)
+    dbg.delete(0)
+    cpu.pc = 0
+    cpu.run(23)
+    my_assert(cpu.pc == 0x0006)
+    dbg.clear()
+    my_assert(cpu.read_mem == read_mem_before and cpu.memory_hooks == 0 and cpu.write_io == write_io and not cpu.hooks)
+    out = textio.StringIO()
+    my_assert(debugger.console(dbg, textio.StringIO('b 8\nl\nm 1 3\nc\n'), out))
+    my_assert(out.getvalue().split('\n')[1:4] == [ '> > 0 breakpoint 0008', '> 0001 3e 12 32', '> ' ])
+    my_assert(not debugger.console(dbg, textio.StringIO('s 2\nq\n'), out))
+    my_assert(cpu.pc == 0x0008)
+    dbg.clear()
+    # what was hooked in after the watchpoints stays when these are removed
+    dbg.add_watchpoint(0x3000)
+    c = codecoverage.codecoverage()
+    c.start(cpu)
+    dbg.clear()
+    my_assert(cpu.read_mem == c.counted_read_mem and c.read_mem == read_mem_before and c.bus_write_mem == write_mem)
+    c.stop()
+    my_assert(cpu.read_mem == read_mem_before and cpu.bus_write_mem == write_mem and cpu.memory_hooks == 0)
+    # LDIR still copies at once outside the 16KB pages with a watchpoint
+    for start, copied_at_once in ((0x8000, True), (0x0000, False)):
+        reset_mem()
+        ram0[0:2] = [ 0xed, 0xb0 ] # LDIR
+        cpu.reset()
+        cpu.set_memory_layout((0, 1, 2, 3), [ (ram0, 0, True), None, None, None ])
+        reads = []
+        cpu.read_mem = lambda a: reads.append(a) or read_mem(a)
+        dbg.add_watchpoint(start, start + 0xff, debugger.READ)
+        cpu.hl = 0x0100
+        cpu.de = 0x0200
+        cpu.bc = 0x0100
+        cpu.run(100000, 0x0002)
+        my_assert(ram0[0x0200:0x0300] == ram0[0x0100:0x0200] and cpu.bc == 0)
+        my_assert((len(reads) < 10) == copied_at_once)
+        dbg.clear()
+        cpu.read_mem = read_mem
+    cpu.set_memory_layout((0, 1, 2, 3))
+    my_assert(cpu.hooked_pages == [ 0, 0, 0, 0 ])
+
+def test_pc_hooks():
+    reset_mem()
+    cpu.reset()
+    ram0[0:6] = [ 0x3e, 0x03, 0xcd, 0x00, 0x10, 0x00 ] # LD A,3, CALL 1000, NOP
+    ram0[0x1000] = 0xc9 # RET
+    cpu.sp = 0x2000
+    cpu.bc = 0x1234
+    ram0[0x1234] = 0x56
+    condition = pchooks.compile_condition('pc == 0x1000 and a == 3 and b == 0x12 and c == 0x34 and mem(bc) == 0x56 and slots == 0xf0', cpu, { 'slots': lambda: 0xf0 })
+    cpu.pc = 0x1000
+    cpu.a = 3
+    my_assert(condition())
+    cpu.a = 4
+    my_assert(not condition())
+    for bad in ('a ==', 'x == 1', 'slots == 0xf0'):
+        try:
+            pchooks.compile_condition(bad, cpu)
+            my_assert(False)
+        except ValueError:
+            pass
+    calls = []
+    def bios(cpu):
+        calls.append((cpu.pc, cpu.a))
+        return cpu._ret(True, '') # instead of the RET there
+    def seen(cpu):
+        calls.append(cpu.pc)
+    hooks = pchooks.pc_hooks(cpu)
+    cpu.add_hook(hooks)
+    hooks.add(0x1000, bios, 'a == 4')
+    hooks.add(0x0002, seen)
+    cpu.pc = 0x0000
+    cpu.run(1000, 0x0005)
+    my_assert(calls == [ 0x0002 ]) # condition does not hold
+    hooks.add(0x1000, bios, 'a == 3')
+    cpu.pc = 0x0000
+    cpu.run(1000, 0x0005)
+    my_assert(calls == [ 0x0002, 0x0002, (0x1000, 3) ])
+    my_assert(cpu.sp == 0x2000)
+    hooks.remove(0x1000)
+    hooks.remove(0x0002, seen)
+    my_assert(hooks.table == {})
+    cpu.remove_hook(hooks)
+    dbg = debugger.debugger(cpu)
+    dbg.add_breakpoint(0x1000, 'a == 4')
+    cpu.pc = 0x0000
+    my_assert(cpu.run(1000, 0x0005) == 7 + 17 + 10)
+    dbg.add_breakpoint(0x1000, 'a == 3')
+    my_assert(dbg.list()[1] == 'breakpoint 1000 if a == 3')
+    cpu.pc = 0x0000
+    try:
+        cpu.run(1000, 0x0005)
+        my_assert(False)
+    except debugger.break_hit:
+        pass
+    my_assert(cpu.pc == 0x1000)
+    dbg.clear()
+
+class fake_vdp:
+    # logs the accesses of the VRAM data port
+    def __init__(self):
+        self.log = []
+        self.next = 0
+        self.bulk = 0
+    def interrupt(self):
+        return False
+    def read_io(self, a):
+        self.log.append(('in', a))
+        self.next = (self.next + 7) & 0xff
+        return self.next
+    def write_io(self, a, v):
+        self.log.append(('out', a, v))
+    def read_data(self, n):
+        self.bulk += 1
+        return bytes([ self.read_io(0x98) for i in range(n) ])
+    def write_data(self, data):
+        self.bulk += 1
+        for v in data:
+            self.write_io(0x98, v)
+
+def test_bios_vram():
+    rom = open('msxbiosbasic.rom', 'rb').read()
+    results = []
+    for hle in (False, True):
+        vdp = fake_vdp()
+        vcpu = z80(read_mem, write_mem, vdp.read_io, vdp.write_io, debug, vdp)
+        bios = biosvram.bios_vram(vcpu, vdp)
+        hooks = pchooks.pc_hooks(vcpu)
+        ram0[0:16384] = [ 0 ] * 16384
+        my_assert(not bios.matches())
+        ram0[0:16384] = rom[0:16384]
+        if hle:
+            my_assert(bios.matches())
+            bios.install(hooks)
+            vcpu.add_hook(hooks)
+        for i in range(0x200):
+            ram0[0x3000 + i] = (i * 3) & 0xff
+        state = []
+        # LDIRVM, LDIRMV and FILVRM, crossing an event and with BC 1
+        for entry, hl, de, bc in ((0x005c, 0x3000, 0x1234, 0x0180), (0x0059, 0x0800, 0x3200, 0x0100), (0x0056, 0x2000, 0, 0x0200), (0x005c, 0x3000, 0x0000, 0x0001)):
+            vcpu.sp = 0x3f00
+            vcpu.push(0x3e00)
+            vcpu.pc = entry
+            vcpu.a = 0x5a
+            vcpu.hl = hl
+            vcpu.de = de
+            vcpu.bc = bc
+            vcpu.r = 0x7e
+            vcpu.scheduler.add_in(3000, lambda when: None)
+            start = vcpu.scheduler.now
+            vcpu.run(1000000, 0x3e00)
+            state.append((vcpu.a, vcpu.f, vcpu.bc, vcpu.de, vcpu.hl, vcpu.sp, vcpu.r, vcpu.memptr, vcpu.interrupts, vcpu.scheduler.now - start))
+        results.append((state, vdp.log, ram0[0x3000:0x3400]))
+        my_assert((vdp.bulk > 3) == hle) # split by the events
+    my_assert(results[0] == results[1])
+    my_assert(len(results[0][1]) == 0x180 + 2 + 0x100 + 2 + 0x200 + 2 + 1 + 2)
+    ram0[0:16384] = [ 0 ] * 16384
+
+def test_fuzzer():
+    generated = fuzzer.generate((1, 0, 50, fuzzer.tables))
+    my_assert(generated == fuzzer.generate((1, 0, 50, fuzzer.tables)))
+    my_assert(generated != fuzzer.generate((2, 0, 50, fuzzer.tables)))
+    directory = tempfile.TemporaryDirectory()
+    filename = directory.name + '/tests.json'
+    with open(filename, 'w') as fh:
+        my_assert(fuzzer.write_tests(fh, iter([ generated[0:20], generated[20:] ])) == 50)
+    tests = list(fuzzer.read_tests(filename))
+    my_assert(tests == [ json.loads(test) for test in generated ])
+    my_assert([ len(batch) for batch in fuzzer.batches(tests, 20) ] == [ 20, 20, 10 ])
+    my_assert(fuzzer.check((filename, tests)) == (50, 0, []))
+    # the jsmoo layout: all on one line, with the cycles
+    tests[0]['final']['pc'] ^= 1
+    tests[1]['cycles'] = [ [ None, None, '----' ] ] * 99
+    pc = tests[2]['initial']['pc']
+    tests[2]['initial']['ram'] = [ [ pc, 0x76 ] ] # HALT
+    with open(filename, 'w') as fh:
+        json.dump(tests, fh)
+    n, skipped, failures = fuzzer.check((filename, list(fuzzer.read_tests(filename))))
+    my_assert(n == 49 and skipped == 1 and len(failures) == 2)
+    my_assert(', Item pc failed' in failures[0] and ', Item cycles failed' in failures[1])
+    # generated tests hold what the instruction reads and the cycles
+    tests = [ json.loads(test) for test in fuzzer.generate((1, 0, 2000, fuzzer.tables)) ]
+    my_assert(all(len(test['cycles']) > 0 and 'r' not in test['final'] for test in tests))
+    my_assert(any(test['ports'] for test in tests))
+    t = fuzzer.tester()
+    missing = []
+    t.cpu.read_mem = t.cpu.fetch_mem = lambda a: t.memory[a] if a in t.memory else missing.append(a) or 0
+    t.cpu.read_io = lambda a: t.ports[a] if a in t.ports else missing.append(a) or 0
+    my_assert(all(result is not None and fuzzer.compare(test, *result) == [] for test, result in zip(tests, fuzzer.run_tests(t, tests))))
+    my_assert(missing == [])
+
+def test_halt():
+    reset_mem()
+    cpu.reset()
+    ram0[0] = 0x76 # HALT
+    ram0[0x38] = 0x00 # NOP
+    cpu.sp = 0x1000
+    n = (cpu.scheduler.deadline - cpu.scheduler.now + 3) // 4
+    my_assert(cpu.step() == n * 4) # up to the next frame at once
+    my_assert(cpu.pc == 0x0000)
+    my_assert(cpu.r == n & 0x7f)
+    cpu.interrupt()
+    my_assert(cpu.step() == 4)
+    my_assert(cpu.pc == 0x0039)
+    my_assert(cpu.pop() == 0x0001) # continues after the HALT
+
+def test_idle():
+    results = []
+    for idle_ports in (None, {}):
+        reset_mem()
+        ram0[0x100] = 0x00
+        ram0[0] = 0x3a # LD A,(0100)
+        ram0[1] = 0x00
+        ram0[2] = 0x01
+        ram0[3] = 0xb7 # OR A
+        ram0[4] = 0x28 # JR Z,0000
+        ram0[5] = 0xfa
+        waiter = z80(read_mem, write_mem, read_io, write_io, debug, cpu.screen, idle_ports=idle_ports)
+        waiter.set_memory_layout((0, 1, 2, 3), [ (ram0, 0, True), None, None, None ])
+        waiter.scheduler.add(50000, lambda when: write_mem(0x100, 0x01))
+        results.append((waiter.run(100000, 0x0006), waiter.pc, waiter.scheduler.now, waiter.idle_cycles))
+
+    my_assert(results[0][0:3] == results[1][0:3])
+    my_assert(results[0][1] == 0x0006)
+    my_assert(results[0][3] == 0)
+    my_assert(results[1][3] > 45000)
+
+    # waiting for a port, which can change without an event while its
+    # check returns False
+    results = []
+    for by_events in (True, False):
+        reset_mem()
+        io[0x99] = 0
+        ram0[0] = 0xdb # IN A,(99)
+        ram0[1] = 0x99
+        ram0[2] = 0xb7 # OR A
+        ram0[3] = 0x28 # JR Z,0000
+        ram0[4] = 0xfb
+        waiter = z80(read_mem, write_mem, read_io, write_io, debug, cpu.screen, idle_ports={ 0x99: lambda: by_events })
+        # what the loop fetches is not seen by memory hooks
+        reads = []
+        waiter.read_mem = lambda a: reads.append(a) or read_mem(a)
+        waiter.scheduler.add(50000, lambda when: write_io(0x99, 0x01))
+        results.append((waiter.run(100000, 0x0005), waiter.pc, waiter.idle_cycles, len(reads)))
+
+    io[0x99] = 0
+    my_assert(results[0][0:2] == results[1][0:2])
+    my_assert(results[0][1] == 0x0005)
+    my_assert(results[0][2] > 45000)
+    my_assert(results[1][2] == 0)
+    my_assert(results[0][3] == results[1][3] == 0)
+
+    # polling memory that is not plain RAM or ROM (a device sees the reads)
+    results = []
+    for direct in (None, [ 0 ] * 16384):
+        reset_mem()
+        ram0[0:7] = [ 0x21, 0x00, 0x40, # LD HL,4000
+                      0x7e,             # LD A,(HL)
+                      0xb7,             # OR A
+                      0x28, 0xfc ]      # JR Z,0003
+        device = [ 0, 0 ] # what it returns, the number of reads
+
+        def read_device(a):
+            if a == 0x4000:
+                device[1] += 1
+                return device[0]
+
+            return read_mem(a)
+
+        def ready(when):
+            device[0] = 1
+
+            if direct:
+                direct[0] = 1
+
+        waiter = z80(read_device, write_mem, read_io, write_io, debug, cpu.screen, idle_ports={})
+        waiter.set_memory_layout((0, 1, 2, 3), [ (ram0, 0, True), None if direct is None else (direct, 0, False), None, None ])
+        waiter.scheduler.add(50000, ready)
+        results.append((waiter.run(100000, 0x0007), waiter.pc, waiter.idle_cycles, device[1]))
+
+    my_assert(results[0][0:2] == results[1][0:2])
+    my_assert(results[0][1] == 0x0007)
+    my_assert(results[0][2] == 0 and results[0][3] > 1000)
+    my_assert(results[1][2] > 45000 and results[1][3] < 10)
+
+def test_debug_trace():
+    reset_mem()
+    ram0[0] = 0x00 # NOP
+    ram0[1] = 0x00 # NOP
+    messages = []
+    traced = z80(read_mem, write_mem, read_io, write_io, messages.append, cpu.screen)
+    my_assert(traced.main_jumps[0x00].__name__ == 'main_00')
+    traced.set_trace(True)
+    my_assert(traced.main_jumps[0x00].__name__ == '_nop')
+    traced.step()
+    my_assert(messages == [ '0000 NOP' ])
+    traced.set_trace(False)
+    traced.step()
+    my_assert(messages == [ '0000 NOP' ])
+
+def test_counters():
+    reset_mem()
+    cpu.reset()
+    p = profiler()
+    cpu.set_profiler(p)
+    ram0[0] = 0x3c # INC A
+    ram0[1] = 0xed # NEG
+    ram0[2] = 0x44
+    ram0[3] = 0x18 # JR 0000
+    ram0[4] = 0xfb
+    my_assert(cpu.run(2 * (4 + 8 + 12)) == 2 * (4 + 8 + 12))
+    my_assert(p.counts['main'][0x3c] == 2)
+    my_assert(p.cycles['ed'][0x44] == 2 * 8)
+    snapshot = p.snapshot()
+    my_assert(snapshot['pcs'][0] == { 'bank': '0', 'pc': 3, 'count': 2, 'cycles': 2 * 12 })
+    my_assert(snapshot['banks'] == [ { 'bank': '0', 'count': 6, 'cycles': 2 * (4 + 8 + 12) } ])
+    p.reset()
+    my_assert(p.snapshot()['opcodes'] == [ ])
+    cpu.set_profiler(None)
+    cpu.step()
+    my_assert(p.snapshot()['opcodes'] == [ ])
+
+def test_history():
+    reset_mem()
+    cpu.reset()
+    cpu.set_history(history(2))
+    ram0[0] = 0x3e # LD A,01
+    ram0[1] = 0x01
+    ram0[2] = 0x3c # INC A
+    ram0[3] = 0xdd # LD IX,1234
+    ram0[4] = 0x21
+    ram0[5] = 0x34
+    ram0[6] = 0x12
+    cpu.step()
+    my_assert(cpu.history.entries() == [ '0000 3e 01       AF %02x%02x BC ffff DE ffff HL ffff IX ffff IY ffff SP ffff  0' % (0xff, cpu.f) ])
+    cpu.step()
+    cpu.step()
+    entries = cpu.history.entries()
+    my_assert(len(entries) == 2)
+    my_assert(entries[0].startswith('0002 3c          AF 01'))
+    my_assert(entries[1].startswith('0003 dd 21 34 12 AF 02'))
+    cpu.set_history(None)
+
+def test_binary_trace():
+    reset_mem()
+    cpu.reset()
+    ram0[0] = 0x3e # LD A,12
+    ram0[1] = 0x12
+    ram0[2] = 0x32 # LD (0100),A
+    ram0[3] = 0x00
+    ram0[4] = 0x01
+    ram0[5] = 0xd3 # OUT (98),A
+    ram0[6] = 0x98
+    fh = tempfile.NamedTemporaryFile()
+    writer = bintrace.bintrace(fh.name)
+    writer.start(cpu)
+    now = cpu.scheduler.now
+    for i in range(3):
+        cpu.step()
+    writer.stop()
+    data = open(fh.name, 'rb').read()
+    size = bintrace.record.size
+    my_assert(len(data) == 5 * size)
+    my_assert(bintrace.record.unpack(data[0:size])[0:3] == (bintrace.INSTRUCTION, 0x0000, 0xffff))
+    my_assert(bintrace.record.unpack(data[size:2 * size])[0:3] == (bintrace.INSTRUCTION, 0x0002, 0x12ff))
+    my_assert(bintrace.record.unpack(data[2 * size:3 * size]) == (bintrace.MEM_WRITE, 0x0100, 0x12, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, now + 7))
+    my_assert(bintrace.record.unpack(data[4 * size:5 * size])[0:3] == (bintrace.IO_WRITE, 0x98, 0x12))
+    my_assert(cpu.read_mem == read_mem)
+    my_assert(bintrace.first_difference(data, data) == -1)
+    other = data[0:3 * size + 2] + b'x' + data[3 * size + 3:]
+    my_assert(bintrace.first_difference(data, other, 64) == 3 * size + 2)
+    my_assert(bintrace.first_difference(data, data[0:size]) == size)
+
+cpu = z80(read_mem, write_mem, read_io, write_io, debug, screen_kb_dummy(None))
+
+# a failing test does not stop the others
+failed = []
+
+for test in (
+        test__flags,
+        test__support,
+        test_add,
+        test_and,
+        test_batch_run,
+        test_bc_de_hl,
+        test_binary_trace,
+        test_bios_vram,
+        test_bit,
+        test_boot_cache,
+        test_blocks,
+        test_bulk,
+        test_call_ret,
+        test_ccf,
+        test_cp_cpir,
+        test_counters,
+        test_coverage,
+        test_cpm,
+        test_cpl,
+        test_dec,
+        test_debugger,
+        test_decode,
+        test_debug_trace,
+        test_generated,
+        test_get_set_state,
+        test_di_ei,
+        test_djnz,
+        test_events,
+        test_ex,
+        test_flag_tables,
+        test_fuzzer,
+        test_halt,
+        test_idle,
+        test_history,
+        test_inc,
+        test_jp,
+        test_jr,
+        test_ld,
+        test_ldi_r,
+        test_nop,
+        test_or,
+        test_out_in,
+        test_pc_hooks,
+        test_push_pop,
+        test_res,
+        test_rewind,
+        test_rlca_rlc_rl_rla,
+        test_rr,
+        test_rrca,
+        test_rst,
+        test_set,
+        test_sla,
+        test_srl,
+        test_sub,
+        test_throttle,
+        test_tracer,
+        test_xor,
+        ):
+    try:
+        test()
+
+    except test_failed:
+        failed.append(test.__name__)
+
+if failed:
+    print('Failed: %s' % ', '.join(failed))
+    sys.exit(1)
 
 print('All fine')
@@ -0,0 +1,68 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import time
+from typing import Callable, Optional
+
+class throttle:
+    ''' Keeps the emulated time in step with the real time: pace() is
+    called with the cycle count every now and then and sleeps when the
+    emulation is ahead. 'speed' is how much faster than a real machine to
+    run (1.0: real time), None runs as fast as possible. Also measures how
+    fast the emulation runs. '''
+
+    # when the emulation is behind by more than this (in seconds) it does
+    # not try to catch up: that would run it too fast for a while
+    max_lag: float = 0.25
+
+    def __init__(self, clock: int, frame_cycles: int, speed: Optional[float] = 1.0, now: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.clock: int = clock
+        self.frame_cycles: int = frame_cycles
+        self.speed: Optional[float] = speed
+        self.now = now
+        self.sleep = sleep
+
+        # the real and emulated time that the pacing is relative to
+        self.start_time: float = now()
+        self.start_cycles: int = 0
+
+        # the measurement since the last report()
+        self.interval: float = 1.0
+        self.report_time: float = self.start_time
+        self.report_cycles: int = 0
+
+    def restart(self, cycles: int) -> None:
+        self.start_time = self.report_time = self.now()
+        self.start_cycles = self.report_cycles = cycles
+
+    def pace(self, cycles: int) -> None:
+        if cycles < self.start_cycles:  # a state was restored
+            self.restart(cycles)
+
+        if self.speed is None:
+            return
+
+        ahead = self.start_time + (cycles - self.start_cycles) / (self.clock * self.speed) - self.now()
+
+        if ahead > 0:
+            self.sleep(ahead)
+
+        elif ahead < -throttle.max_lag:
+            self.start_time = self.now()
+            self.start_cycles = cycles
+
+    def report(self, cycles: int) -> Optional[str]:
+        ''' The emulated MHz, frames per second and how fast that is
+        compared to a real machine, over at least 'interval' seconds since
+        the previous report; None when that time has not passed yet. '''
+        now = self.now()
+        took = now - self.report_time
+        done = cycles - self.report_cycles
+
+        if took < self.interval:
+            return None
+
+        self.report_time = now
+        self.report_cycles = cycles
+
+        return '%.2f MHz, %.1f fps (%.0f%%)' % (done / took / 1000000, done / self.frame_cycles / took, done / took * 100 / self.clock)
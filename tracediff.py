@@ -0,0 +1,63 @@
+#! /usr/bin/python3
+
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# compares two binary traces (see bintrace.py, msx.py -B) and shows where
+# they start to differ
+
+import mmap
+import sys
+from bintrace import record, describe, first_difference, INSTRUCTION
+
+if len(sys.argv) < 3:
+    print('Usage: %s trace1 trace2 [lines of context]' % sys.argv[0])
+    sys.exit(1)
+
+context = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+def open_trace(filename: str):
+    fh = open(filename, 'rb')
+
+    try:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    except ValueError:  # empty file
+        return b''
+
+a = open_trace(sys.argv[1])
+b = open_trace(sys.argv[2])
+
+offset = first_difference(a, b)
+
+if offset == -1:
+    print('Traces are the same (%d records)' % (len(a) // record.size))
+    sys.exit(0)
+
+n = offset // record.size
+size = record.size
+
+def get(trace, i: int) -> bytes:
+    return trace[i * size:(i + 1) * size]
+
+# start the context at an instruction
+first = max(0, n - context)
+while first > 0 and get(a, first)[0] != INSTRUCTION:
+    first -= 1
+
+print('Traces differ at record %d:' % n)
+
+for i in range(first, n):
+    print('  %s' % describe(get(a, i)))
+
+for name, trace in ((sys.argv[1], a), (sys.argv[2], b)):
+    if len(trace) < (n + 1) * size:
+        print('%s: (ends here)' % name)
+
+    else:
+        print('%s:' % name)
+
+        for i in range(n, min(n + context, len(trace) // size)):
+            print('  %s' % describe(get(trace, i)))
+
+sys.exit(1)
@@ -0,0 +1,101 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+import collections
+import threading
+from typing import Callable, Dict, Optional
+
+OFF: int = 0
+ERROR: int = 1
+INFO: int = 2
+DEBUG: int = 3
+
+level_names: Dict[str, int] = { 'off': OFF, 'error': ERROR, 'info': INFO, 'debug': DEBUG }
+
+class tracer:
+    ''' Debug messages per category ('cpu', 'disk', ...) and level. Messages
+    above the level of their category are dropped before anything is
+    formatted, the others are formatted and written to the log file by a
+    background thread. '''
+
+    def __init__(self) -> None:
+        self.default_level: int = OFF
+        self.levels: Dict[str, int] = {}
+
+        self.fh = None
+        # (format, arguments); deque.append() is safe to use from any thread
+        self.pending: collections.deque = collections.deque()
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.stop_flag: bool = False
+
+    def open(self, filename: str, levels: str = 'debug') -> None:
+        ''' 'levels' is a level for all categories and/or category:level
+        pairs, separated by commas (e.g. "info,cpu:debug"). Raises
+        ValueError (with the valid levels) for an unknown level. '''
+        for item in levels.split(','):
+            parts = item.split(':')
+
+            if len(parts) > 2 or parts[-1] not in level_names:
+                raise ValueError('Invalid trace level "%s", the levels are %s' % (item, ', '.join(level_names)))
+
+        for item in levels.split(','):
+            parts = item.split(':')
+
+            if len(parts) == 1:
+                self.default_level = level_names[parts[0]]
+
+            else:
+                self.levels[parts[0]] = level_names[parts[1]]
+
+        self.fh = open(filename, 'a+', buffering=1 << 16)
+
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def enabled(self, category: str, level: int = DEBUG) -> bool:
+        return self.fh is not None and self.levels.get(category, self.default_level) >= level
+
+    def log(self, category: str, level: int, fmt: str, *args) -> None:
+        if self.fh is not None and self.levels.get(category, self.default_level) >= level:
+            self.pending.append((fmt, args))
+
+            if len(self.pending) > 4096:
+                self.wakeup.set()
+
+    def logger(self, category: str, level: int = DEBUG) -> Callable[[str], None]:
+        # for the objects that are given a debug(str) function
+        def log(x: str) -> None:
+            self.log(category, level, '%s', x)
+
+        return log
+
+    def writer(self) -> None:
+        while not self.stop_flag:
+            self.wakeup.wait(0.25)
+            self.wakeup.clear()
+
+            self.flush()
+
+    def flush(self) -> None:
+        pending = self.pending
+        fh = self.fh
+
+        while pending:
+            fmt, args = pending.popleft()
+            fh.write(fmt % args)
+            fh.write('\n')
+
+        fh.flush()
+
+    def close(self) -> None:
+        if self.fh is None:
+            return
+
+        self.stop_flag = True
+        self.wakeup.set()
+        self.thread.join()
+
+        self.flush()
+        self.fh.close()
+        self.fh = None
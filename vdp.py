@@ -4,21 +4,30 @@
 # implements VDP and also kb because of pygame
 
 import os
+import struct
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = 'hide'
 import pygame  # type: ignore
 import sys
 import threading
 import time
-from typing import List
+from typing import List, Optional, Tuple
 import traceback
 
+# read/write pointer, address state, first address byte (0xffff for none),
+# read ahead, keyboard row, palette state and first palette byte; the
+# command registers and state (command -1 for none); then the palette, the
+# registers, the status registers and the VRAM
+vdp_state = struct.Struct('<HBHBBBBiiiiiiiiiiiB16I')
+
 class vdp(threading.Thread):
-    def __init__(self):
+    def __init__(self, hz: int = 50):
         pygame.init()
         pygame.fastevent.init()
         pygame.display.set_caption('pymsx')
 
         self.ram: List[int] = [ 0 ] * 131072
+        # per 16KB: written since the last get_state_pages()
+        self.vram_dirty = bytearray(b'\1' * 8)
 
         self.vdp_rw_pointer: int = 0
         self.vdp_addr_state: bool = False
@@ -55,11 +64,17 @@ class vdp(threading.Thread):
         self.numbery: int = 0
         self.vdp_cmd = None
         self.start_destinationx: int = 0
-        start_destinationy: int = 0
+        self.start_destinationy: int = 0
         self.pixelsleft: int = 0
         self.pixeloffset: int = 0
         self.highspeed: bool = False
 
+        # the emulated time (in CPU cycles) of the I/O being done; the
+        # status bits of the retraces follow it
+        self.cycles: int = 0
+        self.frame_cycles: int = 3579545 // hz
+        self.line_cycles: int = 228
+
         self.prev_hsync_int = 0
         self.prev_vsync_int = 0
 
@@ -69,6 +84,47 @@ class vdp(threading.Thread):
 
         super(vdp, self).__init__()
 
+    def get_state(self) -> bytes:
+        return self.get_registers_state() + bytes(self.ram)
+
+    def get_registers_state(self) -> bytes:
+        return vdp_state.pack(self.vdp_rw_pointer, self.vdp_addr_state, 0xffff if self.vdp_addr_b1 is None else self.vdp_addr_b1,
+                self.vdp_read_ahead, self.keyboard_row, self.pal_sel, self.pal_byte_0,
+                self.sourcex, self.sourcey, self.destinationx, self.destinationy, self.numberx, self.numbery, -1 if self.vdp_cmd is None else self.vdp_cmd,
+                self.start_destinationx, self.start_destinationy, self.pixelsleft, self.pixeloffset, self.highspeed,
+                *self.rgb) + bytes(self.registers) + bytes(self.status_register)
+
+    def get_state_pages(self) -> Tuple[bytes, List[Optional[bytes]]]:
+        # get_state() split in everything but the VRAM and the VRAM per
+        # 16KB; pages that were not written since the previous call are None
+        pages = [ bytes(self.ram[i * 16384:(i + 1) * 16384]) if self.vram_dirty[i] else None for i in range(8) ]
+
+        self.vram_dirty[:] = bytes(8)
+
+        return self.get_registers_state(), pages
+
+    def set_state(self, data: bytes) -> None:
+        fields = vdp_state.unpack_from(data, 0)
+
+        (self.vdp_rw_pointer, vdp_addr_state, vdp_addr_b1, self.vdp_read_ahead, self.keyboard_row, pal_sel, self.pal_byte_0,
+                self.sourcex, self.sourcey, self.destinationx, self.destinationy, self.numberx, self.numbery, vdp_cmd,
+                self.start_destinationx, self.start_destinationy, self.pixelsleft, self.pixeloffset, highspeed) = fields[0:19]
+
+        self.vdp_addr_state = vdp_addr_state == 1
+        self.vdp_addr_b1 = None if vdp_addr_b1 == 0xffff else vdp_addr_b1
+        self.pal_sel = pal_sel == 1
+        self.vdp_cmd = None if vdp_cmd == -1 else vdp_cmd
+        self.highspeed = highspeed == 1
+        self.rgb[:] = fields[19:]
+
+        o = vdp_state.size
+        self.registers[:] = data[o:o + 47]
+        o += 47
+        self.status_register[:] = data[o:o + 10]
+        o += 10
+        self.ram[:] = data[o:o + 131072]
+        self.vram_dirty[:] = b'\1' * 8
+
     def resize_window(self, w: int, h: int):
         self.screen = pygame.display.set_mode((w, h), pygame.RESIZABLE)
         self.surface = pygame.Surface((w, h))
@@ -236,6 +292,7 @@ class vdp(threading.Thread):
                 offset = (y * 256) + x
 
             self.ram[offset] = v
+            self.vram_dirty[offset >> 14] = 1
 
             if vm == 6:
                 np = 2
@@ -259,6 +316,7 @@ class vdp(threading.Thread):
         if a == 0x98:
             if vm in (4, 16, 0):  # MSX 1 modi
                 self.ram[self.vdp_rw_pointer] = v
+                self.vram_dirty[0] = 1
                 self.vdp_rw_pointer += 1
                 self.vdp_rw_pointer &= 0x3fff
 
@@ -266,6 +324,7 @@ class vdp(threading.Thread):
                 vram_addr_high = (self.registers[0x0e] & 7) << 14
                 vram_addr = vram_addr_high + self.vdp_rw_pointer
                 self.ram[vram_addr] = v
+                self.vram_dirty[vram_addr >> 14] = 1
 
                 self.vdp_rw_pointer += 1
 
@@ -361,6 +420,14 @@ class vdp(threading.Thread):
 
         return bits ^ 0xff
 
+    def write_data(self, data: bytes) -> None:
+        # writes to the VRAM data port, in one go
+        for v in data:
+            self.write_io(0x98, v)
+
+    def read_data(self, n: int) -> bytes:
+        return bytes([ self.read_io(0x98) for i in range(n) ])
+
     def read_io(self, a: int) -> int:
         vm = self.video_mode()
 
@@ -399,13 +466,14 @@ class vdp(threading.Thread):
                 self.status_register[reg] = (self.status_register[reg] & 0x7e) | ((~(self.status_register[reg] & 0x81)) & 0x81)
                 self.status_register[reg] &= ~0x60
 
-                now = time.time()
+                # (the time goes back when a state is restored)
+                now = self.cycles
 
-                if now - self.prev_vsync_int >= 1 / 50: # FIXME 50Hz configurable?
+                if not 0 <= now - self.prev_vsync_int < self.frame_cycles:
                     self.status_register[reg] |= 0x40
                     self.prev_vsync_int = now
 
-                if now - self.prev_hsync_int >= 1 / (228 * 50): # hsync
+                if not 0 <= now - self.prev_hsync_int < self.line_cycles: # hsync
                     self.status_register[reg] |= 0x20
                     self.prev_hsync_int = now
 
@@ -550,6 +618,7 @@ class vdp(threading.Thread):
                 return
 
             offset = (y * (256 // 2)) + (x // 2)
+            self.vram_dirty[offset >> 14] = 1
 
             if highspeed:
                 self.ram[offset] = color
@@ -567,6 +636,7 @@ class vdp(threading.Thread):
                 return
 
             offset = (y * (512 // 4)) + (x // 4)
+            self.vram_dirty[offset >> 14] = 1
             hnibble = x & 3
             shift = (3 - hnibble) * 2
             mask = ~(3 << shift)
@@ -579,6 +649,7 @@ class vdp(threading.Thread):
                 return
 
             offset = (y * (512 // 2)) + (x // 2)
+            self.vram_dirty[offset >> 14] = 1
 
             if highspeed:
                 self.ram[offset] = color
@@ -596,6 +667,7 @@ class vdp(threading.Thread):
                 return
 
             offset = (y * 256) + x
+            self.vram_dirty[offset >> 14] = 1
 
             self.ram[offset] = color
 
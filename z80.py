@@ -1,13 +1,151 @@
 # (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
 # released under AGPL v3.0
 
-from typing import Tuple, Callable, List
-import time
+from functools import partial
+from types import MethodType
+from operator import attrgetter
+from scheduler import scheduler
+import struct
+from typing import Tuple, Callable, Dict, List, Optional
+
+# B, C, D, E, H and L (and the alternate set) are stored as the register
+# pairs; these are the 8 bit views on them: name -> (pair, shift)
+register_views: Dict[str, Tuple[str, int]] = {
+        'b': ('bc', 8), 'c': ('bc', 0), 'd': ('de', 8), 'e': ('de', 0), 'h': ('hl', 8), 'l': ('hl', 0),
+        'b_': ('bc_', 8), 'c_': ('bc_', 0), 'd_': ('de_', 8), 'e_': ('de_', 0), 'h_': ('hl_', 8), 'l_': ('hl_', 0) }
+
+def register_view(pair: str, shift: int) -> property:
+    get = attrgetter(pair)
+
+    if shift:
+        return property(lambda self: get(self) >> 8, lambda self, v: setattr(self, pair, (get(self) & 0xff) | (v << 8)))
+
+    return property(lambda self: get(self) & 0xff, lambda self, v: setattr(self, pair, (get(self) & 0xff00) | v))
+
+# flag lookup tables, see flag_tables()
+shared_tables: dict = {}
+
+def flag_tables() -> dict:
+    ''' Builds the tables with the flags of the 8 bit ALU instructions once,
+    they are shared by all z80 instances. '''
+    if shared_tables:
+        return shared_tables
+
+    parity: List[bool] = [ bin(v).count('1') & 1 == 0 for v in range(256) ]
+
+    # sign, zero and the undocumented bits 5 and 3
+    sz53: List[int] = [ (v & 0xa8) | (0x40 if v == 0 else 0) for v in range(256) ]
+    sz53p: List[int] = [ sz53[v] | (parity[v] << 2) for v in range(256) ]
+
+    # ADD/ADC and SUB/SBC/CP: indexed by carry << 16 | A << 8 | value
+    add: List[int] = []
+    sub: List[int] = []
+
+    for carry in range(2):
+        for a in range(256):
+            for value in range(256):
+                result = a + value + carry
+                add.append(sz53[result & 0xff] | ((a ^ value ^ result) & 0x10) | ((((a ^ result) & (value ^ result) & 0x80) != 0) << 2) | ((result & 0x100) >> 8))
+
+                result = a - value - carry
+                sub.append(sz53[result & 0xff] | ((a ^ value ^ result) & 0x10) | ((((a ^ value) & (a ^ result) & 0x80) != 0) << 2) | ((result & 0x100) >> 8) | 2)
+
+    # INC/DEC: indexed by the value before, carry is not included
+    inc: List[int] = [ sz53[(v + 1) & 0xff] | (0x10 if (v + 1) & 0x0f == 0 else 0) | (4 if v == 0x7f else 0) for v in range(256) ]
+    dec: List[int] = [ sz53[(v - 1) & 0xff] | (0x10 if (v - 1) & 0x0f == 0x0f else 0) | (4 if v == 0x80 else 0) | 2 for v in range(256) ]
+
+    # DAA: indexed by (F & (H | N | C)) << 8 | A, gives A << 8 | F
+    # from https://stackoverflow.com/questions/8119577/z80-daa-instruction/8119836
+    daa: List[int] = [ 0 ] * 0x1400
+
+    for f in (0x00, 0x01, 0x02, 0x03, 0x10, 0x11, 0x12, 0x13):
+        for a in range(256):
+            t = 0
+            c = f & 1
+            n = f & 2
+            h = f & 0x10
+
+            if h or (a & 0x0f) > 9:
+                t += 1
+
+            if c or a > 0x99:
+                t += 2
+                c = 1
+
+            if n and not h:
+                h = 0
+
+            elif n and h:
+                h = 0x10 if (a & 0x0f) < 6 else 0
+
+            else:
+                h = 0x10 if (a & 0x0f) >= 0x0a else 0
+
+            if t == 1:
+                result = (a + (0xfa if n else 0x06)) & 0xff
+
+            elif t == 2:
+                result = (a + (0xa0 if n else 0x60)) & 0xff
+
+            elif t == 3:
+                result = (a + (0x9a if n else 0x66)) & 0xff
+
+            else:
+                result = a
+
+            daa[(f << 8) | a] = (result << 8) | sz53p[result] | h | n | c
+
+    shared_tables.update({ 'parity': parity, 'sz53': sz53, 'sz53p': sz53p, 'add': add, 'sub': sub, 'inc': inc, 'dec': dec, 'daa': daa })
+
+    return shared_tables
+
+# cycles per second
+clock: int = 3579545
+
+# see get_state(): A, F, BC, DE, HL, A', F', BC', DE', HL', IX, IY, PC, SP, I,
+# R, IM, IFF1, IFF2, MEMPTR, interrupts, int, halted, the cycle count, the
+# cycles since the last VDP interrupt and the cycles until the next one
+cpu_state = struct.Struct('<BBHHHBBHHHHHHHBBBBBHBBBQQQ')
+
+# JR, JR cc, JP and JP cc
+jumps: frozenset = frozenset((0x18, 0x20, 0x28, 0x30, 0x38, 0xc2, 0xc3, 0xca, 0xd2, 0xda, 0xe2, 0xea, 0xf2, 0xfa))
+
+# instructions that can be in a loop that waits for an event: they only
+# change registers (reading plain memory is fine, see plain_reads()) and do
+# not leave the loop
+idle_main: frozenset = frozenset([ 0x00, 0x01, 0x03, 0x04, 0x05, 0x06, 0x07, 0x09, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e, 0x0f,
+                                   0x11, 0x13, 0x14, 0x15, 0x16, 0x17, 0x19, 0x1a, 0x1b, 0x1c, 0x1d, 0x1e, 0x1f,
+                                   0x21, 0x23, 0x24, 0x25, 0x26, 0x27, 0x29, 0x2a, 0x2b, 0x2c, 0x2d, 0x2e, 0x2f,
+                                   0x31, 0x33, 0x37, 0x39, 0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f,
+                                   0xc6, 0xce, 0xd6, 0xde, 0xe6, 0xee, 0xf6, 0xfe ] +
+                                 list(range(0x40, 0x70)) + list(range(0x78, 0xc0))) | jumps
+
+# the idle_main instructions that read memory through a register pair: the
+# pair (LD A,(BC), LD A,(DE), LD r,(HL) and the ALU instructions on (HL))
+idle_indirect: Dict[int, str] = { 0x0a: 'bc', 0x1a: 'de', 0x7e: 'hl' }
+idle_indirect.update({ instr: 'hl' for instr in list(range(0x46, 0x70, 8)) + list(range(0x86, 0xc0, 8)) })
+
+# the idle_main instructions that change B, C, D, E, H or L
+idle_pair_writes: frozenset = frozenset([ 0x01, 0x03, 0x04, 0x05, 0x06, 0x09, 0x0b, 0x0c, 0x0d, 0x0e,
+                                          0x11, 0x13, 0x14, 0x15, 0x16, 0x19, 0x1b, 0x1c, 0x1d, 0x1e,
+                                          0x21, 0x23, 0x24, 0x25, 0x26, 0x29, 0x2a, 0x2b, 0x2c, 0x2d, 0x2e, 0x39 ] +
+                                        list(range(0x40, 0x70)))
 
 class z80:
-    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen) -> None:
+    __slots__ = ( 'a', 'f', 'bc', 'de', 'hl', 'a_', 'f_', 'bc_', 'de_', 'hl_', 'ix', 'iy', 'pc', 'sp', 'i', 'r', 'im', 'iff1', 'iff2', 'memptr',
+                  'interrupts', 'interrupt_start', 'frame_cycles', 'frame_event', 'int', 'halted', 'halt_cycles', 'idle_ports', 'idle_cycles', 'idle_state', 'idle_time', 'hooks', 'access_hooks', 'memory_hooks', 'hooked_pages', 'profiler', 'history', 'scheduler',
+                  'read_mem', 'fetch_mem', 'write_mem', 'bus_write_mem', 'read_io', 'write_io', 'debug_out', 'screen',
+                  'main_jumps', 'bits_jumps', 'ed_jumps', 'ixy_jumps', 'ixy_bit_jumps', 'ix_jumps', 'iy_jumps', 'ix_bit_jumps', 'iy_bit_jumps',
+                  'traced_tables', 'fast_tables', 'main_operands', 'ed_operands', 'ixy_operands', 'decoded', 'decode_pages', 'code_marks', 'memory_layout', 'direct_pages', 'code_page', 'blocks',
+                  'parity_lookup', 'sz53p_lookup', 'add_lookup', 'sub_lookup', 'inc_lookup', 'dec_lookup', 'daa_lookup' )
+
+    def __init__(self, read_mem, write_mem, read_io, write_io, debug, screen, generated: bool = True, sched: Optional[scheduler] = None, idle_ports: Optional[dict] = None, hz: int = 50) -> None:
         self.read_mem = read_mem
-        self.write_mem = write_mem
+        # not replaced by hooks: for looking at code without it counting as
+        # a memory access
+        self.fetch_mem = read_mem
+        self.bus_write_mem = write_mem
+        self.write_mem = self.write_mem_code
         self.read_io = read_io
         self.write_io = write_io
         self.debug_out = debug
@@ -17,9 +155,46 @@ class z80:
         self.init_xy()
         self.init_xy_bit()
         self.init_bits()
-        self.init_parity()
+        self.init_flags()
         self.init_ext()
 
+        self.blocks = None
+        self.init_decoder()
+
+        if generated:
+            self.init_generated()
+
+        # cycles that were skipped while halted
+        self.halt_cycles: int = 0
+
+        # loops that only wait for an event are skipped when this is not
+        # None; it has the I/O ports (e.g. a status register) that such a
+        # loop may read, each with None or a function that returns False
+        # while what the port returns can change without an event
+        self.idle_ports: Optional[dict] = idle_ports
+        self.idle_cycles: int = 0
+        self.idle_state: Optional[tuple] = None
+        self.idle_time: int = 0
+
+        # see add_hook(), set_profiler() and set_history()
+        self.hooks: list = []
+        # see add_access_hook()
+        self.access_hooks: list = []
+        # when not 0, something replaced read_mem/bus_write_mem to see all
+        # accesses: LDIR and friends then do not use the direct pages of the
+        # 16KB pages it looks at (the number of these hooks per page)
+        self.memory_hooks: int = 0
+        self.hooked_pages: List[int] = [ 0 ] * 4
+        self.profiler = None
+        self.history = None
+
+        # the (machine wide) emulated time
+        self.scheduler: scheduler = scheduler() if sched is None else sched
+        self.interrupt_start: int = self.scheduler.now
+        # when the VDP interrupt comes: 'hz' times per second
+        self.frame_cycles: int = clock // hz + 1
+        self.frame_event: list = self.scheduler.add_in(self.frame_cycles, self.frame)
+
         self.reset()
 
     def debug(self, x : str) -> None:
@@ -28,21 +203,15 @@ class z80:
 
     def reset(self) -> None:
         self.a: int = 0xff
-        self.b: int = 0xff
-        self.c: int = 0xff
-        self.d: int = 0xff
-        self.e: int = 0xff
         self.f: int = 0xff
-        self.h: int = 0xff
-        self.l: int = 0xff
+        self.bc: int = 0xffff
+        self.de: int = 0xffff
+        self.hl: int = 0xffff
         self.a_: int = 0xff
-        self.b_: int = 0xff
-        self.c_: int = 0xff
-        self.d_: int = 0xff
-        self.e_: int = 0xff
         self.f_: int = 0xff
-        self.h_: int = 0xff
-        self.l_: int = 0xff
+        self.bc_: int = 0xffff
+        self.de_: int = 0xffff
+        self.hl_: int = 0xffff
         self.ix: int = 0xffff
         self.iy: int = 0xffff
         self.interrupts: bool = True
@@ -55,13 +224,74 @@ class z80:
         self.iff2: int = 0
         self.memptr: int = 0xffff
 
-        self.interrupt_cycles: int = 0
+        self.interrupt_cycles = 0
         self.int: bool = False
+        self.halted: bool = False
+
+        self.flush_decoded()
 
     def interrupt(self) -> None:
         if self.interrupts:
             self.int = True
 
+    def accept_interrupt(self) -> None:
+        self.int = False
+        self.idle_state = None
+        self.debug('Interrupt')
+
+        if self.halted:  # return to the instruction after the HALT
+            self.halted = False
+            self.pc = (self.pc + 1) & 0xffff
+
+        self.push(self.pc)
+        self.pc = 0x38
+
+    @property
+    def interrupt_cycles(self) -> int:
+        # cycles since the last VDP interrupt
+        return self.scheduler.now - self.interrupt_start
+
+    @interrupt_cycles.setter
+    def interrupt_cycles(self, v: int) -> None:
+        self.interrupt_start = self.scheduler.now - v
+
+    def frame(self, when: int) -> None:
+        # vertical blank of the VDP
+        if self.screen.interrupt():
+            self.interrupt()
+            self.interrupt_cycles = 0
+
+        self.frame_event = self.scheduler.add(when + self.frame_cycles, self.frame)
+
+    def get_state(self) -> bytes:
+        ''' The registers, interrupt state and emulated time, for
+        set_state() (see savestate.py). '''
+        now = self.scheduler.now
+
+        return cpu_state.pack(self.a, self.f, self.bc, self.de, self.hl, self.a_, self.f_, self.bc_, self.de_, self.hl_, self.ix, self.iy, self.pc, self.sp,
+                self.i, self.r, self.im, self.iff1, self.iff2, self.memptr, self.interrupts, self.int, self.halted,
+                now, now - self.interrupt_start, max(0, self.frame_event[0] - now))
+
+    def set_state(self, data: bytes) -> None:
+        (self.a, self.f, self.bc, self.de, self.hl, self.a_, self.f_, self.bc_, self.de_, self.hl_, self.ix, self.iy, self.pc, self.sp,
+                self.i, self.r, self.im, self.iff1, self.iff2, self.memptr, interrupts, int_, halted,
+                now, since, until) = cpu_state.unpack(data)
+
+        self.interrupts = interrupts == 1
+        self.int = int_ == 1
+        self.halted = halted == 1
+        self.idle_state = None
+
+        sched = self.scheduler
+        sched.now = now
+        self.interrupt_start = now - since
+
+        sched.cancel(self.frame_event)
+        self.frame_event = sched.add(now + until, self.frame)
+
+        # the memory has changed as well
+        self.flush_decoded()
+
     def in_(self, a: int) -> int:
         return self.read_io(a)
 
@@ -77,7 +307,7 @@ class z80:
         return p & 0xffff
 
     def read_pc_inc(self) -> int:
-        v = self.read_mem(self.pc)
+        v = self.fetch_mem(self.pc)
 
         self.pc = self.incp16(self.pc)
 
@@ -89,36 +319,17 @@ class z80:
         return self.m16(high, low)
 
     def flags_add_sub_cp(self, is_sub : bool, carry : bool, value : int) -> int:
-        org_value = value
-        value += 1 if carry and self.get_flag_c() else 0
+        c = 1 if carry and self.f & 1 else 0
 
         if is_sub:
-            self.set_flag_n(True)
-
-            result = self.a - value
+            self.f = self.sub_lookup[(c << 16) | (self.a << 8) | value]
+            result = self.a - value - c
 
         else:
-            self.set_flag_n(False)
+            self.f = self.add_lookup[(c << 16) | (self.a << 8) | value]
+            result = self.a + value + c
 
-            result = self.a + value
-
-        self.set_flag_h(((self.a & 0x10) ^ (org_value & 0x10) ^ (result & 0x10)) == 0x10)
-
-        self.set_flag_c((result & 0x100) != 0)
-
-        before_sign = self.a & 0x80
-        value_sign = org_value & 0x80
-        after_sign = result & 0x80
-        self.set_flag_pv(after_sign != before_sign and ((before_sign != value_sign and is_sub) or (before_sign == value_sign and not is_sub)))
-
-        result &= 0xff
-
-        self.set_flag_z(result == 0)
-        self.set_flag_s(after_sign == 0x80)
-
-        self.set_flag_53(result)
-
-        return result
+        return result & 0xff
 
     def flags_add_sub_cp16(self, is_sub : bool, carry : bool, org_val : int, value : int) -> int:
         org_value = value
@@ -150,24 +361,21 @@ class z80:
 
         return result
 
-    def _jr_wrapper(self, instr: int) -> int:
+    def _jr_wrapper(self, instr: int, offset: int) -> int:
         if instr == 0x18:
-            return self._jr(True, '')
-
-        elif instr == 0xc3:
-            return self._jp(True, None)
+            return self._jr(True, '', offset)
 
         elif instr == 0x20:
-            return self._jr(not self.get_flag_z(), 'NZ')
+            return self._jr(not self.get_flag_z(), 'NZ', offset)
 
         elif instr == 0x28:
-            return self._jr(self.get_flag_z(), 'Z')
+            return self._jr(self.get_flag_z(), 'Z', offset)
 
         elif instr == 0x30:
-            return self._jr(not self.get_flag_c(), 'NC')
+            return self._jr(not self.get_flag_c(), 'NC', offset)
 
         elif instr == 0x38:
-            return self._jr(self.get_flag_c(), 'C')
+            return self._jr(self.get_flag_c(), 'C', offset)
 
         else:
             assert False
@@ -200,61 +408,61 @@ class z80:
         else:
             assert False
 
-    def _jp_wrap(self, instr: int) -> int:
+    def _jp_wrap(self, instr: int, a: int) -> int:
         if instr == 0xc2:
-            return self._jp(not self.get_flag_z(), 'NZ')
+            return self._jp(not self.get_flag_z(), 'NZ', a)
 
         elif instr == 0xc3:
-            return self._jp(True, '')
+            return self._jp(True, '', a)
 
         elif instr == 0xca:  # JP Z,**
-            return self._jp(self.get_flag_z(), 'Z')
+            return self._jp(self.get_flag_z(), 'Z', a)
 
         elif instr == 0xd2:
-            return self._jp(not self.get_flag_c(), 'NC')
+            return self._jp(not self.get_flag_c(), 'NC', a)
 
         elif instr == 0xda:  # JP c,**
-            return self._jp(self.get_flag_c(), 'C')
+            return self._jp(self.get_flag_c(), 'C', a)
 
         elif instr == 0xe2:
-            return self._jp(not self.get_flag_pv(), 'PO')
+            return self._jp(not self.get_flag_pv(), 'PO', a)
 
         elif instr == 0xea:  # JP pe,**
-            return self._jp(self.get_flag_pv(), 'PE')
+            return self._jp(self.get_flag_pv(), 'PE', a)
 
         elif instr == 0xf2:
-            return self._jp(not self.get_flag_s(), 'P')
+            return self._jp(not self.get_flag_s(), 'P', a)
 
         elif instr == 0xfa:  # JP M,**
-            return self._jp(self.get_flag_s(), 'M')
+            return self._jp(self.get_flag_s(), 'M', a)
 
         else:
             assert False
 
-    def _call_wrap(self, instr: int) -> int:
+    def _call_wrap(self, instr: int, a: int) -> int:
         if instr == 0xc4:
-            return self._call_flag(not self.get_flag_z(), 'NZ')
+            return self._call_flag(not self.get_flag_z(), 'NZ', a)
 
         elif instr == 0xcc:  # CALL Z,**
-            return self._call_flag(self.get_flag_z(), 'Z')
+            return self._call_flag(self.get_flag_z(), 'Z', a)
 
         elif instr == 0xd4:
-            return self._call_flag(not self.get_flag_c(), 'NC')
+            return self._call_flag(not self.get_flag_c(), 'NC', a)
 
         elif instr == 0xdc:  # CALL C,**
-            return self._call_flag(self.get_flag_c(), 'C')
+            return self._call_flag(self.get_flag_c(), 'C', a)
 
         elif instr == 0xe4:
-            return self._call_flag(not self.get_flag_pv(), 'PO')
+            return self._call_flag(not self.get_flag_pv(), 'PO', a)
 
         elif instr == 0xec:  # CALL PE,**
-            return self._call_flag(self.get_flag_pv(), 'PE')
+            return self._call_flag(self.get_flag_pv(), 'PE', a)
 
         elif instr == 0xf4:
-            return self._call_flag(not self.get_flag_s(), 'P')
+            return self._call_flag(not self.get_flag_s(), 'P', a)
 
         elif instr == 0xfc:  # CALL M,**
-            return self._call_flag(self.get_flag_s(), 'M')
+            return self._call_flag(self.get_flag_s(), 'M', a)
 
         else:
             assert False
@@ -430,7 +638,6 @@ class z80:
         self.main_jumps[0xea] = self._jp_wrap
         self.main_jumps[0xfa] = self._jp_wrap
 
-        self.main_jumps[0xcb] = self.bits
         self.main_jumps[0xdb] = self._in
         self.main_jumps[0xeb] = self._ex_de_hl
         self.main_jumps[0xfb] = self._ei
@@ -441,9 +648,6 @@ class z80:
         self.main_jumps[0xfc] = self._call_wrap
 
         self.main_jumps[0xcd] = self._call
-        self.main_jumps[0xdd] = self._ix
-        self.main_jumps[0xed] = self.ed
-        self.main_jumps[0xfd] = self._iy
 
         self.main_jumps[0xce] = self._add_a_val
         self.main_jumps[0xde] = self._sub_val
@@ -456,46 +660,605 @@ class z80:
         self.main_jumps[0xff] = self._rst
 
     def step(self):
-        if self.interrupt_cycles >= 3579545 / 50:
-            if self.screen.IE0():
-                self.interrupt()
-                self.interrupt_cycles = 0
-            self.screen.interrupt()
+        if self.scheduler.now >= self.scheduler.deadline:
+            self.scheduler.run_due()
 
         if self.int:
-            self.int = False
-            self.debug('Interrupt')
-            self.push(self.pc)
-            self.pc = 0x38
+            self.accept_interrupt()
+
+        # self.debug('AF %04x BC %04x DE %04x HL %04x IX %04x IY %04x SP %04x slot %02x' % (self.m16(self.a, self.f), self.bc, self.de, self.hl, self.ix, self.iy, self.sp, self.read_io(0xa8)))
+
+        pc = self.pc
 
-        # self.debug('AF %04x BC %04x DE %04x HL %04x IX %04x IY %04x SP %04x slot %02x' % (self.m16(self.a, self.f), self.m16(self.b, self.c), self.m16(self.d, self.e), self.m16(self.h, self.l), self.ix, self.iy, self.sp, self.read_io(0xa8)))
+        instr = self.decoded[pc >> 14][pc & 0x3fff]
+        if instr is None:
+            instr = self.get_decoded(pc)
 
-        instr = self.read_pc_inc()
+        self.pc = (pc + instr[1]) & 0xffff
 
         try:
-            took = self.main_jumps[instr](instr)
+            took = instr[0]()
             assert took is not None
-            self.interrupt_cycles += took
+            self.scheduler.now += took
 
         except TypeError as te:
-            self.debug('TypeError main(%02X): %s' % (instr, te))
+            self.debug('TypeError main(%02X): %s' % (self.fetch_mem(pc), te))
             assert False
 
         except AssertionError as ae:
-            self.debug('AssertionError main(%02X): %s' % (instr, ae))
+            self.debug('AssertionError main(%02X): %s' % (self.fetch_mem(pc), ae))
             assert False
 
         return took
 
-    def bits(self, dummy) -> int:
-        try:
-            instr = self.read_pc_inc()
-            # self.debug('%04x cb%02X' % (self.pc - 2, instr))
-            return self.bits_jumps[instr](instr)
+    def run(self, budget: int, until_pc: int = -1) -> int:
+        ''' Executes instructions like step() does until at least 'budget'
+        cycles have passed or the program counter is 'until_pc'. Returns
+        the number of cycles used. '''
+        decoded = self.decoded
+        get_decoded = self.get_decoded
+        sched = self.scheduler
 
-        except TypeError as te:
-            self.debug('TypeError bits(%02X): %s' % (instr, te))
-            assert False
+        done = 0
+
+        # a deadline at the end of the budget keeps LDIR and friends from
+        # running (far) past it
+        end = sched.now + budget
+        if end < sched.deadline:
+            sched.deadline = end
+
+        while done < budget:
+            if sched.now >= sched.deadline:
+                sched.run_due()
+
+                if end < sched.deadline:
+                    sched.deadline = end
+
+            if self.int:
+                self.accept_interrupt()
+
+            pc = self.pc
+
+            if pc == until_pc:
+                break
+
+            instr = decoded[pc >> 14][pc & 0x3fff]
+            if instr is None:
+                instr = get_decoded(pc)
+
+            self.pc = (pc + instr[1]) & 0xffff
+
+            took = instr[0]()
+            sched.now += took
+            done += took
+
+        return done
+
+    def init_decoder(self) -> None:
+        # what follows the opcode: 0 nothing, 1 a byte, 2 a relative jump
+        # offset, 3 a word, 4 an index register displacement, 5 a
+        # displacement and a byte
+        operands = { self._ld_val_high: 1, self._ld_val_low: 1, self._out: 1, self._in: 1, self._add_a_val: 1, self._sub_val: 1, self._and_val: 1, self._or_val: 1, self._xor_mem: 1, self._cp_mem: 1, self._ld_ixh: 1, self._ld_ixl: 1,
+                     self._djnz: 2, self._jr_wrapper: 2,
+                     self._ld_pair: 3, self._ld_imem_from: 3, self._ld_imem: 3, self._jp_wrap: 3, self._call_wrap: 3, self._call: 3, self._ld_mem_pair: 3, self._ld_pair_mem: 3, self._ld_ixy: 3, self._ld_mem_from_ixy: 3, self._ld_ixy_from_mem: 3,
+                     self._inc_ix_index: 4, self._dec_ix_index: 4, self._ld_X_ixy_deref: 4, self._ld_ixy_X: 4, self._add_a_deref_ixy: 4, self._adc_a_ixy_deref: 4, self._sub_a_ixy_deref: 4, self._and_a_ixy_deref: 4, self._xor_a_ixy_deref: 4, self._or_a_ixy_deref: 4, self._cp_a_ixy_deref: 4,
+                     self._ld_ix_index: 5 }
+
+        self.main_operands: List[int] = [ operands.get(handler, 0) for handler in self.main_jumps ]
+        self.ed_operands: List[int] = [ operands.get(handler, 0) for handler in self.ed_jumps ]
+        self.ixy_operands: List[int] = [ operands.get(handler, 0) for handler in self.ixy_jumps ]
+
+        # IX and IY versions of the DD/FD and DDCB/FDCB tables
+        self.ix_jumps: List[Callable[..., int]] = self.ixy_jumps
+        self.iy_jumps: List[Callable[..., int]] = self.ixy_jumps
+        self.ix_bit_jumps: List[Callable[..., int]] = self.ixy_bit_jumps
+        self.iy_bit_jumps: List[Callable[..., int]] = self.ixy_bit_jumps
+
+        self.traced_tables: tuple = (self.main_jumps, self.bits_jumps, self.ed_jumps, self.ix_jumps, self.iy_jumps, self.ix_bit_jumps, self.iy_bit_jumps)
+        self.fast_tables: Optional[tuple] = None
+
+        self.decode_pages: dict = {}
+        self.decoded: List[list] = [ None ] * 4
+        # per key of the memory layout the 256 byte parts of its 16KB that
+        # hold decoded code (or compiled blocks), and the same per 256 bytes
+        # of the address space for what is mapped now: writes to these are
+        # checked
+        self.code_marks: dict = {}
+        self.code_page: bytearray = bytearray(256)
+        self.memory_layout: tuple = (0, 1, 2, 3)
+        self.direct_pages: list = [ None ] * 4
+
+        self.set_memory_layout(self.memory_layout)
+
+    def init_generated(self) -> None:
+        # replace the handlers by the per-opcode versions from z80gen.py
+        # (these do not produce debug output)
+        import z80gen
+
+        module = z80gen.load(self)
+
+        fast_tables = []
+
+        for prefix, table, is_ix in z80gen.tables(self):
+            new_table = []
+
+            for i, handler in enumerate(table):
+                function = getattr(module, '%s_%02x' % (prefix, i), None)
+                new_table.append(handler if function is None else MethodType(function, self))
+
+            fast_tables.append(new_table)
+
+        self.fast_tables = tuple(fast_tables)
+        self.use_tables(self.fast_tables)
+
+    def use_tables(self, tables: tuple) -> None:
+        # main, CB, ED, DD, FD, DDCB and FDCB
+        self.main_jumps, self.bits_jumps, self.ed_jumps, self.ix_jumps, self.iy_jumps, self.ix_bit_jumps, self.iy_bit_jumps = tables
+
+    def set_trace(self, traced: bool) -> None:
+        ''' Selects the handlers that produce debug output (traced) or the
+        generated ones that do not (when the CPU was created with these). '''
+        self.use_tables(self.traced_tables if traced or self.fast_tables is None else self.fast_tables)
+
+        self.flush_decoded()
+
+    def bind(self, handler: Callable[..., int], args: tuple, kind: int, a: int) -> Tuple[Callable[[], int], int]:
+        # returns 'handler' with its arguments and the operands at 'a'
+        # bound to it, and the number of operand bytes
+        if handler is None:
+            return (partial(self.invalid, args[0]), 0)
+
+        if kind == 0:
+            return (partial(handler, *args), 0)
+
+        v = self.fetch_mem(a)
+
+        if kind == 1:
+            return (partial(handler, *args, v), 1)
+
+        if kind == 2 or kind == 4:
+            return (partial(handler, *args, self.compl8(v)), 1)
+
+        v2 = self.fetch_mem((a + 1) & 0xffff)
+
+        if kind == 3:
+            return (partial(handler, *args, self.m16(v2, v)), 2)
+
+        return (partial(handler, *args, self.compl8(v), v2), 2)
+
+    def decode(self, a: int) -> Tuple[Callable[[], int], int]:
+        ''' Returns the handler of the instruction at 'a' with its operands
+        bound to it, and the length of the instruction. '''
+        instr = self.fetch_mem(a)
+        a1 = (a + 1) & 0xffff
+
+        if instr == 0xcb:
+            instr = self.fetch_mem(a1)
+            return (partial(self.bits_jumps[instr], instr), 2)
+
+        if instr == 0xed:
+            instr = self.fetch_mem(a1)
+            handler, length = self.bind(self.ed_jumps[instr], (instr,), self.ed_operands[instr], (a + 2) & 0xffff)
+            return (handler, 2 + length)
+
+        if instr == 0xdd or instr == 0xfd:
+            is_ix = instr == 0xdd
+            instr = self.fetch_mem(a1)
+
+            if instr == 0xcb:  # DDCB/FDCB: displacement and then the opcode
+                offset = self.compl8(self.fetch_mem((a + 2) & 0xffff))
+                instr = self.fetch_mem((a + 3) & 0xffff)
+                return (partial((self.ix_bit_jumps if is_ix else self.iy_bit_jumps)[instr], instr, is_ix, offset), 4)
+
+            handler = (self.ix_jumps if is_ix else self.iy_jumps)[instr]
+
+            if handler == self._main_mirror:  # prefix is ignored
+                handler, length = self.decode(a1)
+                return (partial(self._main_mirror, handler), 1 + length)
+
+            handler, length = self.bind(handler, (instr, is_ix), self.ixy_operands[instr], (a + 2) & 0xffff)
+            return (handler, 2 + length)
+
+        handler, length = self.bind(self.main_jumps[instr], (instr,), self.main_operands[instr], a1)
+
+        if instr in jumps and self.idle_ports is not None:
+            ports: list = []
+            reads: list = []
+            target = self.idle_loop(a, ports, reads)
+
+            if target != -1:
+                checks = tuple(self.idle_ports[port] for port in ports if self.idle_ports[port])
+                handler = partial(self.idle_branch, handler, a, target, checks, tuple(reads))
+
+        return (handler, 1 + length)
+
+    def jump_target(self, a: int) -> int:
+        # for the instructions in 'jumps'
+        read = self.fetch_mem
+
+        if read(a) < 0x40:
+            return (a + 2 + self.compl8(read((a + 1) & 0xffff))) & 0xffff
+
+        return self.m16(read((a + 2) & 0xffff), read((a + 1) & 0xffff))
+
+    def idle_loop(self, a: int, ports: Optional[list] = None, reads: Optional[list] = None) -> int:
+        ''' Returns the start of the loop that ends with the jump at 'a' if
+        it could be waiting for an event (see idle_main), else -1. The I/O
+        ports that the loop reads are added to 'ports', the memory it reads
+        to 'reads': addresses, and the names of the register pairs that it
+        reads through (these do not change in the loop). '''
+        read = self.fetch_mem
+        target = self.jump_target(a)
+        size = (a - target) & 0xffff
+
+        if size > 32:
+            return -1
+
+        if reads is None:
+            reads = []
+
+        pair_writes = False
+
+        b = target
+
+        while b != a:
+            instr = read(b)
+            v = read((b + 1) & 0xffff)
+
+            if instr == 0xcb and v >= 0x40 and v < 0x80:  # BIT
+                length = 2
+
+                if v & 7 == 6:  # BIT n,(HL)
+                    reads.append('hl')
+
+            elif instr == 0xdb and v in self.idle_ports:  # IN A,(n)
+                length = 2
+
+                if ports is not None:
+                    ports.append(v)
+
+            elif instr in idle_main:
+                length = 1 + (0, 1, 1, 2)[self.main_operands[instr]]
+
+                if instr in jumps and (self.jump_target(b) - target) & 0xffff > size:
+                    return -1
+
+                if instr in idle_indirect:
+                    reads.append(idle_indirect[instr])
+
+                elif instr == 0x2a or instr == 0x3a:  # LD HL,(nn) and LD A,(nn)
+                    address = self.m16(read((b + 2) & 0xffff), v)
+                    reads.append(address)
+
+                    if instr == 0x2a:
+                        reads.append((address + 1) & 0xffff)
+
+                pair_writes |= instr in idle_pair_writes
+
+            else:
+                return -1
+
+            b = (b + length) & 0xffff
+
+            if (b - target) & 0xffff > size:
+                return -1
+
+        # where it reads through a pair is only known when it is not changed
+        if pair_writes and any(isinstance(r, str) for r in reads):
+            return -1
+
+        return target
+
+    def plain_reads(self, reads: tuple) -> bool:
+        # if the memory an idle loop reads (see idle_loop()) is plain RAM or
+        # ROM now (see set_memory_layout()), not a device that sees the reads
+        direct_pages = self.direct_pages
+
+        for r in reads:
+            if direct_pages[(r if isinstance(r, int) else getattr(self, r)) >> 14] is None:
+                return False
+
+        return True
+
+    def idle_branch(self, handler: Callable[[], int], a: int, target: int, checks: tuple, reads: tuple) -> int:
+        # the jump at the end of a loop found by idle_loop(); 'checks' are
+        # those of the idle_ports it reads, 'reads' the memory it reads
+        took = handler()
+
+        if self.pc != target:
+            self.idle_state = None
+            return took
+
+        sched = self.scheduler
+        state = (a, self.a, self.f, self.bc, self.de, self.hl, self.ix, self.iy, self.sp, sched.runs)
+        skip = 0
+
+        if state == self.idle_state:
+            # the previous iteration started in the same state and only an
+            # event can change what the loop reads: skip the iterations
+            # before the next one (the loop is checked again in case it
+            # was modified)
+            period = sched.now - self.idle_time
+            n = (sched.deadline - sched.now - took - 1) // period
+
+            if n > 0 and all(check() for check in checks) and self.plain_reads(reads) and self.idle_loop(a) == target:
+                skip = n * period
+                self.idle_cycles += skip
+
+        self.idle_state = state
+        self.idle_time = sched.now + skip
+
+        return took + skip
+
+    def get_decoded(self, a: int) -> Tuple[Callable[[], int], int]:
+        entry = self.decode(a)
+        length = entry[1]
+
+        for hook in self.hooks:
+            entry = (hook.wrap(entry[0], self, a, length), length)
+
+        # instructions that run into the next 16KB page depend on what is
+        # mapped there and chained prefixes can be longer than the 4 bytes
+        # that are checked on a write; these are not cached
+        if length <= 4 and (a & 0x3fff) + length <= 0x4000:
+            self.decoded[a >> 14][a & 0x3fff] = entry
+            self.mark_code(a)
+            self.mark_code(a + length - 1)
+
+        return entry
+
+    def opcode_at(self, a: int) -> Tuple[str, int]:
+        # the instruction table and opcode of the instruction at 'a'
+        instr = self.fetch_mem(a)
+
+        if instr == 0xcb:
+            return ('cb', self.fetch_mem((a + 1) & 0xffff))
+
+        if instr == 0xed:
+            return ('ed', self.fetch_mem((a + 1) & 0xffff))
+
+        if instr == 0xdd or instr == 0xfd:
+            prefix = 'dd' if instr == 0xdd else 'fd'
+            instr = self.fetch_mem((a + 1) & 0xffff)
+
+            if instr == 0xcb:
+                return (prefix + 'cb', self.fetch_mem((a + 3) & 0xffff))
+
+            return (prefix, instr)
+
+        return ('main', instr)
+
+    def add_hook(self, hook) -> None:
+        ''' Hooks wrap the handler of each instruction that is decoded for
+        step() and run(): hook.wrap(handler, cpu, pc, length) returns the
+        handler to use instead. Compiled blocks do not use these. '''
+        self.hooks.append(hook)
+
+        self.flush_decoded()
+
+    def remove_hook(self, hook) -> None:
+        self.hooks.remove(hook)
+
+        self.flush_decoded()
+
+    def add_access_hook(self, hook, functions: dict, pages: tuple = (0, 1, 2, 3)) -> None:
+        ''' Puts the functions in 'functions' (name: function, of read_mem,
+        bus_write_mem, read_io and write_io) in front of those of the CPU.
+        What each one replaces is stored in the attribute with the same
+        name of 'hook', for the function to call. The memory functions are
+        called for every access, but only need to see those to 'pages' (of
+        16KB): LDIR and friends still copy plain memory in the others at
+        once. '''
+        for name, function in functions.items():
+            setattr(hook, name, getattr(self, name))
+            setattr(self, name, function)
+
+        self.access_hooks.append((hook, functions, pages))
+
+        if 'read_mem' in functions or 'bus_write_mem' in functions:
+            self.memory_hooks += 1
+
+            for page in pages:
+                self.hooked_pages[page] += 1
+
+    def remove_access_hook(self, hook) -> None:
+        ''' Takes out the functions of 'hook', also when hooks were added
+        after it: these then call what it called. '''
+        i = [ entry[0] for entry in self.access_hooks ].index(hook)
+        functions, pages = self.access_hooks.pop(i)[1:]
+
+        for name, function in functions.items():
+            # the hook that was added on top of this one, else the CPU
+            holder = self
+
+            for other, other_functions, other_pages in self.access_hooks[i:]:
+                if name in other_functions and getattr(other, name) == function:
+                    holder = other
+                    break
+
+            setattr(holder, name, getattr(hook, name))
+
+        if 'read_mem' in functions or 'bus_write_mem' in functions:
+            self.memory_hooks -= 1
+
+            for page in pages:
+                self.hooked_pages[page] -= 1
+
+    def set_profiler(self, profiler) -> None:
+        ''' Counts the instructions executed by step() and run() in the given
+        profiler (see profiler.py), None stops counting. '''
+        if self.profiler:
+            self.remove_hook(self.profiler)
+
+        self.profiler = profiler
+
+        if profiler:
+            self.add_hook(profiler)
+
+    def set_history(self, history) -> None:
+        ''' Remembers the last instructions executed by step() and run() in
+        the given history (see history.py), None stops this. '''
+        if self.history:
+            self.remove_hook(self.history)
+
+        self.history = history
+
+        if history:
+            self.add_hook(history)
+
+    def invalid(self, instr: int) -> int:
+        self.debug('%04x invalid instruction %02x' % (self.pc, instr))
+        assert False
+
+    def write_mem_code(self, a: int, v: int) -> None:
+        if self.code_page[a >> 8]:
+            self.invalidate_code(a)
+
+        self.bus_write_mem(a, v)
+
+    def invalidate_code(self, a: int) -> None:
+        # drops the decoded instructions that 'a' can be a part of
+        decoded = self.decoded
+
+        for i in range(0, 4):
+            b = (a - i) & 0xffff
+            decoded[b >> 14][b & 0x3fff] = None
+
+        if self.blocks:
+            self.blocks.invalidate(a)
+
+    def mark_code(self, a: int) -> None:
+        # the 256 bytes of 'a' hold code: wherever what is mapped there is
+        # mapped, writes are checked
+        layout = self.memory_layout
+        key = layout[a >> 14]
+        part = (a >> 8) & 0x3f
+
+        self.code_marks[key][part] = 1
+
+        for page in range(0, 4):
+            if layout[page] == key:
+                self.code_page[(page << 6) | part] = 1
+
+    def flush_decoded(self) -> None:
+        ''' Forgets all decoded instructions (and compiled blocks). Memory
+        that is changed without going through write_mem (e.g. by a device
+        or by a test writing to the RAM list) is not seen by the CPU: call
+        this or invalidate_range() after doing that, else the instructions
+        that were there before are executed. '''
+        empty = [ None ] * 256
+
+        for key, marks in self.code_marks.items():
+            part = marks.find(1)
+
+            while part != -1:
+                self.decode_pages[key][part << 8:(part + 1) << 8] = empty
+                marks[part] = 0
+
+                part = marks.find(1, part + 1)
+
+        if any(self.code_page):
+            self.code_page = bytearray(256)
+
+        if self.blocks:
+            self.blocks.flush()
+
+    def enable_blocks(self) -> None:
+        from blockcache import blockcache
+
+        self.blocks = blockcache(self)
+
+    def disable_blocks(self) -> None:
+        self.blocks = None
+
+    def set_memory_layout(self, layout: tuple, direct: Optional[list] = None) -> None:
+        # 'layout' has a hashable key per 16KB page describing what is
+        # mapped there; pages with the same key must have the same contents.
+        # 'direct' optionally has per page a (list, offset, writable) tuple
+        # when the page is plain memory (list[offset + (address & 0x3fff)])
+        # that can be accessed without going through read_mem/write_mem;
+        # writable pages can have a (flags, index) pair added: flags[index]
+        # is set to 1 when these are written to
+        self.memory_layout = layout
+        self.direct_pages = list(direct) if direct else [ None ] * 4
+
+        for page in range(0, 4):
+            decoded = self.decode_pages.get(layout[page])
+
+            if decoded is None:
+                decoded = self.decode_pages[layout[page]] = [ None ] * 16384
+                self.code_marks[layout[page]] = bytearray(64)
+
+            self.decoded[page] = decoded
+
+        # the same key can be mapped at another address than where its code
+        # was decoded
+        self.code_page = bytearray(b''.join(self.code_marks[layout[page]] for page in range(0, 4)))
+
+        if self.blocks:
+            self.blocks.set_layout(layout)
+
+    def step_block(self) -> int:
+        if self.scheduler.now >= self.scheduler.deadline:
+            self.scheduler.run_due()
+
+        if self.int:
+            self.accept_interrupt()
+
+        block = self.blocks.get(self.pc)
+
+        if block is None:  # executed as is
+            self.debug('Cannot compile block at %04x (%02X)' % (self.pc, self.fetch_mem(self.pc)))
+
+            return self.step()
+
+        took = block(self)
+        self.scheduler.now += took
+
+        return took
+
+    def run_block(self, budget: int, until_pc: int = -1) -> int:
+        ''' run() using compiled blocks; 'until_pc' is only checked at the
+        start of a block. '''
+        get_block = self.blocks.get
+        sched = self.scheduler
+
+        done = 0
+
+        # a deadline at the end of the budget keeps LDIR and friends from
+        # running (far) past it
+        end = sched.now + budget
+        if end < sched.deadline:
+            sched.deadline = end
+
+        while done < budget:
+            if sched.now >= sched.deadline:
+                sched.run_due()
+
+                if end < sched.deadline:
+                    sched.deadline = end
+
+            if self.int:
+                self.accept_interrupt()
+
+            pc = self.pc
+
+            if pc == until_pc:
+                break
+
+            block = get_block(pc)
+
+            if block is None:  # executed as is
+                self.debug('Cannot compile block at %04x (%02X)' % (pc, self.fetch_mem(pc)))
+
+                done += self.step()
+                continue
+
+            took = block(self)
+            sched.now += took
+            done += took
+
+        return done
 
     def init_bits(self) -> None:
         self.bits_jumps: List[Callable[[int], int]] = [ None ] * 256
@@ -533,10 +1296,8 @@ class z80:
         for i in range(0xc0, 0x100):
             self.bits_jumps[i] = self._set
 
-    def _main_mirror(self, instr: int, is_ix : bool) -> int:
-        self.interrupt_cycles += 4
-
-        return self.main_jumps[instr](instr)
+    def _main_mirror(self, handler: Callable[[], int]) -> int:
+        return handler() + 4
 
     def init_xy(self) -> None:
         self.ixy_jumps: List[Callable[[int, bool], int]] = [ None ] * 256
@@ -619,31 +1380,12 @@ class z80:
         self.ixy_jumps[0xbc] = self._cp_a_ixy_hl
         self.ixy_jumps[0xbd] = self._cp_a_ixy_hl
         self.ixy_jumps[0xbe] = self._cp_a_ixy_deref
-        self.ixy_jumps[0xcb] = self.ixy_bit
         self.ixy_jumps[0xe1] = self._pop_ixy
         self.ixy_jumps[0xe3] = self._ex_sp_ix
         self.ixy_jumps[0xe5] = self._push_ixy
         self.ixy_jumps[0xe9] = self._jp_ixy
         self.ixy_jumps[0xf9] = self._ld_sp_ixy
 
-    def _ix(self, dummy) -> int:
-        try:
-            instr = self.read_pc_inc()
-            return self.ixy_jumps[instr](instr, True)
-
-        except TypeError as te:
-            self.debug('TypeError IX(%02X): %s' % (instr, te))
-            assert False
-
-    def _iy(self, dummy) -> int:
-        try:
-            instr = self.read_pc_inc()
-            return self.ixy_jumps[instr](instr, False)
-
-        except TypeError as te:
-            self.debug('TypeError IY(%02X): %s' % (instr, te))
-            assert False
-
     def init_xy_bit(self) -> None:
         self.ixy_bit_jumps: List[Callable[[int, bool], int]] = [ None ] * 256
 
@@ -680,26 +1422,6 @@ class z80:
         for i in range(0xc0, 0x100):
             self.ixy_bit_jumps[i] = self._set_ixy
 
-    def ixy_bit(self, instr: int, which: bool) -> int:
-        try:
-            instr = self.read_mem((self.pc + 1) & 0xffff)
-            rc = self.ixy_bit_jumps[instr](instr, which)
-            self.pc = self.incp16(self.pc)
-            return rc
-
-        except TypeError as te:
-            self.debug('TypeError IXY_BIT(%02X): %s' % (instr, te))
-            assert False
-
-    def ed(self, dummy) -> int:
-        try:
-            instr = self.read_pc_inc()
-            return self.ed_jumps[instr](instr)
-
-        except TypeError as te:
-            self.debug('TypeError EXT(%02X): %s' % (instr, te))
-            assert False
-
     def m16(self, high: int, low: int) -> int:
         assert low >= 0 and low <= 255
         assert high >= 0 and high <= 255
@@ -727,19 +1449,19 @@ class z80:
 
     def get_src(self, which: int) -> Tuple[int, str]:
         if which == 0:
-            return (self.b, 'B')
+            return (self.bc >> 8, 'B')
         if which == 1:
-            return (self.c, 'C')
+            return (self.bc & 0xff, 'C')
         if which == 2:
-            return (self.d, 'D')
+            return (self.de >> 8, 'D')
         if which == 3:
-            return (self.e, 'E')
+            return (self.de & 0xff, 'E')
         if which == 4:
-            return (self.h, 'H')
+            return (self.hl >> 8, 'H')
         if which == 5:
-            return (self.l, 'L')
+            return (self.hl & 0xff, 'L')
         if which == 6:
-            a = self.m16(self.h, self.l)
+            a = self.hl
             v = self.read_mem(a)
             return (v, '(HL)')
         if which == 7:
@@ -751,25 +1473,25 @@ class z80:
         assert value >= 0 and value <= 255
 
         if which == 0:
-            self.b = value
+            self.bc = (self.bc & 0xff) | (value << 8)
             return 'B'
         elif which == 1:
-            self.c = value
+            self.bc = (self.bc & 0xff00) | value
             return 'C'
         elif which == 2:
-            self.d = value
+            self.de = (self.de & 0xff) | (value << 8)
             return 'D'
         elif which == 3:
-            self.e = value
+            self.de = (self.de & 0xff00) | value
             return 'E'
         elif which == 4:
-            self.h = value
+            self.hl = (self.hl & 0xff) | (value << 8)
             return 'H'
         elif which == 5:
-            self.l = value
+            self.hl = (self.hl & 0xff00) | value
             return 'L'
         elif which == 6:
-            self.write_mem(self.m16(self.h, self.l), value)
+            self.write_mem(self.hl, value)
             return '(HL)'
         elif which == 7:
             self.a = value
@@ -779,11 +1501,11 @@ class z80:
 
     def get_pair(self, which: int) -> Tuple[int, str]:
         if which == 0:
-            return (self.m16(self.b, self.c), 'BC')
+            return (self.bc, 'BC')
         elif which == 1:
-            return (self.m16(self.d, self.e), 'DE')
+            return (self.de, 'DE')
         elif which == 2:
-            return (self.m16(self.h, self.l), 'HL')
+            return (self.hl, 'HL')
         elif which == 3:
             return (self.sp, 'SP')
 
@@ -793,13 +1515,13 @@ class z80:
         assert v >= 0 and v <= 65535
 
         if which == 0:
-            (self.b, self.c) = self.u16(v)
+            self.bc = v
             return 'BC'
         elif which == 1:
-            (self.d, self.e) = self.u16(v)
+            self.de = v
             return 'DE'
         elif which == 2:
-            (self.h, self.l) = self.u16(v)
+            self.hl = v
             return 'HL'
         elif which == 3:
             self.sp = v
@@ -807,16 +1529,16 @@ class z80:
 
         assert False
 
-    def init_parity(self) -> None:
-        self.parity_lookup: List[bool] = [ False ] * 256
-
-        for v in range(0, 256):
-            count = 0
+    def init_flags(self) -> None:
+        tables = flag_tables()
 
-            for i in range(0, 8):
-                count += (v & (1 << i)) != 0
-
-            self.parity_lookup[v] = (count & 1) == 0
+        self.parity_lookup: List[bool] = tables['parity']
+        self.sz53p_lookup: List[int] = tables['sz53p']
+        self.add_lookup: List[int] = tables['add']
+        self.sub_lookup: List[int] = tables['sub']
+        self.inc_lookup: List[int] = tables['inc']
+        self.dec_lookup: List[int] = tables['dec']
+        self.daa_lookup: List[int] = tables['daa']
 
     def parity(self, v: int) -> bool:
         return self.parity_lookup[v]
@@ -926,20 +1648,13 @@ class z80:
 
         (val, name) = self.get_src(src)
         self.a = self.flags_add_sub_cp(False, c, val)
-        self.set_flag_53(self.a)
 
         self.debug('%04x %s A,%s' % (self.pc - 1, 'ADC' if c else 'ADD', name))
 
         return 4
 
     def or_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p_lookup[self.a]
 
     def _or(self, instr: int) -> int:
         src = instr & 7
@@ -951,8 +1666,7 @@ class z80:
         self.debug('%04x OR %s' % (self.pc - 1, name))
         return 4
 
-    def _or_val(self, instr: int) -> int:
-        v = self.read_pc_inc()
+    def _or_val(self, instr: int, v: int) -> int:
         self.a |= v
 
         self.or_flags()
@@ -961,13 +1675,7 @@ class z80:
         return 7
 
     def and_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(True)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p_lookup[self.a] | 0x10
 
     def _and(self, instr: int) -> int:
         src = instr & 7
@@ -979,8 +1687,7 @@ class z80:
         self.debug('%04x AND %s' % (self.pc - 1, name))
         return 4
 
-    def _and_val(self, instr: int) -> int:
-        v = self.read_pc_inc()
+    def _and_val(self, instr: int, v: int) -> int:
         self.a &= v
 
         self.and_flags()
@@ -989,13 +1696,7 @@ class z80:
         return 7
 
     def xor_flags(self) -> None:
-        self.set_flag_c(False)
-        self.set_flag_z(self.a == 0)
-        self.set_flag_parity()
-        self.set_flag_s(self.a >= 128)
-        self.set_flag_n(False)
-        self.set_flag_h(False)
-        self.set_flag_53(self.a)
+        self.f = self.sz53p_lookup[self.a]
 
     def _xor(self, instr: int) -> int:
         src = instr & 7
@@ -1008,9 +1709,7 @@ class z80:
         self.debug('%04x XOR %s' % (self.pc - 1, name))
         return 4
 
-    def _xor_mem(self, instr: int) -> int:
-        val = self.read_pc_inc()
-
+    def _xor_mem(self, instr: int, val: int) -> int:
         self.a ^= val
 
         self.xor_flags()
@@ -1018,8 +1717,7 @@ class z80:
         self.debug('%04x XOR %02X' % (self.pc - 1, val))
         return 7
 
-    def _out(self, instr: int) -> int:
-        a = self.read_pc_inc()
+    def _out(self, instr: int, a: int) -> int:
         self.debug('%04x OUT (#%02X),A' % (self.pc - 2, a))
         self.out(a, self.a)
         self.memptr = (a + 1) & 0xff
@@ -1048,8 +1746,7 @@ class z80:
         self.debug('%04x SLA %s' % (self.pc - 2, name))
         return 8
     
-    def ixy_boilerplate(self, is_ix: bool) -> Tuple[int, int, int, int, str]:
-        offset = self.compl8(self.read_pc_inc())
+    def ixy_boilerplate(self, is_ix: bool, offset: int) -> Tuple[int, int, int, int, str]:
         ixy = self.ix if is_ix else self.iy
         name = 'IX' if is_ix else 'IY'
         a = (ixy + offset) & 0xffff
@@ -1058,8 +1755,8 @@ class z80:
 
         return (a, ixy, val, offset, name)
 
-    def _sla_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _sla_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         val <<= 1
 
@@ -1107,8 +1804,8 @@ class z80:
         self.debug('%04x SLL %s' % (self.pc - 1, name))
         return 8
 
-    def _sll_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _sll_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         val <<= 1
         val |= 1  # only difference with sla
@@ -1158,8 +1855,8 @@ class z80:
         self.debug('%04x SRA %s' % (self.pc - 1, name))
         return 8
 
-    def _sra_ixy(self, instr: int, is_ix: bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _sra_ixy(self, instr: int, is_ix: bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         old_7 = val & 128
         self.set_flag_c((val & 1) == 1)
@@ -1186,9 +1883,8 @@ class z80:
         self.debug('%04x SRA (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
-    def _ld_val_low(self, instr: int) -> int:
+    def _ld_val_low(self, instr: int, val: int) -> int:
         which = instr >> 4
-        val = self.read_pc_inc()
 
         if which == 0:
             self.c = val
@@ -1208,9 +1904,8 @@ class z80:
         self.debug('%04x LD %s,#%02X' % (self.pc - 2, name, val))
         return 7
 
-    def _ld_val_high(self, instr: int) -> int:
+    def _ld_val_high(self, instr: int, val: int) -> int:
         which = instr >> 4
-        val = self.read_pc_inc()
         assert val >= 0 and val <= 255
 
         cycles = 7
@@ -1224,7 +1919,7 @@ class z80:
             self.h = val
             name = 'H'
         elif which == 3:
-            self.write_mem(self.m16(self.h, self.l), val)
+            self.write_mem(self.hl, val)
             name = '(HL)'
             cycles = 10
         else:
@@ -1250,19 +1945,16 @@ class z80:
 
         return cycles
 
-    def _ld_pair(self, instr: int) -> int:
+    def _ld_pair(self, instr: int, val: int) -> int:
         which = instr >> 4
-        val = self.read_pc_inc_16()
         name = self.set_pair(which, val)
 
         self.debug('%04x LD %s,#%04X' % (self.pc - 3, name, val))
 
         return 10
 
-    def _jp(self, flag : bool, flag_name) -> int:
-        org_pc = self.pc
-
-        a = self.read_pc_inc_16()
+    def _jp(self, flag : bool, flag_name, a: int) -> int:
+        org_pc = self.pc - 2
 
         if flag:
             self.pc = a
@@ -1277,8 +1969,7 @@ class z80:
 
         return 10
 
-    def _call(self, instr: int) -> int:
-        a = self.read_pc_inc_16()
+    def _call(self, instr: int, a: int) -> int:
         self.debug('%04x CALL #%04X' % (self.pc - 3, a))
         self.push(self.pc)
         self.pc = a
@@ -1314,12 +2005,11 @@ class z80:
         self.debug('%04x POP %s' % (self.pc - 1, name))
         return 10
 
-    def _jr(self, flag : bool, flag_name) -> int:
-        org_pc = self.pc
-        offset = self.read_pc_inc()
+    def _jr(self, flag : bool, flag_name, offset: int) -> int:
+        org_pc = self.pc - 1
 
         if flag:
-            self.pc += self.compl8(offset)
+            self.pc += offset
             self.pc &= 0xffff
             self.memptr = self.pc
             if flag_name != '':
@@ -1329,21 +2019,19 @@ class z80:
             return 12
 
         if flag_name != '':
-            self.debug('%04x JR %s,#%04X' % (org_pc - 1, flag_name, self.pc + self.compl8(offset)))
+            self.debug('%04x JR %s,#%04X' % (org_pc - 1, flag_name, self.pc + offset))
         else:
-            self.debug('%04x JR #%04X' % (org_pc - 1, self.pc + self.compl8(offset)))
+            self.debug('%04x JR #%04X' % (org_pc - 1, self.pc + offset))
 
         return 7
 
-    def _djnz(self, instr: int) -> int:
-        org_pc = self.pc
-        offset = self.read_pc_inc()
+    def _djnz(self, instr: int, offset: int) -> int:
+        org_pc = self.pc - 1
 
-        self.b -= 1
-        self.b &= 0xff
+        self.bc = (self.bc - 0x100) & 0xffff
 
-        if self.b != 0:
-            self.pc += self.compl8(offset)
+        if self.bc >= 0x100:
+            self.pc += offset
             self.pc &= 0xffff
             self.memptr = self.pc
             self.debug('%04x DJNZ #%04X' % (org_pc - 1, self.pc))
@@ -1351,7 +2039,7 @@ class z80:
             cycles = 13
 
         else:
-            self.debug('%04x DJNZ #%04X' % (org_pc - 1, self.pc + self.compl8(offset)))
+            self.debug('%04x DJNZ #%04X' % (org_pc - 1, self.pc + offset))
 
             cycles = 8
 
@@ -1389,9 +2077,8 @@ class z80:
         self.debug('%04x %s%s' % (self.pc - 1, 'SBC A,' if c else 'SUB ', name))
         return 7 if src == 6 else 4
 
-    def _sub_val(self, instr: int) -> int:
+    def _sub_val(self, instr: int, v: int) -> int:
         c = instr == 0xde
-        v = self.read_pc_inc()
 
         self.a = self.flags_add_sub_cp(True, c, v)
 
@@ -1411,15 +2098,7 @@ class z80:
         return 6
 
     def inc_flags(self, before: int) -> None:
-        before = self.compl8(before)
-        after = self.compl8((before + 1) & 0xff)
-
-        self.set_flag_z(after == 0)
-        self.set_flag_pv(before >= 0 and after < 0)
-        self.set_flag_s(after < 0)
-        self.set_flag_n(False)
-        self.set_flag_h(not (after & 0x0f))
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | self.inc_lookup[before]
 
     def _inc(self, instr: int) -> int:
         cycles = 4
@@ -1448,7 +2127,7 @@ class z80:
             self.l = (self.l + 1) & 0xff
             name = 'L'
         elif instr == 0x34:
-            a = self.m16(self.h, self.l)
+            a = self.hl
             v = self.read_mem(a)
             self.inc_flags(v)
             self.write_mem(a, (v + 1) & 0xff)
@@ -1499,7 +2178,7 @@ class z80:
         return 15
 
     def add_pair(self, which: int, is_adc : bool) -> str:
-        org_val = self.m16(self.h, self.l)
+        org_val = self.hl
 
         (value, name) = self.get_pair(which)
 
@@ -1519,7 +2198,7 @@ class z80:
             self.set_flag_z(result == 0)
             self.set_flag_s((result & 0x8000) == 0x8000)
 
-        (self.h, self.l) = self.u16(result)
+        self.hl = result
 
         return name
 
@@ -1533,17 +2212,7 @@ class z80:
         return 6
 
     def dec_flags(self, before: int) -> None:
-        after = before - 1
-
-        self.set_flag_n(True)
-        self.set_flag_h((after & 0x0f) == 0x0f)
-        self.set_flag_z(after == 0x00)
-        self.set_flag_s((after & 0x80) == 0x80)
-
-        before_sign = (before & 0x80) == 0x80
-        after_sign = (after & 0x80) == 0x80
-        self.set_flag_pv(before_sign and not after_sign)
-        self.set_flag_53(after & 0xff)
+        self.f = (self.f & 1) | self.dec_lookup[before]
 
     def _dec(self, instr: int) -> int:
         cycles = 4
@@ -1573,7 +2242,7 @@ class z80:
             self.l = (self.l - 1) & 0xff
             name = 'L'
         elif instr == 0x35:
-            a = self.m16(self.h, self.l)
+            a = self.hl
             v = self.read_mem(a)
             self.dec_flags(v)
             self.write_mem(a, (v - 1) & 0xff)
@@ -1608,21 +2277,20 @@ class z80:
         return 11
 
     def _ex_de_hl(self, instr: int) -> int:
-        self.d, self.h = self.h, self.d
-        self.e, self.l = self.l, self.e
+        self.de, self.hl = self.hl, self.de
         self.debug('%04x EX DE,HL' % (self.pc - 1))
         return 4
 
     def _ld_a_imem(self, instr: int) -> int:
         which = instr >> 4
         if which == 0:
-            a = self.m16(self.b, self.c)
+            a = self.bc
             self.a = self.read_mem(a)
             self.debug('%04x LD A,(BC)' % (self.pc - 1))
             self.memptr = (a + 1) & 0xffff
 
         elif which == 1:
-            a = self.m16(self.d, self.e)
+            a = self.de
             self.a = self.read_mem(a)
             self.debug('%04x LD A,(DE)' % (self.pc - 1))
             self.memptr = (a + 1) & 0xffff
@@ -1632,18 +2300,16 @@ class z80:
 
         return 7
 
-    def _ld_imem(self, instr: int) -> int:
+    def _ld_imem(self, instr: int, a: int) -> int:
         which = instr >> 4
         if which == 2:
-            a = self.read_pc_inc_16()
             v = self.read_mem_16(a)
-            (self.h, self.l) = self.u16(v)
+            self.hl = v
             self.memptr = (a + 1) & 0xffff
             self.debug('%04x LD HL,(#%04X)' % (self.pc - 3, a))
             return 16
 
         elif which == 3:
-            a = self.read_pc_inc_16()
             self.debug('%04x LD A,(#%04X)' % (self.pc - 3, a))
             self.a = self.read_mem(a)
             self.memptr = (a + 1) & 0xffff
@@ -1653,12 +2319,9 @@ class z80:
             assert False
 
     def _exx(self, instr: int) -> int:
-        self.b, self.b_ = self.b_, self.b
-        self.c, self.c_ = self.c_, self.c
-        self.d, self.d_ = self.d_, self.d
-        self.e, self.e_ = self.e_, self.e
-        self.h, self.h_ = self.h_, self.h
-        self.l, self.l_ = self.l_, self.l
+        self.bc, self.bc_ = self.bc_, self.bc
+        self.de, self.de_ = self.de_, self.de
+        self.hl, self.hl_ = self.hl_, self.hl
         self.debug('%04x EXX' % (self.pc - 1))
         return 4
 
@@ -1692,15 +2355,13 @@ class z80:
 
         return 8
 
-    def _ld_mem_from_ixy(self, instr: int, is_ix : bool) -> int:
-        a = self.read_pc_inc_16()
+    def _ld_mem_from_ixy(self, instr: int, is_ix : bool, a: int) -> int:
         self.write_mem_16(a, self.ix if is_ix else self.iy)
         self.memptr = (a + 1) & 0xffff
         self.debug('%04x LD (#%04X),I%s' % (self.pc - 3, a, 'X' if is_ix else 'Y'))
         return 20
 
-    def _ld_ixy_from_mem(self, instr: int, is_ix : bool) -> int:
-        a = self.read_pc_inc_16()
+    def _ld_ixy_from_mem(self, instr: int, is_ix : bool, a: int) -> int:
         v = self.read_mem_16(a)
 
         if is_ix:
@@ -1748,17 +2409,15 @@ class z80:
             self.debug('%04x LD SP,IY' % (self.pc - 1))
         return 10
 
-    def _ld_mem_pair(self, instr: int) -> int:
+    def _ld_mem_pair(self, instr: int, a: int) -> int:
         which = (instr >> 4) - 4
-        a = self.read_pc_inc_16()
         (v, name) = self.get_pair(which)
         self.write_mem_16(a, v)
         self.memptr = (a + 1) & 0xffff
         self.debug('%04x LD (#%04X),%s' % (self.pc - 4, a, name))
         return 20
 
-    def _ld_pair_mem(self, instr: int) -> int:
-        a = self.read_pc_inc_16()
+    def _ld_pair_mem(self, instr: int, a: int) -> int:
         v = self.read_mem_16(a)
         self.memptr = (a + 1) & 0xffff
         name = self.set_pair((instr >> 4) - 4, v)
@@ -1859,7 +2518,7 @@ class z80:
 
     def _rrd_rld(self, instr: int) -> int:
         org_a = self.a
-        a = self.m16(self.h, self.l)
+        a = self.hl
         v_hl = self.read_mem(a)
 
         if instr == 0x67:  # rrd
@@ -1905,8 +2564,7 @@ class z80:
         self.debug('%04x LD A,R' % (self.pc - 1))
         return 9
 
-    def _in(self, instr: int) -> int:
-        a = self.read_pc_inc()
+    def _in(self, instr: int, a: int) -> int:
         old_a = self.a
         self.debug('%04x IN A,(#%02X)' % (self.pc - 2, a))
         self.a = self.in_(a)
@@ -1914,13 +2572,12 @@ class z80:
         return 11
 
     def _ld_sp_hl(self, instr: int) -> int:
-        self.sp = self.m16(self.h, self.l)
+        self.sp = self.hl
         self.debug('%04x LD SP,HL' % (self.pc - 1))
         return 6
 
-    def _add_a_val(self, instr: int) -> int:
+    def _add_a_val(self, instr: int, v: int) -> int:
         use_c = instr == 0xce
-        v = self.read_pc_inc()
 
         self.a = self.flags_add_sub_cp(False, use_c, v)
 
@@ -1931,11 +2588,11 @@ class z80:
         which = instr >> 4
 
         if which == 0:  # (BC) = a
-            a = self.m16(self.b, self.c)
+            a = self.bc
             self.write_mem(a, self.a)
             self.debug('%04x LD (BC),A' % (self.pc - 1))
         elif which == 1:
-            a = self.m16(self.d, self.e)
+            a = self.de
             self.write_mem(a, self.a)
             self.debug('%04x LD (DE),A' % (self.pc - 1))
         else:
@@ -1946,10 +2603,9 @@ class z80:
 
         return 7
 
-    def _ld_imem_from(self, instr: int) -> int:
+    def _ld_imem_from(self, instr: int, a: int) -> int:
         which = instr >> 4
         if which == 2:  # LD (**), HL
-            a = self.read_pc_inc_16()
             self.write_mem(a, self.l)
             self.write_mem((a + 1) & 0xffff, self.h)
             self.memptr = a + 1
@@ -1957,7 +2613,6 @@ class z80:
             return 16
 
         elif which == 3:  # LD (**), A
-            a = self.read_pc_inc_16()
             self.write_mem(a, self.a)
             self.memptr = (a + 1) & 0xff
             self.memptr |= self.a << 8
@@ -2036,8 +2691,8 @@ class z80:
         self.debug('%04x RLC %s' % (self.pc - 2, name))
         return 15 if src == 6 else 8
 
-    def _rlc_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _rlc_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2092,8 +2747,8 @@ class z80:
         self.debug('%04x RRC %s' % (self.pc - 1, name))
         return 8
 
-    def _rrc_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _rrc_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2120,25 +2775,176 @@ class z80:
         self.debug('%04x RRC (%s+#%02X),%s' % (self.pc - 2, name, offset, dst_name))
         return 23
 
-    def _cp_mem(self, instr: int) -> int:
-        v = self.read_pc_inc()
-
+    def _cp_mem(self, instr: int, v: int) -> int:
         self.flags_add_sub_cp(True, False, v)
         self.set_flag_53(v)
 
         self.debug('%04x CP #%02X' % (self.pc - 2, v))
         return 7
 
+    def repeat_limit(self) -> int:
+        # how many more iterations (of 21 cycles) of a repeating block
+        # instruction can be done before the next scheduled event
+        return (self.scheduler.deadline - self.scheduler.now - 1) // 21
+
+    def invalidate_range(self, a: int, n: int) -> None:
+        ''' Drops the decoded instructions and blocks in 'n' bytes from 'a'
+        (see flush_decoded()). '''
+        for page in range(a >> 8, ((a + n - 1) >> 8) + 1):
+            if self.code_page[page]:
+                for b in range(max(a, page << 8), min(a + n, (page + 1) << 8)):
+                    self.invalidate_code(b)
+
+    def bulk_copy(self, up: bool) -> int:
+        ''' LDIR/LDDR on plain memory: moves all but the last byte at once
+        (in slices of at most a page). Returns the number of bytes moved. '''
+        hooked = self.hooked_pages
+        n = min((self.bc - 1) & 0xffff, self.repeat_limit())
+        instr_a = (self.pc - 2) & 0xffff
+        hl = self.hl
+        de = self.de
+        done = 0
+
+        while done < n:
+            src = self.direct_pages[hl >> 14]
+            dst = self.direct_pages[de >> 14]
+
+            if src is None or dst is None or not dst[2] or hooked[hl >> 14] or hooked[de >> 14]:
+                break
+
+            # 0xffff is not touched: it can be a register (MSX sub slots)
+            if up:
+                count = min(n - done, 0x4000 - (hl & 0x3fff), 0x4000 - (de & 0x3fff), 0xffff - hl, 0xffff - de)
+                src_a = hl
+                dst_a = de
+
+            else:
+                count = min(n - done, (hl & 0x3fff) + 1, (de & 0x3fff) + 1)
+                if hl == 0xffff or de == 0xffff:
+                    break
+
+                src_a = hl - count + 1
+                dst_a = de - count + 1
+
+            s = src[1] + (src_a & 0x3fff)
+            d = dst[1] + (dst_a & 0x3fff)
+
+            if count <= 0 or s < 0 or d < 0 or s + count > len(src[0]) or d + count > len(dst[0]):
+                break
+
+            # would overwrite this instruction
+            if (instr_a - dst_a) & 0xffff < count or (instr_a + 1 - dst_a) & 0xffff < count:
+                break
+
+            smem = src[0]
+            dmem = dst[0]
+
+            if smem is dmem and up and 0 < d - s < count:  # overlap: repeats the first d - s bytes
+                pattern = smem[s:d]
+                dmem[d:d + count] = (pattern * (count // len(pattern) + 1))[0:count]
+
+            elif smem is dmem and not up and 0 < s - d < count:
+                pattern = smem[d + count:s + count]
+                p = len(pattern)
+                dmem[d:d + count] = [ pattern[p - 1 - ((count - 1 - i) % p)] for i in range(count) ]
+
+            else:
+                dmem[d:d + count] = smem[s:s + count]
+
+            if len(dst) > 3:
+                dst[3][0][dst[3][1]] = 1
+
+            self.invalidate_range(dst_a, count)
+
+            if up:
+                hl = (hl + count) & 0xffff
+                de = (de + count) & 0xffff
+
+            else:
+                hl = (hl - count) & 0xffff
+                de = (de - count) & 0xffff
+
+            done += count
+
+        if done:
+            self.hl = hl
+            self.de = de
+            self.bc = (self.bc - done) & 0xffff
+            self.memptr = (instr_a + 1) & 0xffff
+
+        return done
+
+    def bulk_search(self, up: bool) -> int:
+        ''' CPIR/CPDR on plain memory: skips all bytes before the one that
+        matches A (or the last one). Returns the number of bytes skipped. '''
+        hooked = self.hooked_pages
+        n = min((self.bc - 1) & 0xffff, self.repeat_limit())
+        instr_a = (self.pc - 2) & 0xffff
+        hl = self.hl
+        done = 0
+
+        while done < n:
+            src = self.direct_pages[hl >> 14]
+
+            if src is None or hooked[hl >> 14]:
+                break
+
+            if up:
+                count = min(n - done, 0x4000 - (hl & 0x3fff), 0xffff - hl)
+                s = src[1] + (hl & 0x3fff)
+
+            else:
+                if hl == 0xffff:
+                    break
+
+                count = min(n - done, (hl & 0x3fff) + 1)
+                s = src[1] + (hl & 0x3fff) - count + 1
+
+            if count <= 0 or s < 0 or s + count > len(src[0]):
+                break
+
+            chunk = src[0][s:s + count]
+
+            if not up:
+                chunk.reverse()
+
+            found = self.a in chunk
+
+            if found:
+                count = chunk.index(self.a)
+
+            if up:
+                hl = (hl + count) & 0xffff
+
+            else:
+                hl = (hl - count) & 0xffff
+
+            done += count
+
+            if found:
+                break
+
+        if done:
+            self.hl = hl
+            self.bc = (self.bc - done) & 0xffff
+            self.memptr = (instr_a + 1) & 0xffff
+
+        return done
+
     def _ldd_ldi_r(self, instr: int) -> int:
         org_pc = self.pc - 2
 
+        bulk = 0
+        if instr == 0xb0 or instr == 0xb8:  # LDIR / LDDR
+            bulk = self.bulk_copy(instr == 0xb0) * 21
+
         self.set_flag_n(False)
         self.set_flag_pv(False)
         self.set_flag_h(False)
 
-        bc = self.m16(self.b, self.c)
-        de = self.m16(self.d, self.e)
-        hl = self.m16(self.h, self.l)
+        bc = self.bc
+        de = self.de
+        hl = self.hl
 
         v = self.read_mem(hl)
         # print('hl %04x -> de %04x %02x' % (hl, de, v))
@@ -2175,9 +2981,9 @@ class z80:
                 self.memptr = (self.pc + 1) & 0xffff
             cycles = 21
 
-        (self.b, self.c) = self.u16(bc)
-        (self.d, self.e) = self.u16(de)
-        (self.h, self.l) = self.u16(hl)
+        self.bc = bc
+        self.de = de
+        self.hl = hl
 
         self.set_flag_pv(bc != 0)
 
@@ -2187,7 +2993,7 @@ class z80:
         self.f |= 0x08 if (temp & (1 << 3)) else 0
 
         self.debug('%04x %s' % (org_pc, name))
-        return cycles
+        return bulk + cycles
 
     def _rl(self, instr: int) -> int:
         src = instr & 7
@@ -2213,8 +3019,8 @@ class z80:
 
         return 15 if src == 6 else 8
 
-    def _rl_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _rl_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2265,8 +3071,8 @@ class z80:
 
         return 15 if src == 6 else 8
 
-    def _rr_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _rr_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2327,9 +3133,8 @@ class z80:
 
         return cycles
 
-    def _call_flag(self, flag : bool, flag_name) -> int:
-        org_pc = self.pc
-        a = self.read_pc_inc_16()
+    def _call_flag(self, flag : bool, flag_name, a: int) -> int:
+        org_pc = self.pc - 2
 
         cycles = 10
         if flag:
@@ -2354,11 +3159,11 @@ class z80:
         return 4
 
     def _ex_sp_hl(self, instr: int) -> int:
-        hl = self.m16(self.h, self.l)
+        hl = self.hl
         org_sp_deref = self.read_mem_16(self.sp)
         self.write_mem_16(self.sp, hl)
 
-        (self.h, self.l) = self.u16(org_sp_deref)
+        self.hl = org_sp_deref
         self.memptr = org_sp_deref
 
         self.debug('%04x EX (SP),HL' % (self.pc - 1))
@@ -2462,8 +3267,8 @@ class z80:
         self.debug('%04x SRL %s' % (self.pc - 1, src_name))
         return 12 if src == 6 else 8
 
-    def _srl_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _srl_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.set_flag_n(False)
         self.set_flag_h(False)
@@ -2518,10 +3323,10 @@ class z80:
     def _sbc_pair(self, instr: int) -> int:
         which = (instr >> 4) - 4
         (v, name) = self.get_pair(which)
-        before = self.m16(self.h, self.l)
+        before = self.hl
 
         result = self.flags_add_sub_cp16(True, True, before, v)
-        (self.h, self.l) = self.u16(result)
+        self.hl = result
 
         self.set_flag_z(result == 0)
         self.set_flag_s((result & 0x8000) == 0x8000)
@@ -2544,9 +3349,7 @@ class z80:
         self.debug('%04x NEG' % (self.pc - 1))
         return 8
 
-    def _ld_ixy(self, instr: int, is_ix : bool) -> int:
-        v = self.read_pc_inc_16()
-
+    def _ld_ixy(self, instr: int, is_ix : bool, v: int) -> int:
         if is_ix:
             self.ix = v
             self.debug('%04x LD ix,**' % (self.pc - 4))
@@ -2588,7 +3391,7 @@ class z80:
 
         self.out(self.c, v)
 
-        self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
+        self.memptr = (self.bc + 1) & 0xffff
 
         self.debug('%04x OUT (C),%s' % (self.pc - 1, name))
         return 12
@@ -2611,7 +3414,7 @@ class z80:
         else:
             assert False
 
-        self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
+        self.memptr = (self.bc + 1) & 0xffff
 
         self.out(self.c, v)
 
@@ -2642,7 +3445,7 @@ class z80:
         self.set_flag_z(v == 0)
         self.set_flag_s((v & 0x80) == 0x80)
 
-        self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
+        self.memptr = (self.bc + 1) & 0xffff
 
         self.debug('%04x IN %s,(C)' % (self.pc - 1, name))
         return 12
@@ -2676,18 +3479,17 @@ class z80:
         return 12
 
     def _outi(self, instr: int) -> int:
-        a = self.m16(self.h, self.l)
+        a = self.hl
         self.out(self.c, self.read_mem(a))
 
         a += 1
         a &= 0xffff
 
-        (self.h, self.l) = self.u16(a)
+        self.hl = a
 
-        self.b -= 1
-        self.b &= 0xff
+        self.b = (self.b - 1) & 0xff
 
-        self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
+        self.memptr = (self.bc + 1) & 0xffff
 
         self.set_flag_n(True)
         self.set_flag_z(self.b == 0)
@@ -2695,8 +3497,8 @@ class z80:
         self.debug('%04x OUTI' % (self.pc - 1))
         return 16
 
-    def _ld_ixy_X(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _ld_ixy_X(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         which = instr & 15
         (val, src_name) = self.get_src(which)
@@ -2706,7 +3508,7 @@ class z80:
         return 19
 
     def _otir(self, instr: int) -> int:
-        a = self.m16(self.h, self.l)
+        a = self.hl
 
         while True:
             mem = self.read_mem(a)
@@ -2714,13 +3516,12 @@ class z80:
 
             a = self.incp16(a)
 
-            self.b -= 1
-            self.b &= 0xff
+            self.b = (self.b - 1) & 0xff
 
             if self.b == 0:
                 break
 
-        (self.h, self.l) = self.u16(a)
+        self.hl = a
 
         self.set_flag_n(True)
         self.set_flag_z(True)
@@ -2729,8 +3530,12 @@ class z80:
         return 21  # FIXME or 16?
 
     def _cpi_cpd_r(self, instr: int) -> int:
-        hl = self.m16(self.h, self.l)
-        bc = self.m16(self.b, self.c)
+        bulk = 0
+        if instr == 0xb1 or instr == 0xb9:  # CPIR / CPDR
+            bulk = self.bulk_search(instr == 0xb1) * 21
+
+        hl = self.hl
+        bc = self.bc
 
         mem = self.read_mem(hl)
 
@@ -2748,8 +3553,8 @@ class z80:
 
         result = self.a - mem
 
-        (self.h, self.l) = self.u16(hl)
-        (self.b, self.c) = self.u16(bc)
+        self.hl = hl
+        self.bc = bc
 
         self.set_flag_n(True)
         self.set_flag_pv(bc != 0)
@@ -2781,10 +3586,9 @@ class z80:
 
         self.debug('%04x %s' % (self.pc - 2, name))
 
-        return cycles
+        return bulk + cycles
 
-    def _and_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        offset = self.compl8(self.read_pc_inc())
+    def _and_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
         a = ((self.ix if is_ix else self.iy) + offset) & 0xffff
         self.memptr = a
 
@@ -2795,8 +3599,8 @@ class z80:
         self.debug('%04x AND (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
-    def _ld_X_ixy_deref(self, which, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _ld_X_ixy_deref(self, which, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
  
         if which == 0x46:
             self.b = val
@@ -2832,55 +3636,25 @@ class z80:
         self.debug('%04x LD %s,(IX+#%02x)' % (self.pc - 3, name, offset))
         return 19
 
-    def _add_a_deref_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _add_a_deref_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.a = self.flags_add_sub_cp(False, False, val)
 
         self.debug('%04x ADD A,(%s+#%02x)' % (self.pc - 3, name, offset))
         return 19
 
-    # from https://stackoverflow.com/questions/8119577/z80-daa-instruction/8119836
     def _daa(self, instr: int) -> int:
-        t = 0
-
-        if self.get_flag_h() or (self.a & 0x0f) > 9:
-            t += 1
-
-        if self.get_flag_c() or self.a > 0x99:
-            t += 2
-            self.set_flag_c(True)
-
-        if self.get_flag_n() and not self.get_flag_h():
-            self.set_flag_h(False)
-
-        else:
-            if self.get_flag_n() and self.get_flag_h():
-                self.set_flag_h((self.a & 0x0f) < 6)
-            else:
-                self.set_flag_h((self.a & 0x0f) >= 0x0a)
-
-        if t == 1:
-            self.a += 0xfa if self.get_flag_n() else 0x06
-
-        elif t == 2:
-            self.a += 0xa0 if self.get_flag_n() else 0x60
-
-        elif t == 3:
-            self.a += 0x9a if self.get_flag_n() else 0x66
-
-        self.a &= 0xff
-
-        self.set_flag_s((self.a & 128) == 128)
-        self.set_flag_z(self.a == 0x00)
-        self.set_flag_pv(self.parity(self.a))
-        self.set_flag_53(self.a)
+        # see flag_tables()
+        v = self.daa_lookup[((self.f & 0x13) << 8) | self.a]
+        self.a = v >> 8
+        self.f = v & 0xff
 
         self.debug('%04x DAA' % (self.pc - 1))
         return 4
 
     def _jp_hl(self, instr: int) -> int:
-        self.pc = self.m16(self.h, self.l)
+        self.pc = self.hl
 
         self.debug('%04x JP (HL)' % (self.pc - 1))
 
@@ -2888,8 +3662,17 @@ class z80:
 
     def _halt(self, instr: int) -> int:
         self.pc = (self.pc - 1) & 0xffff
-        self.debug('%04x HALT' % (self.pc - 1))
-        return 4
+        self.halted = True
+
+        # nothing changes until the next event (e.g. the VDP interrupt), so
+        # all the HALT cycles (a NOP each: 4 cycles and R + 1) up to it are
+        # done at once
+        n = max(1, (self.scheduler.deadline - self.scheduler.now + 3) // 4)
+        self.r = (self.r & 0x80) | ((self.r + n) & 0x7f)
+        self.halt_cycles += (n - 1) * 4
+
+        self.debug('%04x HALT' % self.pc)
+        return n * 4
 
     def _inc_ixh(self, instr: int, is_ix : bool) -> int:
         work = (self.ix if is_ix else self.iy) >> 8
@@ -2913,8 +3696,7 @@ class z80:
         self.debug('%04x INC %s' % (self.pc - 2, 'IXH' if is_ix else 'IYH'))
         return 8
 
-    def _ld_ixh(self, instr: int, is_ix : bool) -> int:
-        v = self.read_pc_inc()
+    def _ld_ixh(self, instr: int, is_ix : bool, v: int) -> int:
         if is_ix:
             self.ix = (self.ix & 0x00ff) | (v << 8)
         else:
@@ -2944,8 +3726,7 @@ class z80:
         self.debug('%04x INC %s' % (self.pc - 2, 'IXL' if is_ix else 'IYL'))
         return 8
 
-    def _ld_ixl(self, instr: int, is_ix : bool) -> int:
-        v = self.read_pc_inc()
+    def _ld_ixl(self, instr: int, is_ix : bool, v: int) -> int:
         if is_ix:
             self.ix = (self.ix & 0xff00) | v
         else:
@@ -2953,8 +3734,8 @@ class z80:
         self.debug('%04x LD %s,%02X' % (self.pc - 3, 'IXL' if is_ix else 'IYL', v))
         return 11
 
-    def _inc_ix_index(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _inc_ix_index(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.inc_flags(val)
         val = (val + 1) & 0xff
@@ -2963,8 +3744,8 @@ class z80:
         self.debug('%04x INC (%s+#%02X)' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff))
         return 23
 
-    def _dec_ix_index(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _dec_ix_index(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         self.dec_flags(val)
         val = (val - 1) & 0xff
@@ -2973,18 +3754,16 @@ class z80:
         self.debug('%04x DEC (%s+#%02X)' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff))
         return 23
 
-    def _ld_ix_index(self, instr: int, is_ix : bool) -> int:
-        offset = self.compl8(self.read_pc_inc())
+    def _ld_ix_index(self, instr: int, is_ix : bool, offset: int, v: int) -> int:
         ixy = self.ix if is_ix else self.iy
         a = (ixy + offset) & 0xffff
         self.memptr = a
-        v = self.read_pc_inc()
         self.write_mem(a, v)
         self.debug('%04x LD (%s+#%02X), #%02X' % (self.pc - 3, 'IXL' if is_ix else 'IYL', offset & 0xff, v))
         return 19
 
-    def _bit_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _bit_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
 
         src_name = '(%s+#%02X)' % (name, offset)
 
@@ -3131,16 +3910,16 @@ class z80:
 
         return 8
 
-    def _adc_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _adc_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
  
         self.a = self.flags_add_sub_cp(False, True, val)
         self.debug('%04x ACD A,(I%s%s+#%02X)' % (self.pc - 3, 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H', offset & 0xff))
 
         return 19
 
-    def _sub_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _sub_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
  
         self.a = self.flags_add_sub_cp(True, instr == 0x9e, val)
         self.debug('%04x %s A,(I%s%s+#%02X)' % (self.pc - 3, 'SBC' if instr == 0x9e else 'SUB', 'X' if is_ix else 'Y', 'L' if instr & 1 else 'H', offset & 0xff))
@@ -3200,8 +3979,7 @@ class z80:
 
         return 8
 
-    def _xor_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        offset = self.compl8(self.read_pc_inc())
+    def _xor_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
         a = ((self.ix if is_ix else self.iy) + offset) & 0xffff
         self.memptr = a
 
@@ -3211,8 +3989,7 @@ class z80:
         self.debug('%04x XOR (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
-    def _or_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        offset = self.compl8(self.read_pc_inc())
+    def _or_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
         a = ((self.ix if is_ix else self.iy) + offset) & 0xffff
         self.memptr = a
 
@@ -3222,8 +3999,7 @@ class z80:
         self.debug('%04x OR (I%s+#%02x)' % (self.pc - 3, 'X' if is_ix else 'Y', offset))
         return 19
 
-    def _cp_a_ixy_deref(self, instr: int, is_ix : bool) -> int:
-        offset = self.compl8(self.read_pc_inc())
+    def _cp_a_ixy_deref(self, instr: int, is_ix : bool, offset: int) -> int:
         a = ((self.ix if is_ix else self.iy) + offset) & 0xffff
         self.memptr = a
 
@@ -3235,8 +4011,8 @@ class z80:
 
         return 8
 
-    def _res_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _res_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
  
         bit = (instr - 0x80) >> 3
         val &= ~(1 << bit)
@@ -3253,8 +4029,8 @@ class z80:
         self.debug('%04x RES (%s+#%02X),%s' % (self.pc - 3, name, offset, dst_name))
         return 23
 
-    def _set_ixy(self, instr: int, is_ix : bool) -> int:
-        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix)
+    def _set_ixy(self, instr: int, is_ix : bool, offset: int) -> int:
+        a, ixy, val, offset, name = self.ixy_boilerplate(is_ix, offset)
  
         bit = (instr - 0xc0) >> 3
         val |= 1 << bit
@@ -3289,10 +4065,10 @@ class z80:
     def _ini_r(self, instr: int) -> int:
         v = self.in_(self.c)
 
-        hl = self.m16(self.h, self.l)
+        hl = self.hl
         self.write_mem(hl, v)
 
-        self.memptr = (self.m16(self.b, self.c) + 1) & 0xffff
+        self.memptr = (self.bc + 1) & 0xffff
 
         self.b = (self.b - 1) & 0xff
 
@@ -3306,7 +4082,7 @@ class z80:
         self.set_flag_c(temp < v)
 
         hl = (hl + 1) & 0xffff
-        (self.h, self.l) = self.u16(hl)
+        self.hl = hl
 
         cycles = 16
         if instr == 0xb2:  # INIR
@@ -3317,3 +4093,6 @@ class z80:
         self.debug('%04x %s' % (self.pc - 2, 'INIR' if instr == 0xb2 else 'INI'))
 
         return cycles
+
+for name, (pair, shift) in register_views.items():
+    setattr(z80, name, register_view(pair, shift))
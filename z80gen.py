@@ -0,0 +1,749 @@
+# (C) 2020 by Folkert van Heusden <mail@vanheusden.com>
+# released under AGPL v3.0
+
+# Turns the handlers of z80.py into one function per opcode: the opcode (and
+# IX/IY selection) is filled in, helpers like get_src() and set_dst() are
+# inlined, branches that can not be taken are removed and so is the debug
+# output. The result is written to disk so that it is only regenerated when
+# z80.py or this file changes.
+
+import ast
+import copy
+import hashlib
+import importlib.util
+import inspect
+import os
+import textwrap
+from typing import Dict, List, Optional, Tuple
+
+# methods of the z80 class that are inlined into the handlers
+inline_names = ('get_src', 'set_dst', 'get_pair', 'set_pair', 'm16', 'u16', 'incp16', 'decp16', 'parity', 'read_mem_16', 'write_mem_16', 'pop', 'push', 'in_', 'out',
+                'set_flag_53', 'set_flag_c', 'get_flag_c', 'set_flag_n', 'get_flag_n', 'set_flag_pv', 'set_flag_parity', 'get_flag_pv', 'set_flag_h', 'get_flag_h', 'set_flag_z', 'get_flag_z', 'set_flag_s', 'get_flag_s',
+                'flags_add_sub_cp', 'flags_add_sub_cp16', 'or_flags', 'and_flags', 'xor_flags', 'inc_flags', 'dec_flags', 'add_pair', 'ixy_boilerplate',
+                '_jr', '_jp', '_ret', '_call_flag')
+
+def is_pure(node: ast.AST) -> bool:
+    # no calls, so evaluating it has no side effects
+    for n in ast.walk(node):
+        if isinstance(n, (ast.Call, ast.NamedExpr, ast.Lambda, ast.Yield, ast.YieldFrom, ast.Await)):
+            return False
+
+    return True
+
+def is_simple(node: ast.AST) -> bool:
+    return isinstance(node, (ast.Constant, ast.Name)) or (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name))
+
+def self_call(node: ast.AST) -> Optional[str]:
+    # name of the method if 'node' is self.<method>(...)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id == 'self':
+        return node.func.attr
+
+    return None
+
+def stored_names(nodes: List[ast.AST]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+
+    for node in nodes:
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+                counts[n.id] = counts.get(n.id, 0) + 1
+
+            elif isinstance(n, ast.AugAssign) and isinstance(n.target, ast.Name):
+                counts[n.target.id] = counts.get(n.target.id, 0) + 1
+
+    return counts
+
+def loaded_names(nodes: List[ast.AST]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+
+    for node in nodes:
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load):
+                counts[n.id] = counts.get(n.id, 0) + 1
+
+            elif isinstance(n, ast.AugAssign) and isinstance(n.target, ast.Name):
+                counts[n.target.id] = counts.get(n.target.id, 0) + 1
+
+    return counts
+
+class substitute(ast.NodeTransformer):
+    def __init__(self, values: Dict[str, ast.AST]):
+        self.values = values
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if isinstance(node.ctx, ast.Load) and node.id in self.values:
+            return copy.deepcopy(self.values[node.id])
+
+        return node
+
+class rename(ast.NodeTransformer):
+    def __init__(self, names: Dict[str, str]):
+        self.names = names
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id in self.names:
+            node.id = self.names[node.id]
+
+        return node
+
+class views(ast.NodeTransformer):
+    ''' Replaces the 8 bit registers that are a view on a register pair
+    (self.b, self.l etc.) by operations on the pair. '''
+
+    def __init__(self, views: Dict[str, Tuple[str, int]]):
+        self.views = views
+
+    def view(self, node: ast.AST) -> Optional[Tuple[str, int]]:
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'self':
+            return self.views.get(node.attr)
+
+        return None
+
+    def pair(self, name: str, ctx: ast.expr_context) -> ast.Attribute:
+        return ast.Attribute(value=ast.Name(id='self', ctx=ast.Load()), attr=name, ctx=ctx)
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        view = self.view(node)
+
+        if view is None or not isinstance(node.ctx, ast.Load):
+            return self.generic_visit(node)
+
+        pair, shift = view
+
+        if shift:
+            return ast.BinOp(left=self.pair(pair, ast.Load()), op=ast.RShift(), right=ast.Constant(value=8))
+
+        return ast.BinOp(left=self.pair(pair, ast.Load()), op=ast.BitAnd(), right=ast.Constant(value=0xff))
+
+    def store(self, target: ast.Attribute, value: ast.expr) -> ast.Assign:
+        pair, shift = self.view(target)
+
+        if shift:
+            keep = ast.BinOp(left=self.pair(pair, ast.Load()), op=ast.BitAnd(), right=ast.Constant(value=0xff))
+            value = ast.BinOp(left=value, op=ast.LShift(), right=ast.Constant(value=8))
+
+        else:
+            keep = ast.BinOp(left=self.pair(pair, ast.Load()), op=ast.BitAnd(), right=ast.Constant(value=0xff00))
+
+        return ast.Assign(targets=[self.pair(pair, ast.Store())], value=ast.BinOp(left=keep, op=ast.BitOr(), right=value))
+
+    def visit_Assign(self, node: ast.Assign) -> ast.AST:
+        self.generic_visit(node)
+
+        # tuple targets keep using the property
+        if len(node.targets) == 1 and self.view(node.targets[0]):
+            return self.store(node.targets[0], node.value)
+
+        return node
+
+    def visit_AugAssign(self, node: ast.AugAssign) -> ast.AST:
+        if self.view(node.target) is None:
+            return self.generic_visit(node)
+
+        current = self.visit(ast.Attribute(value=ast.Name(id='self', ctx=ast.Load()), attr=node.target.attr, ctx=ast.Load()))
+
+        return self.store(node.target, ast.BinOp(left=current, op=node.op, right=self.visit(node.value)))
+
+class fold(ast.NodeTransformer):
+    ''' Evaluates expressions of which all operands are known. '''
+
+    def evaluate(self, node: ast.expr) -> ast.AST:
+        try:
+            expr = ast.fix_missing_locations(ast.Expression(body=node))
+            return ast.Constant(value=eval(compile(expr, '<fold>', 'eval'), {'__builtins__': {}}))
+
+        except Exception:
+            return node
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+
+        if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+            return self.evaluate(node)
+
+        # x + 0, x | 0, x - 0, x << 0 etc.
+        if isinstance(node.right, ast.Constant) and node.right.value == 0 and type(node.right.value) == int and isinstance(node.op, (ast.Add, ast.Sub, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift)):
+            return node.left
+
+        if isinstance(node.left, ast.Constant) and node.left.value == 0 and type(node.left.value) == int and isinstance(node.op, (ast.Add, ast.BitOr, ast.BitXor)):
+            return node.right
+
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+
+        if isinstance(node.operand, ast.Constant):
+            return self.evaluate(node)
+
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+
+        if isinstance(node.left, ast.Constant) and all([ isinstance(c, ast.Constant) for c in node.comparators ]):
+            return self.evaluate(node)
+
+        return node
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+
+        is_and = isinstance(node.op, ast.And)
+        values = node.values
+
+        # leading operands that are known either decide the outcome or can
+        # be dropped
+        while isinstance(values[0], ast.Constant):
+            if len(values) == 1 or bool(values[0].value) != is_and:
+                return values[0]
+
+            values = values[1:]
+
+        if len(values) == 1:
+            return values[0]
+
+        node.values = values
+
+        return node
+
+    def visit_IfExp(self, node: ast.IfExp) -> ast.AST:
+        self.generic_visit(node)
+
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+
+        return node
+
+class generator:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.cls = type(cpu)
+        self.views = views(register_views(cpu))
+        self.sources: Dict[str, str] = {}
+        self.expressions: Dict[str, Optional[Tuple[List[str], ast.expr]]] = {}
+        self.bodies: Dict[str, Optional[Tuple[List[str], str, set]]] = {}
+        self.n_inlined: int = 0
+
+    def parse(self, name: str) -> ast.FunctionDef:
+        # parsing is cheaper than copying the tree
+        if not name in self.sources:
+            self.sources[name] = textwrap.dedent(inspect.getsource(getattr(self.cls, name)))
+
+        return self.views.visit(ast.parse(self.sources[name]).body[0])
+
+    def specialise(self, name: str, values: tuple, new_name: str) -> str:
+        ''' Source of method 'name' with its first parameters replaced by
+        'values'. '''
+        fn = self.parse(name)
+
+        params = [ arg.arg for arg in fn.args.args[1:] ]
+        known = dict([ (params[i], ast.Constant(value=v)) for i, v in enumerate(values) ])
+
+        fn.body = self.bind(fn.body, known)
+
+        for i in range(0, 25):
+            before = ast.dump(fn)
+
+            fn.body = self.optimise(fn.body)
+            fn.body = self.propagate(fn.body, params)
+            fn.body = self.optimise(fn.body)
+            fn.body = self.dead_stores(fn.body)
+            fn.body = self.forward(fn.body)
+            fn.body = self.merge(fn.body)
+
+            if ast.dump(fn) == before:
+                break
+
+        fn.name = new_name
+        fn.returns = None
+        fn.decorator_list = []
+
+        for arg in fn.args.args:
+            arg.annotation = None
+
+        return ast.unparse(ast.fix_missing_locations(fn))
+
+    def bind(self, body: List[ast.stmt], values: Dict[str, ast.AST]) -> List[ast.stmt]:
+        # parameters that are assigned to get an assignment, others are
+        # substituted
+        stored = stored_names(body)
+
+        assign = [ ast.Assign(targets=[ast.Name(id=k, ctx=ast.Store())], value=v) for k, v in values.items() if k in stored ]
+        direct = dict([ (k, v) for k, v in values.items() if not k in stored ])
+
+        return assign + [ substitute(direct).visit(stmt) for stmt in body ]
+
+    def optimise(self, body: List[ast.stmt]) -> List[ast.stmt]:
+        out: List[ast.stmt] = []
+
+        for stmt in body:
+            stmt = fold().visit(stmt)
+            stmt = self.inline_expressions(stmt)
+
+            if isinstance(stmt, ast.Expr) and self_call(stmt.value) == 'debug':
+                continue
+
+            if isinstance(stmt, ast.Assert):
+                if isinstance(stmt.test, ast.Constant) and not stmt.test.value:
+                    out.append(stmt)
+                    break
+
+                continue
+
+            if isinstance(stmt, ast.Pass):
+                continue
+
+            if isinstance(stmt, ast.Expr) and is_pure(stmt.value):
+                continue
+
+            if isinstance(stmt, ast.If):
+                if isinstance(stmt.test, ast.Constant):
+                    out += self.optimise(stmt.body if stmt.test.value else stmt.orelse)
+
+                    if out and isinstance(out[-1], (ast.Return, ast.Raise)):
+                        break
+
+                    continue
+
+                stmt.body = self.optimise(stmt.body) or [ ast.Pass() ]
+                stmt.orelse = self.optimise(stmt.orelse)
+
+            elif isinstance(stmt, (ast.For, ast.While)):
+                stmt.body = self.optimise(stmt.body) or [ ast.Pass() ]
+                stmt.orelse = self.optimise(stmt.orelse)
+
+            inlined = self.inline_statement(stmt)
+
+            if inlined is not None:
+                out += inlined
+
+            else:
+                out += self.split(stmt)
+
+            if out and isinstance(out[-1], (ast.Return, ast.Raise)):
+                break
+
+        return out
+
+    def split(self, stmt: ast.stmt) -> List[ast.stmt]:
+        # (a, b) = (x, y) -> a = x; b = y, if y does not use a
+        if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1:
+            return [ stmt ]
+
+        target = stmt.targets[0]
+        value = stmt.value
+
+        if not isinstance(target, ast.Tuple) or not isinstance(value, ast.Tuple) or len(target.elts) != len(value.elts):
+            return [ stmt ]
+
+        out: List[ast.stmt] = []
+        names = set()
+
+        for t, v in zip(target.elts, value.elts):
+            if not isinstance(t, (ast.Name, ast.Attribute)) or (isinstance(t, ast.Attribute) and not isinstance(t.value, ast.Name)):
+                return [ stmt ]
+
+            if any([ (isinstance(n, ast.Name) and n.id in names) or (isinstance(n, ast.Attribute) and n.attr in names) for n in ast.walk(v) ]):
+                return [ stmt ]
+
+            names.add(t.id if isinstance(t, ast.Name) else t.attr)
+
+            if isinstance(t, ast.Name) and isinstance(v, ast.Name) and t.id == v.id:  # a = a
+                continue
+
+            out.append(ast.Assign(targets=[t], value=v))
+
+        return out
+
+    def prepare(self, call: ast.Call) -> Optional[Tuple[List[ast.stmt], List[ast.stmt]]]:
+        ''' Body of the called method with the arguments bound (and locals
+        renamed), preceded by the assignments of the arguments that can
+        not be substituted. '''
+        name = self_call(call)
+
+        if not name in inline_names or call.keywords or any([ isinstance(a, ast.Starred) for a in call.args ]):
+            return None
+
+        key = '%s %s' % (name, [ ast.dump(a) if isinstance(a, ast.Constant) else None for a in call.args ])
+
+        if not key in self.bodies:
+            fn = self.parse(name)
+            params = [ arg.arg for arg in fn.args.args[1:] ]
+
+            if len(params) != len(call.args):
+                self.bodies[key] = None
+
+            else:
+                values = dict([ (p, a) for p, a in zip(params, call.args) if isinstance(a, ast.Constant) ])
+                body = self.optimise(self.bind(fn.body, values))
+
+                self.bodies[key] = (params, ast.unparse(ast.fix_missing_locations(ast.Module(body=body, type_ignores=[]))), set(stored_names(body).keys()))
+
+        if self.bodies[key] is None:
+            return None
+
+        params, body, stored = self.bodies[key]
+
+        self.n_inlined += 1
+
+        names = dict([ (n, '%s_%d' % (n, self.n_inlined)) for n in set(params) | stored ])
+
+        body = [ rename(names).visit(stmt) for stmt in ast.parse(body).body ]
+
+        assign: List[ast.stmt] = []
+        direct: Dict[str, ast.AST] = {}
+
+        for p, a in zip(params, call.args):
+            if isinstance(a, ast.Constant):  # already filled in
+                continue
+
+            if isinstance(a, ast.Name) and not p in stored:
+                direct[names[p]] = a
+
+            else:
+                assign.append(ast.Assign(targets=[ast.Name(id=names[p], ctx=ast.Store())], value=a))
+
+        return (assign, [ substitute(direct).visit(stmt) for stmt in body ])
+
+    def inline_statement(self, stmt: ast.stmt) -> Optional[List[ast.stmt]]:
+        if isinstance(stmt, (ast.Expr, ast.Return)):
+            call = stmt.value
+
+        elif isinstance(stmt, ast.Assign) and len(stmt.targets) == 1:
+            call = stmt.value
+
+        else:
+            return None
+
+        if not self_call(call):
+            return None
+
+        prepared = self.prepare(call)
+
+        if prepared is None:
+            return None
+
+        assign, body = prepared
+
+        if isinstance(stmt, ast.Return):
+            # the returns of the callee return from the caller
+            if not body or not isinstance(body[-1], (ast.Return, ast.Raise)):
+                body.append(ast.Return(value=ast.Constant(value=None)))
+
+            return assign + body
+
+        returns = [ n for stmt2 in body for n in ast.walk(stmt2) if isinstance(n, ast.Return) ]
+
+        if body and isinstance(body[-1], ast.Return):
+            if len(returns) != 1:
+                return None
+
+            value = body[-1].value or ast.Constant(value=None)
+            body = body[:-1]
+
+        elif len(returns) == 0:
+            value = ast.Constant(value=None)
+
+        else:
+            return None
+
+        if isinstance(stmt, ast.Expr):
+            return assign + body + ([] if is_pure(value) else [ ast.Expr(value=value) ])
+
+        return assign + body + self.split(ast.Assign(targets=stmt.targets, value=value))
+
+    def inline_expressions(self, stmt: ast.stmt) -> ast.stmt:
+        ''' Replaces calls to methods that only return a side-effect free
+        expression by that expression. '''
+        gen = self
+
+        class expressions(ast.NodeTransformer):
+            def visit_Call(self, node: ast.Call) -> ast.AST:
+                self.generic_visit(node)
+
+                name = self_call(node)
+
+                if not name in inline_names or not all([ is_pure(a) for a in node.args ]) or node.keywords:
+                    return node
+
+                found = gen.expression(name, node.args)
+
+                if found is None:
+                    return node
+
+                params, expr = found
+
+                uses = loaded_names([ expr ])
+
+                for p, a in zip(params, node.args):
+                    if uses.get(p, 0) > 1 and not is_simple(a):
+                        return node
+
+                return fold().visit(substitute(dict(zip(params, node.args))).visit(copy.deepcopy(expr)))
+
+        if isinstance(stmt, (ast.If, ast.While)):
+            stmt.test = expressions().visit(stmt.test)
+            return stmt
+
+        if isinstance(stmt, (ast.For, ast.FunctionDef)):
+            return stmt
+
+        return expressions().visit(stmt)
+
+    def expression(self, name: str, args: List[ast.expr]) -> Optional[Tuple[List[str], ast.expr]]:
+        # the expression that method 'name' returns, if that is all it does
+        # (for these arguments)
+        key = '%s %s' % (name, [ ast.dump(a) if isinstance(a, ast.Constant) else None for a in args ])
+
+        if not key in self.expressions:
+            fn = self.parse(name)
+            params = [ arg.arg for arg in fn.args.args[1:] ]
+
+            self.expressions[key] = None
+
+            if len(params) == len(args):
+                # constant arguments may reduce the method to a 'return'
+                values = dict([ (p, a) for p, a in zip(params, args) if isinstance(a, ast.Constant) ])
+                body = self.optimise(self.bind(fn.body, values))
+
+                if len(body) == 1 and isinstance(body[0], ast.Return) and body[0].value is not None and is_pure(body[0].value):
+                    self.expressions[key] = (params, body[0].value)
+
+        return self.expressions[key]
+
+    def propagate(self, body: List[ast.stmt], params: List[str]) -> List[ast.stmt]:
+        ''' Replaces locals that are assigned once (at the top level) with a
+        constant or a name that does not change. '''
+        stored = stored_names(body)
+
+        i = 0
+        while i < len(body):
+            stmt = body[i]
+            i += 1
+
+            if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1 or not isinstance(stmt.targets[0], ast.Name):
+                continue
+
+            name = stmt.targets[0].id
+
+            if stored.get(name, 0) != 1:
+                continue
+
+            value = stmt.value
+
+            if isinstance(value, ast.Name):
+                src = value.id
+                # a parameter that is never assigned, or a local that is
+                # assigned once before this point
+                if src == 'self' or stored.get(src, 0) > 1 or (stored.get(src, 0) == 1 and not self.assigned_before(body[:i - 1], src)) or (stored.get(src, 0) == 0 and not src in params):
+                    continue
+
+            elif not isinstance(value, ast.Constant):
+                continue
+
+            i -= 1
+            body = body[:i] + [ substitute({ name: value }).visit(s) for s in body[i + 1:] ]
+
+        return body
+
+    def assigned_before(self, body: List[ast.stmt], name: str) -> bool:
+        for stmt in body:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name) and stmt.targets[0].id == name:
+                return True
+
+        return False
+
+    def dead_stores(self, body: List[ast.stmt]) -> List[ast.stmt]:
+        # locals that are never read
+        reads = set([ n.id for stmt in body for n in ast.walk(stmt) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load) ])
+
+        def unused(t: ast.AST) -> bool:
+            if isinstance(t, ast.Name):
+                return not t.id in reads
+
+            if isinstance(t, ast.Tuple):
+                return all([ unused(e) for e in t.elts ])
+
+            return False
+
+        def clean(stmts: List[ast.stmt]) -> List[ast.stmt]:
+            out: List[ast.stmt] = []
+
+            for stmt in stmts:
+                if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and unused(stmt.targets[0]):
+                    if not is_pure(stmt.value):
+                        out.append(ast.Expr(value=stmt.value))
+
+                    continue
+
+                if isinstance(stmt, ast.AugAssign) and unused(stmt.target) and is_pure(stmt.value):
+                    continue
+
+                if isinstance(stmt, (ast.If, ast.For, ast.While)):
+                    stmt.body = clean(stmt.body) or [ ast.Pass() ]
+                    stmt.orelse = clean(stmt.orelse)
+
+                out.append(stmt)
+
+            return out
+
+        return clean(body)
+
+    def forward(self, body: List[ast.stmt]) -> List[ast.stmt]:
+        ''' Moves the expression of a local that is read once into the
+        statement that reads it, when nothing in between can change what
+        the expression depends on. '''
+        stored = stored_names(body)
+        loaded = loaded_names(body)
+
+        i = 0
+        while i < len(body):
+            stmt = body[i]
+            i += 1
+
+            if not isinstance(stmt, ast.Assign) or len(stmt.targets) != 1 or not isinstance(stmt.targets[0], ast.Name):
+                continue
+
+            name = stmt.targets[0].id
+
+            if stored.get(name, 0) != 1 or loaded.get(name, 0) != 1 or not is_pure(stmt.value):
+                continue
+
+            depends = set([ n.id if isinstance(n, ast.Name) else n.attr for n in ast.walk(stmt.value) if isinstance(n, (ast.Name, ast.Attribute)) ])
+
+            for j in range(i, len(body)):
+                use = body[j]
+
+                if isinstance(use, (ast.Assign, ast.AugAssign, ast.Expr, ast.Return)) and name in loaded_names([ use ]):
+                    # a call in the statement could change an attribute
+                    # before the expression is evaluated
+                    if not is_pure(use) and any([ isinstance(n, ast.Attribute) for n in ast.walk(stmt.value) ]):
+                        break
+
+                    use = substitute({ name: stmt.value }).visit(use)
+
+                    i -= 1
+                    body = body[:i] + body[i + 1:j] + [ use ] + body[j + 1:]
+                    break
+
+                # does the statement in between change anything the
+                # expression reads
+                if not isinstance(use, (ast.Assign, ast.AugAssign)) or not is_pure(use):
+                    break
+
+                targets = use.targets if isinstance(use, ast.Assign) else [ use.target ]
+
+                if any([ (isinstance(n, ast.Name) and n.id in depends) or (isinstance(n, ast.Attribute) and n.attr in depends) for t in targets for n in ast.walk(t) ]):
+                    break
+
+        return body
+
+    def merge(self, body: List[ast.stmt]) -> List[ast.stmt]:
+        ''' self.x &= a; self.x |= b -> self.x = self.x & a | b '''
+        out: List[ast.stmt] = []
+
+        for stmt in body:
+            if isinstance(stmt, (ast.If, ast.For, ast.While)):
+                stmt.body = self.merge(stmt.body)
+                stmt.orelse = self.merge(stmt.orelse)
+
+            if isinstance(stmt, ast.AugAssign) and isinstance(stmt.op, (ast.BitOr, ast.BitXor, ast.Add, ast.Sub)) and isinstance(stmt.value, ast.Constant) and stmt.value.value == 0 and isinstance(stmt.target, ast.Attribute):
+                continue
+
+            prev = out[-1] if out else None
+
+            if isinstance(stmt, ast.AugAssign) and isinstance(stmt.op, (ast.BitAnd, ast.BitOr)) and isinstance(stmt.target, ast.Attribute) and isinstance(stmt.target.value, ast.Name) and is_pure(stmt.value):
+                attr = stmt.target.attr
+
+                if not any([ isinstance(n, ast.Attribute) and n.attr == attr for n in ast.walk(stmt.value) ]):
+                    if isinstance(prev, ast.AugAssign) and ast.dump(prev.target) == ast.dump(stmt.target) and isinstance(prev.op, (ast.BitAnd, ast.BitOr)) and is_pure(prev.value):
+                        left = ast.BinOp(left=ast.Attribute(value=ast.Name(id=stmt.target.value.id, ctx=ast.Load()), attr=attr, ctx=ast.Load()), op=prev.op, right=prev.value)
+                        out[-1] = ast.Assign(targets=[stmt.target], value=ast.BinOp(left=left, op=stmt.op, right=stmt.value))
+                        continue
+
+                    if isinstance(prev, ast.Assign) and len(prev.targets) == 1 and ast.dump(prev.targets[0]) == ast.dump(stmt.target) and is_pure(prev.value):
+                        out[-1] = ast.Assign(targets=prev.targets, value=ast.BinOp(left=prev.value, op=stmt.op, right=stmt.value))
+                        continue
+
+            out.append(stmt)
+
+        return out
+
+def tables(cpu) -> List[Tuple[str, list, int]]:
+    # (name prefix, handler table, which of 'main', 'ix' and 'iy')
+    return [ ('main', cpu.main_jumps, None), ('cb', cpu.bits_jumps, None), ('ed', cpu.ed_jumps, None),
+             ('dd', cpu.ixy_jumps, True), ('fd', cpu.ixy_jumps, False), ('ddcb', cpu.ixy_bit_jumps, True), ('fdcb', cpu.ixy_bit_jumps, False) ]
+
+def generate(cpu) -> str:
+    g = generator(cpu)
+
+    out = [ '# generated by z80gen.py from z80.py, do not edit', '' ]
+
+    for prefix, table, is_ix in tables(cpu):
+        for instr, handler in enumerate(table):
+            if handler is None or handler == cpu._main_mirror:
+                continue
+
+            values = (instr,) if is_ix is None else (instr, is_ix)
+
+            out.append(g.specialise(handler.__name__, values, '%s_%02x' % (prefix, instr)))
+            out.append('')
+
+    return '\n'.join(out)
+
+def register_views(cpu) -> Dict[str, Tuple[str, int]]:
+    return getattr(inspect.getmodule(type(cpu)), 'register_views', {})
+
+def source_hash(cpu) -> str:
+    h = hashlib.sha256()
+    h.update(inspect.getsource(type(cpu)).encode('utf-8'))
+    h.update(repr(register_views(cpu)).encode('utf-8'))
+    h.update(inspect.getsource(generator).encode('utf-8'))
+    h.update(repr(inline_names).encode('utf-8'))
+
+    return h.hexdigest()[0:16]
+
+# modules that were loaded, by file name
+loaded: Dict[str, object] = {}
+
+def load(cpu, cache_dir: Optional[str] = None):
+    ''' Returns the module with the generated handlers, from the cache when
+    it is up to date. '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+
+    name = 'z80gen_%s' % source_hash(cpu)
+    path = os.path.join(cache_dir, name + '.py')
+
+    if path in loaded:
+        return loaded[path]
+
+    if not os.path.isfile(path):
+        src = generate(cpu)
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            for file in os.listdir(cache_dir):
+                if file.startswith('z80gen_') and file.endswith('.py'):
+                    os.unlink(os.path.join(cache_dir, file))
+
+            tmp = path + '.%d' % os.getpid()
+            with open(tmp, 'w') as fh:
+                fh.write(src)
+            os.replace(tmp, path)
+
+        except OSError:  # read-only location: use it without caching
+            module = type(os)(name)
+            exec(compile(src, name, 'exec'), module.__dict__)
+            loaded[path] = module
+            return module
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    loaded[path] = module
+
+    return module